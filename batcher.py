@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from storage import Storage
+from dedupe import DUPLICATES_SUPPRESSED
+
+logger = logging.getLogger(__name__)
+
+# Flush queued completions after this many milliseconds...
+BATCH_FLUSH_INTERVAL = float(os.environ.get('DOGE_BATCH_FLUSH_MS', '50')) / 1000
+# ...or as soon as this many completions are waiting, whichever comes first
+BATCH_MAX_EVENTS = int(os.environ.get('DOGE_BATCH_MAX_EVENTS', '500'))
+# After this many failed flushes in a row the batch is written one completion
+# at a time, and completions that still fail are dropped
+BATCH_MAX_ATTEMPTS = int(os.environ.get('DOGE_BATCH_MAX_ATTEMPTS', '3'))
+
+
+class CompletionEvent(NamedTuple):
+    user_id: int
+    task_id: int
+    doge_reward: int
+    referrer_id: Optional[int]
+    # Period of a recurring task the completion counts for (0 for one-time tasks)
+    period: int = 0
+
+
+class CompletionBatcher:
+    """Write-behind queue that group-commits task completions
+
+    Handlers validate a completion, submit it and confirm to the user right
+    away. Queued completions are written every BATCH_FLUSH_INTERVAL seconds
+    (or every BATCH_MAX_EVENTS events) in a single transaction, with point
+    awards aggregated into one UPDATE per affected user. A batch that keeps
+    failing is split up so one bad completion cannot hold back the rest.
+    """
+
+    def __init__(self, storage: Storage, flush_interval: float = BATCH_FLUSH_INTERVAL,
+                 max_events: int = BATCH_MAX_EVENTS, max_attempts: int = BATCH_MAX_ATTEMPTS):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.max_attempts = max_attempts
+        self._failed_flushes = 0
+        self._events: List[CompletionEvent] = []
+        self._pending: Dict[int, Set[int]] = defaultdict(set)
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushed_events = 0
+        self.flushed_batches = 0
+        self.dropped_events = 0
+        # Called with the completions each flush recorded (those not skipped as duplicates)
+        self.on_recorded: Optional[Callable[[List[tuple]], None]] = None
+
+    def start(self) -> None:
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the background flusher and write everything still queued"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Last chance to write: don't wait for more attempts before splitting the batch
+        await self.flush(split_on_failure=True)
+        logger.info(f"Completion batcher closed after {self.flushed_events} completions "
+                    f"in {self.flushed_batches} batches ({self.dropped_events} dropped)")
+
+    def is_pending(self, user_id: int, task_id: int) -> bool:
+        return task_id in self._pending.get(user_id, ())
+
+    def pending_tasks(self, user_id: int) -> Set[int]:
+        """Task ids queued for a user but not yet written"""
+        return self._pending.get(user_id, set())
+
+    def submit(self, event: CompletionEvent) -> bool:
+        """Queue a completion; returns False if the same one is already queued"""
+        tasks = self._pending[event.user_id]
+        if event.task_id in tasks:
+            return False
+        tasks.add(event.task_id)
+        self._events.append(event)
+        if len(self._events) >= self.max_events:
+            self._wakeup.set()
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing task completions: {str(e)}")
+
+    async def flush(self, split_on_failure: bool = False) -> None:
+        """Write all queued completions in one transaction"""
+        async with self._flush_lock:
+            if not self._events:
+                return
+            events, self._events = self._events, []
+            written = events
+            try:
+                recorded = await self.storage.record_completions(events)
+            except Exception:
+                self._failed_flushes += 1
+                if not split_on_failure and self._failed_flushes < self.max_attempts:
+                    # Keep the batch queued (ahead of newer events) and retry next flush
+                    self._events = events + self._events
+                    raise
+                written, recorded = await self._write_separately(events)
+            self._failed_flushes = 0
+            for event in events:
+                tasks = self._pending.get(event.user_id)
+                if tasks is not None:
+                    tasks.discard(event.task_id)
+                    if not tasks:
+                        del self._pending[event.user_id]
+            duplicates = len(written) - len(recorded)
+            if duplicates:
+                DUPLICATES_SUPPRESSED.labels('batch').inc(duplicates)
+            if self.on_recorded and recorded:
+                self.on_recorded(recorded)
+            self.flushed_events += len(written)
+            self.flushed_batches += 1
+
+    async def _write_separately(self, events: List[CompletionEvent]) -> Tuple[List[CompletionEvent], List[tuple]]:
+        """Write completions one at a time, dropping those that fail
+
+        Returns the completions written and those of them recorded rather
+        than skipped as duplicates.
+        """
+        written = []
+        recorded = []
+        for event in events:
+            try:
+                recorded.extend(await self.storage.record_completions([event]))
+            except Exception as e:
+                self.dropped_events += 1
+                logger.error(f"Dropping task completion {event} after {self._failed_flushes} failed writes: {str(e)}")
+            else:
+                written.append(event)
+        return written, recorded
@@ -1,21 +1,50 @@
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, CallbackContext
 from telegram.ext import filters
-from telegram.error import TimedOut, NetworkError, RetryAfter
-import sqlite3
+from telegram.error import BadRequest
+from telegram.request import BaseRequest, HTTPXRequest
 import asyncio
 import nest_asyncio
-import backoff
 import logging
-from typing import Optional
+from typing import Callable, List, Optional, Tuple
 import shlex
+import os
+import tempfile
+import time
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+from storage import Storage
+from sharding import create_storage, shard_for
+from batcher import CompletionBatcher, CompletionEvent
+from leaderboard import Leaderboard, LEADERBOARD_PAGE_SIZE
+from task_cache import TaskCatalog, CompletionCache
+import task_schedule
+from templates import (MessageTemplates, ShownContent, NAVIGATION_EDITS, display_name, mention, escape_markdown,
+                       with_back)
+from task_io import parse_task_document, validate_tasks, tasks_document, export_users, TASK_IMPORT_MAX_BYTES
+from onboarding import OnboardingCache, OnboardingState
+from dedupe import RecentKeys, DUPLICATES_SUPPRESSED
+from dispatch import OutboundDispatcher, PRIORITY_INTERACTIVE
+from broadcast import Broadcaster
+from webhook import run_webhook, WEBHOOK_QUEUE_SIZE
+from update_processor import UserOrderedUpdateProcessor
+from throttle import create_throttle
+from scheduler import Scheduler
+import stats
+from stats import StatsCounters
+import metrics
+from metrics import instrument, InstrumentedRequest
+import logs
+from logs import RateLimitedLog
+from update_trace import TraceRecorder, TRACE_PATH
+
+# Configure logging: records are formatted and written on a background thread
+logs.configure()
 logger = logging.getLogger(__name__)
+# Warnings that can repeat for every update while Telegram misbehaves
+limited_logger = RateLimitedLog(logger)
+
+# Count every logged error in the metrics, per handler where possible
+logging.getLogger().addHandler(metrics.ErrorCounter())
 
 # Enable nested event loops
 nest_asyncio.apply()
@@ -26,6 +55,28 @@ TOKEN = '7480193735:AAHm8FihmOVjJ1oyUa7521Xgfbtg-7SGKoQ'
 # Replace with your bot username
 BOT_USERNAME = 'doge_adventurer_bot'
 
+# Replace with your actual admin user ID
+YOUR_ADMIN_USER_ID = 1878591152
+
+# How updates are received: 'polling' or 'webhook' (see webhook.py for its settings)
+UPDATE_MODE = os.environ.get('DOGE_UPDATE_MODE', 'polling')
+
+# How menu views are shown: 'edit' redraws the menu message in place (with a back
+# button), 'send' answers every tap with a new message
+NAVIGATION_MODE = os.environ.get('DOGE_NAVIGATION_MODE', 'edit')
+
+# Updates processed at the same time; each user's updates still run in order
+UPDATE_CONCURRENCY = int(os.environ.get('DOGE_UPDATE_CONCURRENCY', '32'))
+
+# Seconds the social-task confirmation stays up before the main welcome replaces it
+WELCOME_DELAY = 3.5
+
+# Invitees shown per page of "My Referrals"
+REFERRALS_PAGE_SIZE = int(os.environ.get('DOGE_REFERRALS_PAGE_SIZE', '20'))
+
+# Rejected rows listed in the /importtasks reply
+IMPORT_ERRORS_SHOWN = 20
+
 # Social account links
 SOCIAL_LINKS = {
     'twitter': 'https://twitter.com/your_twitter',
@@ -34,83 +85,136 @@ SOCIAL_LINKS = {
     'discord': 'https://discord.gg/your_invite'
 }
 
-class DatabaseConnection:
-    def __init__(self):
-        self.conn = None
-    
-    def __enter__(self):
-        self.conn = sqlite3.connect('doge_world.db')
-        return self.conn
-    
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.conn:
-            self.conn.commit()
-            self.conn.close()
-
 class DogeBot:
-    def __init__(self, token: str):
+    def __init__(self, token: str, storage: Optional[Storage] = None,
+                 request: Optional[BaseRequest] = None,
+                 dispatcher: Optional[OutboundDispatcher] = None,
+                 worker: Tuple[int, int] = (0, 1)):
         self.token = token
+        # (index, count) when running as one of several worker processes (see workers.py)
+        self.worker = worker
+        self.request = request
+        self.storage = storage or create_storage()
+        self.batcher = CompletionBatcher(self.storage)
+        self.counters = StatsCounters(self.storage)
+        # Completions are counted once written, so duplicates the batch skips are not
+        self.batcher.on_recorded = self.count_completions
+        self.leaderboard = Leaderboard()
+        self.task_catalog = TaskCatalog()
+        self.task_reload_lock = asyncio.Lock()
+        self.templates = MessageTemplates(BOT_USERNAME, SOCIAL_LINKS)
+        self.navigation = NAVIGATION_MODE
+        self.shown = ShownContent()
+        self.completions = CompletionCache()
+        self.onboarding = OnboardingCache()
+        self.recent_callbacks = RecentKeys()
+        self.recent_completions = RecentKeys()
+        self.dispatcher = dispatcher or OutboundDispatcher()
+        self.broadcaster = Broadcaster(self.storage, self.dispatcher)
+        self.update_processor = UserOrderedUpdateProcessor(UPDATE_CONCURRENCY)
+        self.throttle = create_throttle(exempt=(YOUR_ADMIN_USER_ID,))
+        self.scheduler = Scheduler(self.storage, partition=worker)
+        self.scheduler.register('main_welcome', self.send_main_welcome)
         self.application = None
+        self.metrics_server = None
+        self.trace_recorder = None
+        self.index_builder = None
+        self.background_stopped = False
+        # Called after an admin command changes the tasks
+        self.on_tasks_changed: Optional[Callable[[], None]] = None
 
-    @backoff.on_exception(
-        backoff.expo,
-        (TimedOut, NetworkError),
-        max_tries=5,
-        max_time=30
-    )
     async def send_message_with_retry(self, message: str, chat_id: int, 
                                     parse_mode: Optional[str] = None,
-                                    reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
-        """Send a message with retry logic for network errors"""
+                                    reply_markup: Optional[InlineKeyboardMarkup] = None,
+                                    priority: int = PRIORITY_INTERACTIVE) -> None:
+        """Send a message through the rate-limited outbound dispatcher"""
         try:
-            if self.application and self.application.bot:
-                await self.application.bot.send_message(
-                    chat_id=chat_id,
-                    text=message,
-                    parse_mode=parse_mode,
-                    reply_markup=reply_markup
-                )
-            else:
-                logger.error("Application or bot not initialized")
-        except RetryAfter as e:
-            logger.warning(f"Rate limited. Waiting {e.retry_after} seconds")
-            await asyncio.sleep(e.retry_after)
-            return await self.send_message_with_retry(message, chat_id, parse_mode, reply_markup)
+            await self.dispatcher.send_message(chat_id, message, parse_mode=parse_mode,
+                                               reply_markup=reply_markup, priority=priority)
         except Exception as e:
             logger.error(f"Error sending message: {str(e)}")
             raise
 
+    async def edit_message_with_retry(self, query, message: str,
+                                      parse_mode: Optional[str] = None,
+                                      reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        """Edit a callback query's message through the outbound dispatcher"""
+        try:
+            await self.dispatcher.edit_message_text(query.message.chat_id, query.message.message_id,
+                                                    message, parse_mode=parse_mode,
+                                                    reply_markup=reply_markup)
+        except Exception as e:
+            logger.error(f"Error editing message: {str(e)}")
+            raise
+
+    async def edit_view(self, query, message: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+                        parse_mode: Optional[str] = 'Markdown', back: bool = True) -> None:
+        """Redraw a callback query's message, sending only what changed
+
+        Nothing is sent if the message already shows this view, and only the
+        keyboard is sent if the text is unchanged. In edit navigation mode a
+        back button to the main menu is added unless back is False.
+        """
+        if back and self.navigation == 'edit':
+            reply_markup = with_back(reply_markup)
+        chat_id, message_id = query.message.chat_id, query.message.message_id
+        fingerprint = ShownContent.fingerprint(message, parse_mode, reply_markup)
+        shown = self.shown.get(chat_id, message_id)
+        if shown == fingerprint:
+            NAVIGATION_EDITS.labels('skipped').inc()
+            return
+        try:
+            if shown is not None and shown[0] == fingerprint[0]:
+                NAVIGATION_EDITS.labels('keyboard').inc()
+                await self.dispatcher.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+            else:
+                NAVIGATION_EDITS.labels('text').inc()
+                await self.dispatcher.edit_message_text(chat_id, message_id, message, parse_mode=parse_mode,
+                                                        reply_markup=reply_markup)
+        except BadRequest as e:
+            # Telegram rejects edits that would leave the message as it is
+            if 'not modified' not in str(e).lower():
+                self.shown.forget(chat_id, message_id)
+                logger.error(f"Error editing message: {str(e)}")
+                raise
+        self.shown.put(chat_id, message_id, fingerprint)
+
+    async def show_view(self, query, message: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+                        parse_mode: Optional[str] = 'Markdown') -> None:
+        """Show a main-menu view in place (edit navigation mode) or as a new message"""
+        if self.navigation == 'edit':
+            await self.edit_view(query, message, reply_markup, parse_mode)
+        else:
+            await self.send_message_with_retry(message, query.message.chat_id, parse_mode=parse_mode,
+                                               reply_markup=reply_markup)
+
     async def start(self, update: Update, context: CallbackContext) -> None:
         """Handle the /start command"""
         try:
             user_id = update.message.from_user.id
             username = update.message.from_user.username
             
-            with DatabaseConnection() as conn:
-                c = conn.cursor()
-                
-                # Check if user exists
-                c.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-                user = c.fetchone()
-                
-                if not user:
-                    # Add new user with social_tasks_completed set to False
-                    c.execute('INSERT INTO users (user_id, username, social_tasks_completed) VALUES (?, ?, ?)', 
-                            (user_id, username, False))
-                
-                if context.args:
-                    referrer_id = int(context.args[0])
-                    c.execute('UPDATE users SET referred_by = ? WHERE user_id = ?', 
-                            (referrer_id, user_id))
-                
-                # Check if social tasks are completed
-                c.execute('SELECT social_tasks_completed FROM users WHERE user_id = ?', (user_id,))
-                social_tasks_completed = c.fetchone()[0]
-                
-                if not social_tasks_completed:
-                    # Show social task buttons
-                    await self.show_social_tasks(update, context)
-                    return
+            # Referral links carry the referrer's user id; ignore anything else
+            referrer_id = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+            self.counters.incr(stats.STARTS)
+            
+            # Known users skip the database unless a referral could still be recorded
+            state = self.onboarding.get(user_id)
+            if state is None or (referrer_id is not None and state.referrer_id is None):
+                # Add the user if needed and check if social tasks are completed
+                registration = await self.storage.register_user(user_id, username, referrer_id)
+                state = OnboardingState(registration.social_tasks_completed, registration.referred_by)
+                self.onboarding.put(user_id, state)
+                self.leaderboard.add_user(user_id, username)
+                if registration.created:
+                    self.counters.incr(stats.USERS)
+                if registration.referred:
+                    self.counters.incr(stats.REFERRED_USERS)
+            
+            if not state.social_tasks_completed:
+                # Show social task buttons
+                await self.show_social_tasks(update, context)
+                return
             
             # If social tasks are completed, show the main welcome message
             await self.show_main_welcome(update, context)
@@ -125,28 +229,11 @@ class DogeBot:
     async def show_social_tasks(self, update: Update, context: CallbackContext) -> None:
         """Show social task buttons for first-time users"""
         try:
-            message = "👋 *Welcome to Doge World!* 🐕\n\n"
-            message += "To start earning Doge Points, please join our social accounts:\n\n"
-            message += "1. Follow us on Twitter\n"
-            message += "2. Join our Telegram channel\n"
-            message += "3. Join our Telegram group\n"
-            message += "4. Join our Discord server\n\n"
-            message += "Click the buttons below to join:"
-            
-            keyboard = [
-                [InlineKeyboardButton("🐦 Follow us on Twitter", url=SOCIAL_LINKS['twitter'])],
-                [InlineKeyboardButton("📢 Join our Telegram channel", url=SOCIAL_LINKS['telegram_channel'])],
-                [InlineKeyboardButton("👥 Join our Telegram group", url=SOCIAL_LINKS['telegram_group'])],
-                [InlineKeyboardButton("🎮 Join our Discord server", url=SOCIAL_LINKS['discord'])],
-                [InlineKeyboardButton("✅ I've joined all", callback_data='social_tasks_completed')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
             await self.send_message_with_retry(
-                message,
+                self.templates.social_tasks,
                 update.message.chat_id,
                 parse_mode='Markdown',
-                reply_markup=reply_markup
+                reply_markup=self.templates.social_tasks_keyboard
             )
             
         except Exception as e:
@@ -164,23 +251,26 @@ class DogeBot:
             
             user_id = query.from_user.id
             
-            with DatabaseConnection() as conn:
-                c = conn.cursor()
-                c.execute('UPDATE users SET social_tasks_completed = ? WHERE user_id = ?', 
-                        (True, user_id))
+            if await self.storage.complete_social_tasks(user_id):
+                self.counters.incr(stats.SOCIAL_COMPLETED)
+            self.onboarding.complete_social_tasks(user_id)
             
             # Send confirmation message
-            await query.edit_message_text(
+            await self.edit_message_with_retry(
+                query,
                 "🎉 *Congratulations!* You've completed all social tasks!\n\n"
                 "Preparing your Doge World adventure...",
                 parse_mode='Markdown'
             )
             
-            # Wait 1.5 seconds
-            await asyncio.sleep(3.5)
-            
-            # Show the main welcome message
-            await self.show_main_welcome(update, context)
+            # Replace it with the main welcome message a moment later,
+            # without holding this update's slot in the meantime
+            replace = 'edit_message_id' if self.navigation == 'edit' else 'delete_message_id'
+            self.scheduler.schedule(WELCOME_DELAY, 'main_welcome', {
+                'user_id': user_id,
+                'chat_id': query.message.chat_id,
+                replace: query.message.message_id,
+            })
             
         except Exception as e:
             logger.error(f"Error in handle_social_tasks_completion: {str(e)}")
@@ -191,88 +281,132 @@ class DogeBot:
 
     async def show_main_welcome(self, update: Update, context: CallbackContext) -> None:
         """Show the main welcome message after social tasks are completed"""
+        query = update.callback_query
+        await self.send_main_welcome({
+            'user_id': query.from_user.id if query else update.message.from_user.id,
+            'chat_id': query.message.chat_id if query else update.message.chat_id,
+            'delete_message_id': query.message.message_id if query and query.message else None,
+        })
+
+    async def send_main_welcome(self, payload: dict) -> None:
+        """Send the main welcome message to a chat, replacing edit_message_id or delete_message_id if given
+
+        Also runs as the 'main_welcome' scheduled action, so it only relies on the payload
+        """
+        user_id = payload['user_id']
+        chat_id = payload['chat_id']
         try:
-            user_id = update.callback_query.from_user.id if update.callback_query else update.message.from_user.id
-            chat_id = update.callback_query.message.chat_id if update.callback_query else update.message.chat_id
+            # Turn the previous message into the welcome if possible
+            if payload.get('edit_message_id'):
+                message = self.templates.main_welcome(user_id)
+                try:
+                    await self.dispatcher.edit_message_text(chat_id, payload['edit_message_id'], message,
+                                                            parse_mode='Markdown',
+                                                            reply_markup=self.templates.main_menu)
+                    self.shown.put(chat_id, payload['edit_message_id'],
+                                   ShownContent.fingerprint(message, 'Markdown', self.templates.main_menu))
+                    return
+                except Exception as e:
+                    limited_logger.warning(f"Could not edit previous message: {str(e)}", key='edit')
             
             # Delete the previous message if it exists
-            if update.callback_query and update.callback_query.message:
+            if payload.get('delete_message_id'):
                 try:
-                    await update.callback_query.message.delete()
+                    await self.dispatcher.delete_message(chat_id, payload['delete_message_id'])
                 except Exception as e:
-                    logger.warning(f"Could not delete previous message: {str(e)}")
-            
-            # Generate referral link
-            referral_link = f"https://t.me/{BOT_USERNAME}?start={user_id}"
-            
-            # Main welcome message
-            welcome_message = "🐕 *Welcome to Doge World!* 🐕\n\n"
-            welcome_message += "You are now a **Doge Adventurer** on a quest to collect as many **Doge Points** as possible!\n\n"
-            welcome_message += "🌟 *How to Earn Doge Points:*\n"
-            welcome_message += "- Complete tasks to earn points.\n"
-            welcome_message += "- Invite friends and earn points when they complete tasks.\n\n"
-            welcome_message += f"🔗 *Your Referral Link:* `{referral_link}`\n"
-            welcome_message += "Share this link with friends to earn bonus points!\n\n"
-            welcome_message += "🏆 *Climb the Leaderboard* and become the **Top Doge**!\n\n"
-            welcome_message += "Use the buttons below to get started:"
-            
-            # Main menu buttons
-            keyboard = [
-                [InlineKeyboardButton("📜 Tasks", callback_data='tasks')],
-                [InlineKeyboardButton("🏆 Leaderboard", callback_data='leaderboard')],
-                [InlineKeyboardButton("👤 Referral Info", callback_data='referral')],
-                [InlineKeyboardButton("👥 My Referrals", callback_data='my_referrals')],
-                [InlineKeyboardButton("🔗 Get Referral Link", callback_data='referral_link')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+                    limited_logger.warning(f"Could not delete previous message: {str(e)}", key='delete')
             
+            # Static text and menu are pre-rendered; only the referral link is filled in
             await self.send_message_with_retry(
-                welcome_message,
+                self.templates.main_welcome(user_id),
                 chat_id,
                 parse_mode='Markdown',
-                reply_markup=reply_markup
+                reply_markup=self.templates.main_menu
             )
             
         except Exception as e:
-            logger.error(f"Error in show_main_welcome: {str(e)}")
+            logger.error(f"Error in send_main_welcome: {str(e)}")
             await self.send_message_with_retry(
                 "Sorry, there was an error displaying the welcome message. Please try again later.",
                 chat_id
             )
 
+    async def get_completed_tasks(self, user_id: int) -> int:
+        """Return the bitset of task ids the user has completed, cached per user
+
+        Recurring tasks count only when completed in their current period;
+        the cached bitset is read again once that period is over.
+        """
+        completed = self.completions.get(user_id)
+        if completed is None:
+            self.completions.begin_load(user_id)
+            try:
+                completed, expires = self.task_catalog.completed_bits(await self.storage.get_completions(user_id))
+                completed = self.completions.finish_load(user_id, completed, expires)
+            finally:
+                # Don't leave the user tracked if the read failed
+                self.completions.end_load(user_id)
+        return completed
+
+    def answer_shed(self, update: object) -> None:
+        """Answer a button tap the throttle dropped, so the client stops its spinner
+
+        Sent as bulk traffic behind every reply, and skipped when the bulk
+        queue is full; the client then gives up on its own after a while.
+        """
+        if isinstance(update, Update) and update.callback_query:
+            query = update.callback_query
+            self.dispatcher.post('answer_callback_query', {'callback_query_id': query.id},
+                                 chat_id=query.from_user.id)
+
+    def count_completions(self, recorded: List[tuple]) -> None:
+        """Add completions the batcher recorded to the /stats counters"""
+        for _, task_id, doge_reward, referrer_id, _ in recorded:
+            self.counters.incr(stats.TASK_COMPLETIONS, task_id)
+            self.counters.incr(stats.POINTS_ISSUED, amount=doge_reward + (doge_reward // 2 if referrer_id else 0))
+
+    async def reload_tasks(self) -> None:
+        """Refresh the in-memory task catalog from the database"""
+        # Serialised so an older read can never replace a newer catalog
+        async with self.task_reload_lock:
+            self.task_catalog.load(await self.storage.get_tasks())
+            self.completions.fit_task_ids(self.task_catalog.max_task_id)
+
+    async def tasks_changed(self) -> None:
+        """Reload the task catalog after an admin change and tell other workers"""
+        await self.reload_tasks()
+        if self.on_tasks_changed:
+            self.on_tasks_changed()
+
+    def owns(self, user_id: int) -> bool:
+        """Whether this worker handles the user's updates"""
+        index, count = self.worker
+        return shard_for(user_id, count) == index
+
     async def show_tasks(self, update: Update, context: CallbackContext) -> None:
         """Handle the /tasks command"""
         try:
             user_id = update.callback_query.from_user.id
             
-            with DatabaseConnection() as conn:
-                c = conn.cursor()
-                c.execute('''SELECT * FROM tasks WHERE task_id NOT IN 
-                           (SELECT task_id FROM completed_tasks WHERE user_id = ?)''', 
-                         (user_id,))
-                tasks = c.fetchall()
+            completed = await self.get_completed_tasks(user_id)
             
-            if not tasks:
-                await self.send_message_with_retry(
+            # Hide completions that are queued but not yet written
+            for task_id in self.batcher.pending_tasks(user_id):
+                completed |= 1 << task_id
+            
+            reply_markup = self.task_catalog.markup_for(completed)
+            self.counters.incr(stats.TASK_VIEWS)
+            for task_id in self.task_catalog.task_ids_left(completed):
+                self.counters.incr(stats.TASK_SHOWN, task_id)
+            if reply_markup is None:
+                await self.show_view(
+                    update.callback_query,
                     "No tasks available at the moment. Check back later!",
-                    update.callback_query.message.chat_id
+                    parse_mode=None
                 )
                 return
             
-            keyboard = []
-            for task in tasks:
-                task_id, task_name, task_description, doge_reward = task
-                button_text = f"{task_name} - {doge_reward} Doge Points"
-                keyboard.append([InlineKeyboardButton(button_text, 
-                                                    callback_data=f'task_{task_id}')])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await self.send_message_with_retry(
-                "📜 *Available Tasks:*",
-                update.callback_query.message.chat_id,
-                parse_mode='Markdown',
-                reply_markup=reply_markup
-            )
+            await self.show_view(update.callback_query, "📜 *Available Tasks:*", reply_markup)
             
         except Exception as e:
             logger.error(f"Error in show_tasks: {str(e)}")
@@ -285,65 +419,135 @@ class DogeBot:
         """Handle task completion callback queries"""
         try:
             query = update.callback_query
+            
+            # The same callback delivered again has already been answered
+            if not self.recent_callbacks.add(query.id):
+                DUPLICATES_SUPPRESSED.labels('callback').inc()
+                return
             await query.answer()
             
             user_id = query.from_user.id
             task_id = int(query.data.split('_')[1])
+            self.counters.incr(stats.TASK_TAPS, task_id)
             
-            with DatabaseConnection() as conn:
-                c = conn.cursor()
-                
-                # Mark task as completed
-                c.execute('INSERT INTO completed_tasks (user_id, task_id) VALUES (?, ?)',
-                         (user_id, task_id))
-                
-                # Get task reward
-                c.execute('SELECT doge_reward FROM tasks WHERE task_id = ?', (task_id,))
-                doge_reward = c.fetchone()[0]
-                
-                # Update user points
-                c.execute('UPDATE users SET doge_points = doge_points + ? WHERE user_id = ?',
-                         (doge_reward, user_id))
-                
-                # Reward referrer if applicable
-                c.execute('SELECT referred_by FROM users WHERE user_id = ?', (user_id,))
-                referrer_id = c.fetchone()[0]
-                if referrer_id:
-                    c.execute('''UPDATE users SET doge_points = doge_points + ? 
-                               WHERE user_id = ?''', (doge_reward // 2, referrer_id))
-            
-            await query.edit_message_text(
-                f"🎉 *Task completed!* You earned {doge_reward} Doge Points! 🐕",
-                parse_mode='Markdown'
-            )
+            # Double taps are answered from memory before touching the database
+            period = self.task_catalog.period_of(task_id)
+            if (user_id, task_id, period) in self.recent_completions or self.completions.has(user_id, task_id):
+                DUPLICATES_SUPPRESSED.labels('memory').inc()
+                await self.edit_view(query, task_schedule.ALREADY_COMPLETED[self.task_catalog.schedule_of(task_id)],
+                                     parse_mode=None)
+                return
+            
+            info = await self.storage.get_completion_info(user_id, task_id)
+            now = time.time()
+            if info is None or not task_schedule.is_open(info.starts_at, info.ends_at, now):
+                # Removed, or out of its time window, since the task list was shown
+                await self.edit_view(query, "This task is no longer available.", parse_mode=None)
+                return
+            doge_reward, referrer_id = info.doge_reward, info.referrer_id
+            
+            # A recurring task is due again once the current period is later
+            # than the last one it was completed in
+            period = task_schedule.period_of(info.schedule, now)
+            already_completed = info.period is not None and info.period >= period
+            
+            # Queue the completion; points for the user and their referrer are
+            # written with the next batch
+            if already_completed or not self.batcher.submit(
+                    CompletionEvent(user_id, task_id, doge_reward, referrer_id, period)):
+                DUPLICATES_SUPPRESSED.labels('database' if already_completed else 'queued').inc()
+                self.recent_completions.add((user_id, task_id, period))
+                await self.edit_view(query, task_schedule.ALREADY_COMPLETED[info.schedule], parse_mode=None)
+                return
+            
+            self.recent_completions.add((user_id, task_id, period))
+            self.completions.mark(user_id, task_id, task_schedule.period_end(info.schedule, period))
+            self.leaderboard.add_points(user_id, doge_reward)
+            if referrer_id:
+                self.leaderboard.add_points(referrer_id, doge_reward // 2)
+            
+            message = f"🎉 *Task completed!* You earned {doge_reward} Doge Points! 🐕"
+            if info.schedule in task_schedule.STREAK_UNITS:
+                streak = task_schedule.next_streak(info.period, info.streak, period)
+                message += f"\n🔥 {streak}-{task_schedule.STREAK_UNITS[info.schedule]} streak"
+            await self.edit_view(query, message)
             
         except Exception as e:
             logger.error(f"Error in handle_task_completion: {str(e)}")
-            await query.edit_message_text(
+            await self.edit_message_with_retry(
+                query,
                 "Sorry, there was an error completing the task. Please try again."
             )
 
+    def build_leaderboard_page(self, page: int) -> tuple:
+        """Build the message and navigation buttons for a leaderboard page"""
+        total = len(self.leaderboard)
+        last_page = max((total - 1) // LEADERBOARD_PAGE_SIZE, 0)
+        page = min(max(page, 0), last_page)
+        entries = self.leaderboard.top(LEADERBOARD_PAGE_SIZE, page * LEADERBOARD_PAGE_SIZE)
+        
+        if page == 0:
+            leaderboard_message = "🏆 *Top 10 Doge Adventurers* 🏆\n\n"
+        else:
+            leaderboard_message = (f"🏆 *Doge Adventurers {page * LEADERBOARD_PAGE_SIZE + 1}-"
+                                   f"{page * LEADERBOARD_PAGE_SIZE + len(entries)}* 🏆\n\n")
+        leaderboard_message += "".join(f"{rank}. {display_name(username)}: {doge_points} Doge Points\n"
+                                       for rank, _, username, doge_points in entries)
+        
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("⬅️ Previous", callback_data=f'leaderboard_page_{page - 1}'))
+        if page < last_page:
+            navigation.append(InlineKeyboardButton("Next ➡️", callback_data=f'leaderboard_page_{page + 1}'))
+        keyboard = [navigation] if navigation else []
+        keyboard.append([InlineKeyboardButton("📍 My Rank", callback_data='leaderboard_me')])
+        return leaderboard_message, InlineKeyboardMarkup(keyboard)
+    
+    def build_rank_view(self, user_id: int) -> tuple:
+        """Build the message showing a user's rank and their neighbours"""
+        rank = self.leaderboard.rank(user_id)
+        if not rank:
+            message = "You are not on the leaderboard yet. Send /start to join Doge World!"
+            page = 0
+        else:
+            message = (f"📍 *Your Rank:* #{rank} of {len(self.leaderboard)} "
+                       f"with {self.leaderboard.points(user_id)} Doge Points\n\n")
+            for entry_rank, entry_user_id, username, doge_points in self.leaderboard.around(user_id):
+                marker = "👉 " if entry_user_id == user_id else ""
+                message += f"{marker}{entry_rank}. {display_name(username)}: {doge_points} Doge Points\n"
+            page = (rank - 1) // LEADERBOARD_PAGE_SIZE
+        keyboard = [[InlineKeyboardButton("🏆 Show on Leaderboard", callback_data=f'leaderboard_page_{page}')]]
+        return message, InlineKeyboardMarkup(keyboard)
+
     async def show_leaderboard(self, update: Update, context: CallbackContext) -> None:
         """Handle the /leaderboard command"""
         try:
-            with DatabaseConnection() as conn:
-                c = conn.cursor()
-                c.execute('''SELECT username, doge_points FROM users 
-                           ORDER BY doge_points DESC LIMIT 10''')
-                top_users = c.fetchall()
+            leaderboard_message, reply_markup = self.build_leaderboard_page(0)
             
-            leaderboard_message = "🏆 *Top 10 Doge Adventurers* 🏆\n\n"
-            for i, (username, doge_points) in enumerate(top_users, start=1):
-                leaderboard_message += f"{i}. {username}: {doge_points} Doge Points\n"
+            await self.show_view(update.callback_query, leaderboard_message, reply_markup)
             
+        except Exception as e:
+            logger.error(f"Error in show_leaderboard: {str(e)}")
             await self.send_message_with_retry(
-                leaderboard_message,
-                update.callback_query.message.chat_id,
-                parse_mode='Markdown'
+                "Sorry, there was an error fetching the leaderboard. Please try again later.",
+                update.callback_query.message.chat_id
             )
+
+    async def handle_leaderboard_navigation(self, update: Update, context: CallbackContext) -> None:
+        """Handle leaderboard page and "my rank" buttons by editing the message in place"""
+        try:
+            query = update.callback_query
+            await query.answer()
+            
+            if query.data == 'leaderboard_me':
+                message, reply_markup = self.build_rank_view(query.from_user.id)
+            else:
+                message, reply_markup = self.build_leaderboard_page(int(query.data.rsplit('_', 1)[1]))
+            
+            await self.edit_view(query, message, reply_markup)
             
         except Exception as e:
-            logger.error(f"Error in show_leaderboard: {str(e)}")
+            logger.error(f"Error in handle_leaderboard_navigation: {str(e)}")
             await self.send_message_with_retry(
                 "Sorry, there was an error fetching the leaderboard. Please try again later.",
                 update.callback_query.message.chat_id
@@ -354,25 +558,23 @@ class DogeBot:
         try:
             user_id = update.callback_query.from_user.id
             
-            with DatabaseConnection() as conn:
-                c = conn.cursor()
-                c.execute('SELECT referred_by FROM users WHERE user_id = ?', (user_id,))
-                referrer_id = c.fetchone()[0]
+            summary = await self.storage.get_referral_summary(user_id)
+            
+            if summary and summary['referrer']:
+                referrer_id, referrer_username = summary['referrer']
+                message = f"👤 *You were invited by:* {mention(referrer_username)}\n"
+            else:
+                message = "You were not referred by anyone.\n"
+            
+            if summary and summary['invitees']:
+                message += (f"\n👥 *Your invitees:* {summary['invitees']}\n"
+                            f"💰 *Their Doge Points:* {summary['invitee_points']}\n"
+                            f"🎁 *Your referral bonus:* {summary['bonus_earned']}\n")
+                for depth, count in summary['levels'].items():
+                    message += f"🔗 *Level {depth} invitees:* {count}\n"
+            
+            await self.show_view(update.callback_query, message)
                 
-                if referrer_id:
-                    c.execute('SELECT username FROM users WHERE user_id = ?', (referrer_id,))
-                    referrer_username = c.fetchone()[0]
-                    await self.send_message_with_retry(
-                        f"👤 *You were invited by:* @{referrer_username}",
-                        update.callback_query.message.chat_id,
-                        parse_mode='Markdown'
-                    )
-                else:
-                    await self.send_message_with_retry(
-                        "You were not referred by anyone.",
-                        update.callback_query.message.chat_id
-                    )
-                    
         except Exception as e:
             logger.error(f"Error in show_referral_info: {str(e)}")
             await self.send_message_with_retry(
@@ -380,39 +582,57 @@ class DogeBot:
                 update.callback_query.message.chat_id
             )
 
+    async def build_referrals_page(self, user_id: int, after: Optional[int] = None,
+                                   before: Optional[int] = None) -> tuple:
+        """Build one keyset page of a user's invitees and its navigation buttons"""
+        page = await self.storage.get_invitees_page(user_id, after=after, before=before,
+                                                    limit=REFERRALS_PAGE_SIZE)
+        if not page['invitees']:
+            return "You haven't referred anyone yet.", None
+        
+        message = f"👥 *Users You Have Referred:* {page['total']}\n\n" + "".join(
+            f"• {mention(username)}: {doge_points} Doge Points\n" for _, username, doge_points in page['invitees'])
+        
+        navigation = []
+        if page['has_prev']:
+            navigation.append(InlineKeyboardButton(
+                "⬅️ Previous", callback_data=f"my_referrals_before_{page['invitees'][0][0]}"))
+        if page['has_next']:
+            navigation.append(InlineKeyboardButton(
+                "Next ➡️", callback_data=f"my_referrals_after_{page['invitees'][-1][0]}"))
+        return message, InlineKeyboardMarkup([navigation]) if navigation else None
+
     async def show_referred_users(self, update: Update, context: CallbackContext) -> None:
-        """Show all users referred by the current user"""
+        """Show the first page of users referred by the current user"""
         try:
             user_id = update.callback_query.from_user.id
-            logger.info(f"Fetching referred users for user_id: {user_id}")
-            
-            with DatabaseConnection() as conn:
-                c = conn.cursor()
-                # Fetch all users referred by the current user
-                c.execute('SELECT username, doge_points FROM users WHERE referred_by = ?', (user_id,))
-                referred_users = c.fetchall()
-                logger.info(f"Referred users: {referred_users}")
-            
-            if not referred_users:
-                await self.send_message_with_retry(
-                    "You haven't referred anyone yet.",
-                    update.callback_query.message.chat_id
-                )
-                return
+            message, reply_markup = await self.build_referrals_page(user_id)
             
-            # Build the message
-            message = "👥 *Users You Have Referred:*\n\n"
-            for i, (username, doge_points) in enumerate(referred_users, start=1):
-                message += f"{i}. @{username}: {doge_points} Doge Points\n"
+            await self.show_view(update.callback_query, message, reply_markup)
             
+        except Exception as e:
+            logger.error(f"Error in show_referred_users: {str(e)}")
             await self.send_message_with_retry(
-                message,
-                update.callback_query.message.chat_id,
-                parse_mode='Markdown'
+                "Sorry, there was an error fetching your referred users. Please try again later.",
+                update.callback_query.message.chat_id
             )
+
+    async def handle_referral_navigation(self, update: Update, context: CallbackContext) -> None:
+        """Handle invitee page buttons by editing the message in place"""
+        try:
+            query = update.callback_query
+            await query.answer()
+            
+            _, _, direction, cursor = query.data.split('_')
+            if direction == 'after':
+                message, reply_markup = await self.build_referrals_page(query.from_user.id, after=int(cursor))
+            else:
+                message, reply_markup = await self.build_referrals_page(query.from_user.id, before=int(cursor))
+            
+            await self.edit_view(query, message, reply_markup)
             
         except Exception as e:
-            logger.error(f"Error in show_referred_users: {str(e)}")
+            logger.error(f"Error in handle_referral_navigation: {str(e)}")
             await self.send_message_with_retry(
                 "Sorry, there was an error fetching your referred users. Please try again later.",
                 update.callback_query.message.chat_id
@@ -422,15 +642,9 @@ class DogeBot:
         """Handle the referral link button"""
         try:
             user_id = update.callback_query.from_user.id
-            referral_link = f"https://t.me/{BOT_USERNAME}?start={user_id}"
             
-            await update.callback_query.answer()
-            await self.send_message_with_retry(
-                f"🔗 *Your Referral Link:* `{referral_link}`\n\n"
-                "Share this link with friends to earn bonus points!",
-                update.callback_query.message.chat_id,
-                parse_mode='Markdown'
-            )
+            # The query was already answered by handle_main_menu
+            await self.show_view(update.callback_query, self.templates.referral_link_message(user_id))
             
         except Exception as e:
             logger.error(f"Error in get_referral_link: {str(e)}")
@@ -455,6 +669,9 @@ class DogeBot:
                 await self.show_referred_users(update, context)
             elif query.data == 'referral_link':
                 await self.get_referral_link(update, context)
+            elif query.data == 'main_menu':
+                await self.edit_view(query, self.templates.main_welcome(query.from_user.id),
+                                     self.templates.main_menu, back=False)
                 
         except Exception as e:
             logger.error(f"Error in handle_main_menu: {str(e)}")
@@ -466,7 +683,6 @@ class DogeBot:
     async def add_task(self, update: Update, context: CallbackContext) -> None:
         """Handle the /addtask command (admin only)"""
         try:
-            YOUR_ADMIN_USER_ID = 1878591152  # Replace with your actual admin user ID
             user_id = update.message.from_user.id
             
             # Check if the user is authorized
@@ -490,11 +706,20 @@ class DogeBot:
                 )
                 return
             
+            # Schedule options come after the reward
+            try:
+                args, schedule, starts_at, ends_at = task_schedule.split_options(args)
+            except ValueError as e:
+                await self.send_message_with_retry(f"Invalid schedule: {e}", update.message.chat_id)
+                return
+            
             # Check if the command has the correct number of arguments
             if len(args) < 3:
                 await self.send_message_with_retry(
-                    "Usage: /addtask <name> <description> <doge_reward>\n"
-                    "Example: /addtask \"Begin Again\" \"Follow our Instagram account to earn points\" 50",
+                    "Usage: /addtask <name> <description> <doge_reward> [daily|weekly] "
+                    "[from=<UTC date>] [until=<UTC date>]\n"
+                    "Example: /addtask \"Begin Again\" \"Follow our Instagram account to earn points\" 50\n"
+                    "Example: /addtask \"Spin\" \"Spin the wheel every day\" 10 daily until=2025-12-31",
                     update.message.chat_id
                 )
                 return
@@ -512,25 +737,317 @@ class DogeBot:
                 return
             
             # Insert the task into the database
-            with DatabaseConnection() as conn:
-                c = conn.cursor()
-                c.execute('''INSERT INTO tasks (task_name, task_description, doge_reward) 
-                        VALUES (?, ?, ?)''', (task_name, task_description, doge_reward))
+            await self.storage.add_task(task_name, task_description, doge_reward, schedule, starts_at, ends_at)
+            await self.tasks_changed()
             
             # Send confirmation message
+            message = (f"✅ *Task added successfully!*\n"
+                       f"Name: {escape_markdown(task_name)}\n"
+                       f"Description: {escape_markdown(task_description)}\n"
+                       f"Reward: {doge_reward} Doge Points\n"
+                       f"Repeats: {schedule}")
+            if starts_at is not None:
+                message += f"\nFrom: {task_schedule.format_time(starts_at)} UTC"
+            if ends_at is not None:
+                message += f"\nUntil: {task_schedule.format_time(ends_at)} UTC"
+            await self.send_message_with_retry(message, update.message.chat_id, parse_mode='Markdown')
+            
+        except Exception as e:
+            logger.error(f"Error in add_task: {str(e)}")
             await self.send_message_with_retry(
-                f"✅ *Task added successfully!*\n"
-                f"Name: {task_name}\n"
-                f"Description: {task_description}\n"
-                f"Reward: {doge_reward} Doge Points",
+                "Sorry, there was an error adding the task. Please try again.",
+                update.message.chat_id
+            )
+
+    async def import_tasks(self, update: Update, context: CallbackContext) -> None:
+        """Handle /importtasks sent with (or as a reply to) a CSV or JSON document (admin only)"""
+        try:
+            user_id = update.message.from_user.id
+            
+            # Check if the user is authorized
+            if user_id != YOUR_ADMIN_USER_ID:
+                await self.send_message_with_retry(
+                    "You are not authorized to use this command.",
+                    update.message.chat_id
+                )
+                return
+            
+            document = update.message.document
+            if document is None and update.message.reply_to_message:
+                document = update.message.reply_to_message.document
+            if document is None:
+                await self.send_message_with_retry(
+                    "Usage: send a CSV or JSON file with the caption /importtasks, "
+                    "or reply /importtasks to one.\n"
+                    "CSV columns: task_name, task_description, doge_reward",
+                    update.message.chat_id
+                )
+                return
+            if document.file_size and document.file_size > TASK_IMPORT_MAX_BYTES:
+                await self.send_message_with_retry(
+                    f"The file is too large. Please keep it under {TASK_IMPORT_MAX_BYTES // 1024} KB.",
+                    update.message.chat_id
+                )
+                return
+            
+            file = await context.bot.get_file(document.file_id)
+            data = bytes(await file.download_as_bytearray())
+            try:
+                records = parse_task_document(data, document.file_name or '')
+            except ValueError as e:
+                await self.send_message_with_retry(f"Could not read the file: {e}", update.message.chat_id)
+                return
+            
+            # Validate every row, then insert all valid rows in one transaction
+            existing_names = {task_name for _, task_name, *_ in await self.storage.get_tasks()}
+            rows, errors = validate_tasks(records, existing_names)
+            task_ids = await self.storage.import_tasks(rows) if rows else []
+            if task_ids:
+                await self.tasks_changed()
+            
+            message = f"✅ Imported {len(task_ids)} task(s)"
+            if len(task_ids) == 1:
+                message += f" (id {task_ids[0]})"
+            elif task_ids:
+                message += f" (ids {task_ids[0]}–{task_ids[-1]})"
+            if errors:
+                message += f"\n⚠️ Skipped {len(errors)} row(s):\n"
+                message += "\n".join(f"Row {row}: {error}" for row, error in errors[:IMPORT_ERRORS_SHOWN])
+                if len(errors) > IMPORT_ERRORS_SHOWN:
+                    message += f"\n...and {len(errors) - IMPORT_ERRORS_SHOWN} more"
+            await self.send_message_with_retry(message, update.message.chat_id)
+            
+        except Exception as e:
+            logger.error(f"Error in import_tasks: {str(e)}")
+            await self.send_message_with_retry(
+                "Sorry, there was an error importing the tasks. Please try again.",
+                update.message.chat_id
+            )
+
+    async def export_tasks(self, update: Update, context: CallbackContext) -> None:
+        """Handle the /exporttasks [csv|json] command (admin only)"""
+        try:
+            user_id = update.message.from_user.id
+            
+            # Check if the user is authorized
+            if user_id != YOUR_ADMIN_USER_ID:
+                await self.send_message_with_retry(
+                    "You are not authorized to use this command.",
+                    update.message.chat_id
+                )
+                return
+            
+            fmt = context.args[0].lower() if context.args else 'csv'
+            if fmt not in ('csv', 'json'):
+                await self.send_message_with_retry("Usage: /exporttasks [csv|json]", update.message.chat_id)
+                return
+            
+            tasks = await self.storage.get_tasks()
+            await self.dispatcher.send_document(
+                update.message.chat_id,
+                InputFile(tasks_document(tasks, fmt), filename=f'tasks.{fmt}'),
+                caption=f"{len(tasks)} task(s)"
+            )
+            
+        except Exception as e:
+            logger.error(f"Error in export_tasks: {str(e)}")
+            await self.send_message_with_retry(
+                "Sorry, there was an error exporting the tasks. Please try again.",
+                update.message.chat_id
+            )
+
+    async def export_users(self, update: Update, context: CallbackContext) -> None:
+        """Handle the /exportusers command (admin only): every user as a gzipped CSV"""
+        path = None
+        try:
+            user_id = update.message.from_user.id
+            
+            # Check if the user is authorized
+            if user_id != YOUR_ADMIN_USER_ID:
+                await self.send_message_with_retry(
+                    "You are not authorized to use this command.",
+                    update.message.chat_id
+                )
+                return
+            
+            # Written page by page to a temporary file, never held in memory at once
+            fd, path = tempfile.mkstemp(prefix='doge_users_', suffix='.csv.gz')
+            os.close(fd)
+            count = await export_users(self.storage, path)
+            with open(path, 'rb') as file:
+                await self.dispatcher.send_document(
+                    update.message.chat_id,
+                    InputFile(file, filename='users.csv.gz'),
+                    caption=f"{count} user(s)"
+                )
+            
+        except Exception as e:
+            logger.error(f"Error in export_users: {str(e)}")
+            await self.send_message_with_retry(
+                "Sorry, there was an error exporting the users. Please try again.",
+                update.message.chat_id
+            )
+        finally:
+            if path:
+                os.remove(path)
+
+    async def remove_task(self, update: Update, context: CallbackContext) -> None:
+        """Handle the /removetask <task_id> command (admin only)"""
+        try:
+            user_id = update.message.from_user.id
+            
+            # Check if the user is authorized
+            if user_id != YOUR_ADMIN_USER_ID:
+                await self.send_message_with_retry(
+                    "You are not authorized to use this command.",
+                    update.message.chat_id
+                )
+                return
+            
+            if len(context.args or ()) != 1 or not context.args[0].isdigit():
+                await self.send_message_with_retry(
+                    "Usage: /removetask <task_id>\n"
+                    "Use /exporttasks to list task ids.",
+                    update.message.chat_id
+                )
+                return
+            
+            removed = await self.storage.remove_task(int(context.args[0]))
+            if removed is None:
+                await self.send_message_with_retry(f"There is no task {context.args[0]}.", update.message.chat_id)
+                return
+            await self.tasks_changed()
+            
+            task_id, task_name, _, doge_reward = removed
+            await self.send_message_with_retry(
+                f"🗑 Removed task {task_id}: {task_name} ({doge_reward} Doge Points)",
+                update.message.chat_id
+            )
+            
+        except Exception as e:
+            logger.error(f"Error in remove_task: {str(e)}")
+            await self.send_message_with_retry(
+                "Sorry, there was an error removing the task. Please try again.",
+                update.message.chat_id
+            )
+
+    async def broadcast(self, update: Update, context: CallbackContext) -> None:
+        """Handle the /broadcast command (admin only)"""
+        try:
+            user_id = update.message.from_user.id
+            
+            # Check if the user is authorized
+            if user_id != YOUR_ADMIN_USER_ID:
+                await self.send_message_with_retry(
+                    "You are not authorized to use this command.",
+                    update.message.chat_id
+                )
+                return
+            
+            # Everything after the command is sent verbatim, line breaks included
+            parts = update.message.text.split(None, 1)
+            if len(parts) < 2 or not parts[1].strip():
+                await self.send_message_with_retry(
+                    "Usage: /broadcast <message>\n"
+                    "Example: /broadcast New task available! Open the bot to earn 50 Doge Points",
+                    update.message.chat_id
+                )
+                return
+            
+            broadcast_id = await self.broadcaster.start(parts[1], update.message.chat_id)
+            await self.send_message_with_retry(
+                f"📣 Broadcast #{broadcast_id} started. Progress updates will follow here.\n"
+                f"Use /cancelbroadcast {broadcast_id} to stop it.",
+                update.message.chat_id
+            )
+            
+        except Exception as e:
+            logger.error(f"Error in broadcast: {str(e)}")
+            await self.send_message_with_retry(
+                "Sorry, there was an error starting the broadcast. Please try again.",
+                update.message.chat_id
+            )
+
+    async def cancel_broadcast(self, update: Update, context: CallbackContext) -> None:
+        """Handle the /cancelbroadcast command (admin only)"""
+        try:
+            user_id = update.message.from_user.id
+            
+            # Check if the user is authorized
+            if user_id != YOUR_ADMIN_USER_ID:
+                await self.send_message_with_retry(
+                    "You are not authorized to use this command.",
+                    update.message.chat_id
+                )
+                return
+            
+            broadcast_ids = [int(arg) for arg in context.args] if context.args else self.broadcaster.running()
+            cancelled = [broadcast_id for broadcast_id in broadcast_ids
+                         if await self.broadcaster.cancel(broadcast_id)]
+            
+            if cancelled:
+                message = "🛑 Cancelled broadcast " + ", ".join(f"#{broadcast_id}" for broadcast_id in cancelled)
+            else:
+                message = "No running broadcast to cancel."
+            await self.send_message_with_retry(message, update.message.chat_id)
+            
+        except Exception as e:
+            logger.error(f"Error in cancel_broadcast: {str(e)}")
+            await self.send_message_with_retry(
+                "Sorry, there was an error cancelling the broadcast. Please try again.",
+                update.message.chat_id
+            )
+
+    async def perf(self, update: Update, context: CallbackContext) -> None:
+        """Handle the /perf command (admin only): latency percentiles since startup"""
+        try:
+            user_id = update.message.from_user.id
+            
+            # Check if the user is authorized
+            if user_id != YOUR_ADMIN_USER_ID:
+                await self.send_message_with_retry(
+                    "You are not authorized to use this command.",
+                    update.message.chat_id
+                )
+                return
+            
+            report = metrics.REGISTRY.report()
+            await self.send_message_with_retry(
+                f"📈 *Performance since startup*\n```\n{report[:3900]}\n```",
                 update.message.chat_id,
                 parse_mode='Markdown'
             )
             
         except Exception as e:
-            logger.error(f"Error in add_task: {str(e)}")
+            logger.error(f"Error in perf: {str(e)}")
             await self.send_message_with_retry(
-                "Sorry, there was an error adding the task. Please try again.",
+                "Sorry, there was an error collecting performance data. Please try again.",
+                update.message.chat_id
+            )
+
+    async def stats(self, update: Update, context: CallbackContext) -> None:
+        """Handle the /stats command (admin only): users, onboarding, points and task funnels"""
+        try:
+            user_id = update.message.from_user.id
+            
+            # Check if the user is authorized
+            if user_id != YOUR_ADMIN_USER_ID:
+                await self.send_message_with_retry(
+                    "You are not authorized to use this command.",
+                    update.message.chat_id
+                )
+                return
+            
+            # Served from the counters, never from scans of users or completions
+            report = await self.counters.report()
+            task_names = {task_id: self.task_catalog.get(task_id)[1] for task_id in report.task_ids()
+                          if self.task_catalog.get(task_id) is not None}
+            await self.send_message_with_retry(stats.render(report, task_names)[:4000], update.message.chat_id)
+            
+        except Exception as e:
+            logger.error(f"Error in stats: {str(e)}")
+            await self.send_message_with_retry(
+                "Sorry, there was an error collecting the stats. Please try again.",
                 update.message.chat_id
             )
 
@@ -547,109 +1064,200 @@ class DogeBot:
     async def initialize(self) -> None:
         """Initialize the bot with error handling"""
         try:
-            # Initialize application with custom request parameters
-            self.application = (
+            # Initialize application with custom request parameters; Bot API
+            # calls are timed per method for the metrics
+            request = self.request or HTTPXRequest(connection_pool_size=256, connect_timeout=30.0,
+                                                   read_timeout=30.0, write_timeout=30.0)
+            builder = (
                 Application.builder()
                 .token(self.token)
-                .connect_timeout(30.0)
-                .read_timeout(30.0)
-                .write_timeout(30.0)
-                .build()
+                .request(InstrumentedRequest(request))
+                .concurrent_updates(self.update_processor)
+                .post_init(self.post_init)
+                .post_stop(self.stop_background)
             )
+            if UPDATE_MODE == 'webhook':
+                # Bounded buffer between the webhook listener and the handlers
+                builder = builder.update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)).updater(None)
+            self.application = builder.build()
+            
+            # Optionally record every incoming update (anonymised) for offline replay
+            if TRACE_PATH:
+                self.trace_recorder = TraceRecorder(TRACE_PATH, keep_ids=(YOUR_ADMIN_USER_ID,))
+                self.update_processor.on_arrival = self.trace_recorder.record
+            
+            # Shed floods from single users before they reach any handler
+            # (set self.throttle to None to disable)
+            self.update_processor.guard = self.throttle
+            self.update_processor.on_shed = self.answer_shed
             
             # Add handlers in specific order
-            self.application.add_handler(CommandHandler("start", self.start))
-            self.application.add_handler(CommandHandler("addtask", self.add_task))
+            # (every callback is wrapped to record its latency and errors per route)
+            self.application.add_handler(CommandHandler("start", instrument(self.start)))
+            self.application.add_handler(CommandHandler("addtask", instrument(self.add_task)))
+            self.application.add_handler(CommandHandler("importtasks", instrument(self.import_tasks)))
+            self.application.add_handler(MessageHandler(
+                filters.Document.ALL & filters.CaptionRegex(r'^/importtasks(@\w+)?(\s|$)'),
+                instrument(self.import_tasks)
+            ))
+            self.application.add_handler(CommandHandler("exporttasks", instrument(self.export_tasks)))
+            self.application.add_handler(CommandHandler("exportusers", instrument(self.export_users)))
+            self.application.add_handler(CommandHandler("removetask", instrument(self.remove_task)))
+            self.application.add_handler(CommandHandler("broadcast", instrument(self.broadcast)))
+            self.application.add_handler(CommandHandler("cancelbroadcast", instrument(self.cancel_broadcast)))
+            self.application.add_handler(CommandHandler("perf", instrument(self.perf)))
+            self.application.add_handler(CommandHandler("stats", instrument(self.stats)))
             
             # Add the social tasks completion handler BEFORE the general handlers
             self.application.add_handler(CallbackQueryHandler(
-                self.handle_social_tasks_completion,
+                instrument(self.handle_social_tasks_completion),
                 pattern='^social_tasks_completed$'
             ))
             
             # Add other specific handlers
             self.application.add_handler(CallbackQueryHandler(
-                self.handle_task_completion,
+                instrument(self.handle_task_completion),
                 pattern='^task_'
             ))
             
+            self.application.add_handler(CallbackQueryHandler(
+                instrument(self.handle_leaderboard_navigation),
+                pattern=r'^leaderboard_(page_\d+|me)$'
+            ))
+
+            self.application.add_handler(CallbackQueryHandler(
+                instrument(self.handle_referral_navigation),
+                pattern=r'^my_referrals_(after|before)_\d+$'
+            ))
+
             # Add the general menu handler last
-            self.application.add_handler(CallbackQueryHandler(self.handle_main_menu))
+            self.application.add_handler(CallbackQueryHandler(instrument(self.handle_main_menu)))
             
             # Add error handler
             self.application.add_error_handler(self.error_handler)
             
+            # Cache the task catalog and rank every known user in memory
+            await self.reload_tasks()
+            self.leaderboard.load(await self.storage.get_scores())
+            logger.info(f"Loaded {len(self.leaderboard)} users into the leaderboard")
+            
+            # Start group-committing task completions and flushing stats counts
+            self.batcher.start()
+            self.counters.start()
+            
             return self.application
             
         except Exception as e:
             logger.error(f"Error initializing bot: {str(e)}")
             raise
 
+    async def post_init(self, application: Application) -> None:
+        """Start background senders once the bot has connected to Telegram"""
+        self.dispatcher.start(application.bot)
+        
+        # Run delayed actions, including ones pending from before a restart
+        await self.scheduler.start()
+        
+        # Expose the metrics to a local Prometheus scraper
+        self.metrics_server = metrics.metrics_server()
+        if self.metrics_server:
+            await self.metrics_server.start()
+        
+        # Pick up broadcasts interrupted by a restart and build indexes added by
+        # new migrations, in the worker that serves the admin if there are several
+        if self.owns(YOUR_ADMIN_USER_ID):
+            await self.broadcaster.resume()
+            self.index_builder = asyncio.create_task(self.build_indexes())
+
+    async def build_indexes(self) -> None:
+        """Apply the online schema migrations in the background"""
+        try:
+            applied = await self.storage.migrate_online()
+            if applied:
+                logger.info(f"Applied online migrations {applied}")
+        except Exception as e:
+            logger.error(f"Error in build_indexes: {str(e)}")
+
     async def run(self) -> None:
         """Run the bot with error handling"""
         try:
             app = await self.initialize()
-            await app.run_polling(
+            if UPDATE_MODE == 'webhook':
+                await run_webhook(app)
+                return
+            app.run_polling(
                 poll_interval=1.0,        # Decrease polling interval
                 timeout=30,               # Increase timeout
-                drop_pending_updates=True # Ignore updates from when bot was offline
+                drop_pending_updates=True,# Ignore updates from when bot was offline
+                close_loop=False          # Keep the loop for shutdown() below
             )
         except Exception as e:
             logger.error(f"Error running bot: {str(e)}")
         finally:
-            if self.application:
+            await self.shutdown()
+
+    async def stop_background(self, application: Optional[Application] = None) -> None:
+        """Write pending completions and counts and let queued replies go out
+
+        Registered as post_stop, so run_polling calls it once updates have
+        stopped but before the bot's connection is shut down; shutdown()
+        calls it for the other modes. Only the first call does anything.
+        """
+        if self.background_stopped:
+            return
+        self.background_stopped = True
+        if self.index_builder and not self.index_builder.done():
+            self.index_builder.cancel()
+        # Each step runs even if an earlier one fails
+        for name, close in (('scheduler', self.scheduler.close),
+                            ('completion batcher', self.batcher.close),
+                            ('stats counters', self.counters.close),
+                            ('broadcaster', self.broadcaster.close),
+                            ('outbound dispatcher', self.dispatcher.close)):
+            try:
+                await close()
+            except Exception as e:
+                logger.error(f"Error closing the {name}: {str(e)}")
+
+    async def shutdown(self) -> None:
+        """Stop background work and the application"""
+        # Stop taking updates first, so no handler is left waiting on a
+        # reply once the dispatcher has closed
+        if self.application and self.application.running:
+            try:
+                await self.application.stop()
+            except Exception as e:
+                logger.error(f"Error stopping the application: {str(e)}")
+        await self.stop_background()
+        logger.info(f"Update processing: {self.update_processor.stats()}")
+        if self.throttle is not None:
+            logger.info(f"Ingress throttle: {self.throttle.stats()}")
+        logger.info(f"Onboarding cache: {self.onboarding.stats()}")
+        if self.metrics_server:
+            try:
+                await self.metrics_server.close()
+            except Exception as e:
+                logger.error(f"Error closing the metrics server: {str(e)}")
+        if self.trace_recorder:
+            try:
+                self.trace_recorder.close()
+            except Exception as e:
+                logger.error(f"Error closing the update trace: {str(e)}")
+        if self.application:
+            try:
                 await self.application.shutdown()
-                
-def init_db() -> None:
-    """Initialize the database with required tables"""
-    with DatabaseConnection() as conn:
-        c = conn.cursor()
-        
-        # Users table
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            referred_by INTEGER,
-            doge_points INTEGER DEFAULT 0,
-            social_tasks_completed BOOLEAN DEFAULT FALSE
-        )''')
-        
-        # Tasks table
-        c.execute('''CREATE TABLE IF NOT EXISTS tasks (
-            task_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            task_name TEXT,
-            task_description TEXT,
-            doge_reward INTEGER
-        )''')
-        
-        # Completed tasks table
-        c.execute('''CREATE TABLE IF NOT EXISTS completed_tasks (
-            user_id INTEGER,
-            task_id INTEGER,
-            FOREIGN KEY(user_id) REFERENCES users(user_id),
-            FOREIGN KEY(task_id) REFERENCES tasks(task_id),
-            PRIMARY KEY (user_id, task_id)
-        )''')
-        
-        # Create some initial tasks if the tasks table is empty
-        c.execute('SELECT COUNT(*) FROM tasks')
-        if c.fetchone()[0] == 0:
-            initial_tasks = [
-                ('Join Community', 'Join our Telegram community', 100),
-                ('Share Invite', 'Share your referral link with friends', 50),
-                ('Daily Check-in', 'Check in daily to earn points', 25),
-                ('Complete Profile', 'Fill in your profile information', 75)
-            ]
-            c.executemany('INSERT INTO tasks (task_name, task_description, doge_reward) VALUES (?, ?, ?)',
-                         initial_tasks)
+            except Exception as e:
+                logger.error(f"Error shutting down the application: {str(e)}")
 
 async def main() -> None:
     """Main function to run the bot"""
-    # Initialize database
-    init_db()
+    # Open the connection pool and initialize database
+    storage = create_storage()
+    storage.open()
+    await storage.init_db()
     
     # Create and run bot
-    bot = DogeBot(TOKEN)
+    bot = DogeBot(TOKEN, storage)
     
     try:
         await bot.run()
@@ -657,6 +1265,8 @@ async def main() -> None:
         logger.error(f"Fatal error: {str(e)}")
         if bot.application:
             await bot.application.shutdown()
+    finally:
+        await storage.close()
 
 if __name__ == "__main__":
     try:
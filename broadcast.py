@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from telegram.error import Forbidden
+
+from dispatch import OutboundDispatcher, PRIORITY_BULK
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Recipients read (and checkpointed) per keyset page
+BROADCAST_CHUNK_SIZE = int(os.environ.get('DOGE_BROADCAST_CHUNK_SIZE', '200'))
+
+# Sends in flight per broadcast; the dispatcher still enforces the rate limits
+BROADCAST_CONCURRENCY = int(os.environ.get('DOGE_BROADCAST_CONCURRENCY', '30'))
+
+# Seconds between progress updates to the admin
+BROADCAST_REPORT_INTERVAL = 5.0
+
+
+class Broadcaster:
+    """Sends a message to every user, checkpointing progress in SQLite
+
+    Recipients are read in user_id order one keyset page at a time. After each
+    page the cursor and the sent/failed/blocked counts are committed, so a
+    broadcast interrupted by a restart resumes from the last finished page.
+    """
+
+    def __init__(self, storage: Storage, dispatcher: OutboundDispatcher,
+                 chunk_size: int = BROADCAST_CHUNK_SIZE,
+                 concurrency: int = BROADCAST_CONCURRENCY):
+        self.storage = storage
+        self.dispatcher = dispatcher
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def start(self, message: str, admin_chat_id: int) -> int:
+        """Create a broadcast and start sending it; returns its id"""
+        broadcast_id = await self.storage.create_broadcast(message, admin_chat_id)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def resume(self) -> None:
+        """Restart every broadcast that was still running at shutdown"""
+        for broadcast_id in await self.storage.get_running_broadcast_ids():
+            logger.info(f"Resuming broadcast {broadcast_id}")
+            self._spawn(broadcast_id)
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        task = self._tasks.get(broadcast_id)
+        if task is None:
+            return False
+        task.cancel()
+        await self.storage.set_broadcast_status(broadcast_id, 'cancelled')
+        return True
+
+    def running(self) -> List[int]:
+        return list(self._tasks)
+
+    async def close(self) -> None:
+        """Stop sending; running broadcasts resume from their checkpoint on restart"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast_id: int) -> None:
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _send(self, semaphore: asyncio.Semaphore, message: str,
+                    user_id: int) -> Tuple[int, Optional[str]]:
+        async with semaphore:
+            try:
+                await self.dispatcher.send_message(user_id, message, priority=PRIORITY_BULK)
+                return user_id, None
+            except Forbidden:
+                return user_id, 'blocked'
+            except Exception as e:
+                return user_id, str(e)[:200]
+
+    async def _run(self, broadcast_id: int) -> None:
+        try:
+            broadcast = await self.storage.get_broadcast(broadcast_id)
+            message = broadcast['message']
+            cursor = broadcast['last_user_id']
+            processed = broadcast['sent'] + broadcast['failed'] + broadcast['blocked']
+            semaphore = asyncio.Semaphore(self.concurrency)
+            started = time.monotonic()
+            started_processed = processed
+            last_report = 0.0
+
+            while True:
+                user_ids = await self.storage.get_user_ids_after(cursor, self.chunk_size)
+                if not user_ids:
+                    break
+
+                results = await asyncio.gather(*[self._send(semaphore, message, user_id)
+                                                 for user_id in user_ids])
+                failures = [(broadcast_id, user_id, reason) for user_id, reason in results if reason]
+                blocked = sum(1 for _, _, reason in failures if reason == 'blocked')
+                cursor = user_ids[-1]
+                await self.storage.checkpoint_broadcast(
+                    broadcast_id, cursor, len(user_ids) - len(failures),
+                    len(failures) - blocked, blocked, failures)
+
+                processed += len(user_ids)
+                now = time.monotonic()
+                if now - last_report >= BROADCAST_REPORT_INTERVAL:
+                    last_report = now
+                    rate = (processed - started_processed) / max(now - started, 1e-6)
+                    await self._report(broadcast_id, processed, rate)
+
+            await self.storage.set_broadcast_status(broadcast_id, 'completed')
+            elapsed = time.monotonic() - started
+            await self._report(broadcast_id, processed,
+                               (processed - started_processed) / max(elapsed, 1e-6), done=True)
+            logger.info(f"Broadcast {broadcast_id} completed in {elapsed:.1f}s")
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in broadcast {broadcast_id}: {str(e)}")
+
+    async def _report(self, broadcast_id: int, processed: int, rate: float,
+                      done: bool = False) -> None:
+        """Send or update the admin's progress message"""
+        try:
+            broadcast = await self.storage.get_broadcast(broadcast_id)
+            total = max(broadcast['total'], processed)
+            if done:
+                status = f"✅ *Broadcast #{broadcast_id} finished*"
+                eta = ""
+            else:
+                remaining = total - processed
+                eta = f"ETA: {remaining / rate:.0f}s\n" if rate > 0 else ""
+                status = f"📣 *Broadcast #{broadcast_id} in progress*"
+            text = (f"{status}\n\n"
+                    f"Progress: {processed}/{total}\n"
+                    f"Sent: {broadcast['sent']}\n"
+                    f"Failed: {broadcast['failed']}\n"
+                    f"Blocked: {broadcast['blocked']}\n"
+                    f"Throughput: {rate:.1f} msg/s\n"
+                    f"{eta}")
+            chat_id = broadcast['admin_chat_id']
+            if broadcast['progress_message_id']:
+                await self.dispatcher.edit_message_text(chat_id, broadcast['progress_message_id'],
+                                                        text, parse_mode='Markdown')
+            else:
+                sent = await self.dispatcher.send_message(chat_id, text, parse_mode='Markdown')
+                await self.storage.set_broadcast_progress_message(broadcast_id, sent.message_id)
+        except Exception as e:
+            logger.warning(f"Could not report progress of broadcast {broadcast_id}: {str(e)}")
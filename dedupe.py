@@ -0,0 +1,56 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+import metrics
+
+# Seconds a processed callback or completion is remembered
+DEDUPE_TTL = float(os.environ.get('DOGE_DEDUPE_TTL', '60'))
+# Upper bound on remembered keys per set
+DEDUPE_MAX_KEYS = int(os.environ.get('DOGE_DEDUPE_MAX_KEYS', '100000'))
+
+DUPLICATES_SUPPRESSED = metrics.counter('doge_duplicates_suppressed_total',
+                                        'Repeated task completions answered without writing',
+                                        ('stage',))
+
+
+class RecentKeys:
+    """Set of keys seen in the last ttl seconds
+
+    Every key gets the same lifetime, so insertion order is expiry order and
+    expired keys are always dropped from the front. When more than max_keys
+    are live the oldest are dropped early.
+    """
+
+    def __init__(self, ttl: float = DEDUPE_TTL, max_keys: int = DEDUPE_MAX_KEYS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_keys = max(max_keys, 1)
+        self.clock = clock
+        self._expiry: 'OrderedDict[Hashable, float]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._expiry)
+
+    def __contains__(self, key: Hashable) -> bool:
+        expires = self._expiry.get(key)
+        return expires is not None and expires > self.clock()
+
+    def _expire(self, now: float) -> None:
+        while self._expiry:
+            key, expires = next(iter(self._expiry.items()))
+            if expires > now:
+                break
+            del self._expiry[key]
+
+    def add(self, key: Hashable) -> bool:
+        """Remember key; returns False if it was already seen within the ttl"""
+        now = self.clock()
+        self._expire(now)
+        if key in self._expiry:
+            return False
+        self._expiry[key] = now + self.ttl
+        if len(self._expiry) > self.max_keys:
+            self._expiry.popitem(last=False)
+        return True
@@ -0,0 +1,337 @@
+import asyncio
+import itertools
+import logging
+import os
+from typing import Any, Dict, Optional, Set
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+import metrics
+from logs import RateLimitedLog
+
+logger = logging.getLogger(__name__)
+# A 429 storm would otherwise log once per call
+limited_logger = RateLimitedLog(logger)
+
+# Telegram allows ~30 messages per second overall...
+GLOBAL_RATE = float(os.environ.get('DOGE_GLOBAL_RATE', '30'))
+# ...and about one per second per chat, with short bursts tolerated
+CHAT_RATE = float(os.environ.get('DOGE_CHAT_RATE', '1'))
+CHAT_BURST = float(os.environ.get('DOGE_CHAT_BURST', '3'))
+
+# Concurrent Bot API calls in flight
+DISPATCH_WORKERS = int(os.environ.get('DOGE_DISPATCH_WORKERS', '8'))
+
+# Bulk submitters wait once this many bulk calls are queued
+DISPATCH_MAX_BULK = int(os.environ.get('DOGE_DISPATCH_MAX_BULK', '1000'))
+
+# Attempts per call before giving up on 429s and network errors
+DISPATCH_MAX_ATTEMPTS = 4
+
+# Lower values are sent first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+QUEUE_WAIT = metrics.histogram('doge_dispatch_wait_seconds',
+                               'Time Bot API calls wait in the outbound queue', ('priority',))
+QUEUE_DEPTH = metrics.gauge('doge_dispatch_queue_depth',
+                            'Bot API calls waiting to be sent, including those parked on a chat limit')
+BACKPRESSURE = metrics.gauge('doge_dispatch_backpressure',
+                             'Fraction of the bulk queue in use; 1 means bulk submitters are blocked')
+RATE_LIMITED = metrics.counter('doge_dispatch_rate_limited_total',
+                               'Bot API calls answered with 429 Too Many Requests')
+
+
+class TokenBucket:
+    """Reservation-based token bucket
+
+    reserve() always succeeds and returns how long the caller must wait for
+    its token, so callers are served strictly in reservation order.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = 0.0
+
+    def reserve(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def delay(self, now: float) -> float:
+        """Time until a token is available, without taking it"""
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def pause(self, now: float, seconds: float) -> None:
+        """Withhold tokens for the given time (e.g. after a 429)"""
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+        self.updated = now
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class _Call:
+    __slots__ = ('priority', 'seq', 'chat_id', 'method', 'kwargs', 'future',
+                 'enqueued', 'attempts', 'chat_reserved')
+
+    def __init__(self, priority: int, seq: int, chat_id: int, method: str,
+                 kwargs: Dict[str, Any], future: asyncio.Future, enqueued: float):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued = enqueued
+        self.attempts = 0
+        self.chat_reserved = False
+
+
+class OutboundDispatcher:
+    """Rate-limited, prioritised queue for outgoing Bot API calls
+
+    Every send, edit and delete goes through a priority queue and waits for a
+    token from both the global bucket and the target chat's bucket. A chat
+    that is out of tokens parks only its own calls, so other chats keep
+    flowing, and interactive replies are always dequeued ahead of bulk
+    traffic. Bulk submitters block once DISPATCH_MAX_BULK calls are waiting.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, workers: int = DISPATCH_WORKERS,
+                 max_bulk: int = DISPATCH_MAX_BULK):
+        self.bot: Optional[Bot] = None
+        self.workers = workers
+        self.max_bulk = max_bulk
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._bulk_slots = asyncio.Semaphore(max_bulk)
+        self._seq = itertools.count()
+        self._tasks = []
+        # Calls queued by post(), which nobody waits for
+        self._posted: Set[asyncio.Task] = set()
+        self._parked = 0
+        self._bulk_queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.wait_time = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BULK: 0.0}
+        self.wait_count = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        self.max_wait = 0.0
+
+    def start(self, bot: Bot) -> None:
+        self.bot = bot
+        QUEUE_DEPTH.labels().set_function(lambda: self.depth)
+        BACKPRESSURE.labels().set_function(lambda: self.backpressure)
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._sweep_chats()))
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Give queued calls a chance to go out, then stop the workers"""
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Dropping {self.depth} queued Bot API calls on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Posted calls still queued will never be sent now
+        for task in list(self._posted):
+            task.cancel()
+        await asyncio.gather(*self._posted, return_exceptions=True)
+        logger.info(f"Outbound dispatcher closed: {self.stats()}")
+
+    async def _drain(self) -> None:
+        while self.depth:
+            await asyncio.sleep(0.05)
+
+    @property
+    def depth(self) -> int:
+        """Calls waiting to be sent, including those parked on a chat limit"""
+        return self._queue.qsize() + self._parked
+
+    @property
+    def backpressure(self) -> float:
+        """Fraction of the bulk queue in use; 1.0 means bulk submitters are blocked"""
+        return min(self._bulk_queued / self.max_bulk, 1.0)
+
+    def stats(self) -> dict:
+        counts = self.wait_count
+        return {
+            'queue_depth': self.depth,
+            'backpressure': round(self.backpressure, 3),
+            'sent': self.sent,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited,
+            'avg_wait_interactive_ms': self.wait_time[PRIORITY_INTERACTIVE] / (counts[PRIORITY_INTERACTIVE] or 1) * 1000,
+            'avg_wait_bulk_ms': self.wait_time[PRIORITY_BULK] / (counts[PRIORITY_BULK] or 1) * 1000,
+            'max_wait_ms': self.max_wait * 1000,
+        }
+
+    async def submit(self, method: str, params: Dict[str, Any],
+                     priority: int = PRIORITY_INTERACTIVE, chat_id: Optional[int] = None) -> Any:
+        """Queue a Bot method call for chat_id (default params['chat_id']) and wait for its result"""
+        bulk = priority >= PRIORITY_BULK
+        if bulk:
+            await self._bulk_slots.acquire()
+            self._bulk_queued += 1
+        loop = asyncio.get_running_loop()
+        call = _Call(priority, next(self._seq), params['chat_id'] if chat_id is None else chat_id,
+                     method, params, loop.create_future(), loop.time())
+        self._queue.put_nowait((priority, call.seq, call))
+        try:
+            return await call.future
+        finally:
+            if bulk:
+                self._bulk_queued -= 1
+                self._bulk_slots.release()
+
+    def post(self, method: str, params: Dict[str, Any], priority: int = PRIORITY_BULK,
+             chat_id: Optional[int] = None) -> bool:
+        """Queue a call without waiting for it; returns False, queueing nothing, if the bulk queue is full
+
+        Failures are only counted in the dispatcher's stats.
+        """
+        if priority >= PRIORITY_BULK and self._bulk_slots.locked():
+            return False
+        task = asyncio.create_task(self.submit(method, params, priority, chat_id))
+        self._posted.add(task)
+        task.add_done_callback(self._posted_done)
+        return True
+
+    def _posted_done(self, task: asyncio.Task) -> None:
+        self._posted.discard(task)
+        if not task.cancelled():
+            task.exception()
+
+    async def send_message(self, chat_id: int, text: str, parse_mode: Optional[str] = None,
+                           reply_markup=None, priority: int = PRIORITY_INTERACTIVE):
+        return await self.submit('send_message', {'chat_id': chat_id, 'text': text,
+                                                  'parse_mode': parse_mode,
+                                                  'reply_markup': reply_markup}, priority)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str,
+                                parse_mode: Optional[str] = None, reply_markup=None,
+                                priority: int = PRIORITY_INTERACTIVE):
+        return await self.submit('edit_message_text', {'chat_id': chat_id, 'message_id': message_id,
+                                                       'text': text, 'parse_mode': parse_mode,
+                                                       'reply_markup': reply_markup}, priority)
+
+    async def edit_message_reply_markup(self, chat_id: int, message_id: int, reply_markup=None,
+                                        priority: int = PRIORITY_INTERACTIVE):
+        return await self.submit('edit_message_reply_markup', {'chat_id': chat_id, 'message_id': message_id,
+                                                               'reply_markup': reply_markup}, priority)
+
+    async def send_document(self, chat_id: int, document, caption: Optional[str] = None,
+                            priority: int = PRIORITY_INTERACTIVE):
+        return await self.submit('send_document', {'chat_id': chat_id, 'document': document,
+                                                   'caption': caption}, priority)
+
+    async def delete_message(self, chat_id: int, message_id: int,
+                             priority: int = PRIORITY_INTERACTIVE):
+        return await self.submit('delete_message', {'chat_id': chat_id, 'message_id': message_id},
+                                 priority)
+
+    def _requeue(self, call: _Call) -> None:
+        self._parked -= 1
+        self._queue.put_nowait((call.priority, call.seq, call))
+
+    def _park(self, call: _Call, delay: float) -> None:
+        self._parked += 1
+        asyncio.get_running_loop().call_later(delay, self._requeue, call)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, call = await self._queue.get()
+            if call.future.done():
+                continue
+
+            # Park the call until its chat has a token, without holding up other chats
+            if not call.chat_reserved:
+                call.chat_reserved = True
+                delay = self._chat_bucket(call.chat_id).reserve(loop.time())
+                if delay > 0:
+                    self._park(call, delay)
+                    continue
+
+            # Hand the call back while the global bucket is empty so that, once
+            # tokens are available, the highest-priority call goes first
+            delay = self._global.delay(loop.time())
+            if delay > 0:
+                self._queue.put_nowait((call.priority, call.seq, call))
+                await asyncio.sleep(delay)
+                continue
+            self._global.reserve(loop.time())
+
+            if call.attempts == 0:
+                waited = loop.time() - call.enqueued
+                self.wait_time[min(call.priority, PRIORITY_BULK)] += waited
+                self.wait_count[min(call.priority, PRIORITY_BULK)] += 1
+                self.max_wait = max(self.max_wait, waited)
+                QUEUE_WAIT.labels('bulk' if call.priority >= PRIORITY_BULK else 'interactive').observe(waited)
+            call.attempts += 1
+            await self._execute(call)
+
+    async def _execute(self, call: _Call) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            result = await getattr(self.bot, call.method)(**call.kwargs)
+        except RetryAfter as e:
+            self.rate_limited += 1
+            RATE_LIMITED.labels().inc()
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') \
+                else float(e.retry_after)
+            limited_logger.warning(f"Rate limited on chat {call.chat_id}. Waiting {retry_after} seconds",
+                                   key='retry_after')
+            self._chat_bucket(call.chat_id).pause(loop.time(), retry_after)
+            self._global.pause(loop.time(), min(retry_after, 1.0))
+            self._retry(call, e, retry_after)
+        except BadRequest as e:
+            self._fail(call, e)
+        except (TimedOut, NetworkError) as e:
+            self._retry(call, e, 0.5 * 2 ** call.attempts)
+        except Exception as e:
+            self._fail(call, e)
+        else:
+            self.sent += 1
+            if not call.future.done():
+                call.future.set_result(result)
+
+    def _retry(self, call: _Call, error: Exception, delay: float) -> None:
+        if call.attempts >= DISPATCH_MAX_ATTEMPTS:
+            self._fail(call, error)
+            return
+        call.chat_reserved = False
+        self._park(call, delay)
+
+    def _fail(self, call: _Call, error: Exception) -> None:
+        self.failed += 1
+        if not call.future.done():
+            call.future.set_exception(error)
+
+    async def _sweep_chats(self) -> None:
+        """Forget chat buckets that have refilled so the table stays small"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(60)
+            now = loop.time()
+            for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.idle(now)]:
+                del self._chats[chat_id]
@@ -0,0 +1,102 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from telegram.request import BaseRequest, RequestData
+
+# Methods Telegram rate limits per chat; only these are answered with injected 429s
+RATE_LIMITED_METHODS = frozenset({'sendMessage', 'editMessageText', 'sendDocument', 'deleteMessage'})
+
+# Identity returned for getMe
+FAKE_BOT = {'id': 1, 'is_bot': True, 'first_name': 'Doge', 'username': 'doge_adventurer_bot'}
+
+
+class FakeTelegramAPI(BaseRequest):
+    """In-process stand-in for the Telegram Bot API server
+
+    Plugs into Application.builder().request(...) so the real Bot object is
+    used end to end, but every call is answered locally: messages get
+    increasing ids, getUpdates long-polls an in-memory queue fed by
+    push_update() and each call waits `latency` seconds (plus up to `jitter`)
+    to mimic the network. A `rate_limit` fraction of message calls is
+    answered with 429 and `retry_after` like Telegram's flood control.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0,
+                 rate_limit: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+        self._message_ids = itertools.count(1)
+        self._updates: List[Dict[str, Any]] = []
+        self._updates_ready: Optional[asyncio.Event] = None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        """Queue an update for the next getUpdates call"""
+        self._updates.append(update)
+        if self._updates_ready:
+            self._updates_ready.set()
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> tuple:
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.random() * self.jitter)
+        if self.rate_limit and endpoint in RATE_LIMITED_METHODS and random.random() < self.rate_limit:
+            self.rate_limited[endpoint] += 1
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}}).encode()
+        handler = getattr(self, f'_{endpoint}', None)
+        result = await handler(params) if handler else True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    async def _getMe(self, params: dict) -> dict:
+        return FAKE_BOT
+
+    async def _getUpdates(self, params: dict) -> list:
+        if self._updates_ready is None:
+            self._updates_ready = asyncio.Event()
+        offset = int(params.get('offset', 0) or 0)
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates:
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), float(params.get('timeout', 0) or 0))
+            except asyncio.TimeoutError:
+                pass
+        return list(self._updates)
+
+    def _message(self, params: dict) -> dict:
+        return {
+            'message_id': int(params.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            'text': params.get('text', ''),
+        }
+
+    async def _sendMessage(self, params: dict) -> dict:
+        return self._message(params)
+
+    async def _editMessageText(self, params: dict) -> dict:
+        return self._message(params)
+
+    async def _sendDocument(self, params: dict) -> dict:
+        return self._message(params)
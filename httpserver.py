@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Largest request body accepted (Telegram updates are a few KB)
+MAX_BODY_BYTES = 1024 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class Request:
+    __slots__ = ('method', 'path', 'headers', 'body')
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+# (status, content type, body)
+Response = Tuple[int, str, bytes]
+Route = Callable[[Request], Awaitable[Response]]
+
+
+def text_response(status: int, text: str) -> Response:
+    return status, 'text/plain; charset=utf-8', text.encode()
+
+
+class HTTPServer:
+    """Minimal keep-alive HTTP/1.1 server on asyncio streams
+
+    Only what the bot's internal endpoints need: Content-Length bodies and
+    exact-path routing. Routes map a path to a coroutine returning
+    (status, content_type, body).
+    """
+
+    def __init__(self, host: str, port: int, routes: Dict[str, Route]):
+        self.host = host
+        self.port = port
+        self.routes = routes
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        if self.port == 0:
+            self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Listening on http://{self.host}:{self.port}")
+
+    async def close(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = request_line.split(' ', 2)
+                except ValueError:
+                    await self._respond(writer, text_response(400, 'Bad Request'), False)
+                    break
+                headers = {}
+                for line in header_lines:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+
+                length = headers.get('content-length', '') or '0'
+                if not (length.isascii() and length.isdigit()):
+                    await self._respond(writer, text_response(400, 'Bad Request'), False)
+                    break
+                length = int(length)
+                if length > MAX_BODY_BYTES:
+                    await self._respond(writer, text_response(413, 'Payload Too Large'), False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                keep_alive = (headers.get('connection', '').lower() != 'close'
+                              and version == 'HTTP/1.1')
+                request = Request(method, target.split('?', 1)[0], headers, body)
+                route = self.routes.get(request.path)
+                if route is None:
+                    response = text_response(404, 'Not Found')
+                else:
+                    try:
+                        response = await route(request)
+                    except Exception as e:
+                        logger.error(f"Error serving {request.path}: {str(e)}")
+                        response = text_response(500, 'Internal Server Error')
+                await self._respond(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, response: Response, keep_alive: bool) -> None:
+        status, content_type, body = response
+        writer.write((f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                      f"Content-Type: {content_type}\r\n"
+                      f"Content-Length: {len(body)}\r\n"
+                      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode()
+                     + body)
+        await writer.drain()
@@ -0,0 +1,215 @@
+import random
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Enough levels for ~2^32 entries with p = 1/2
+MAX_LEVEL = 32
+
+# Entries shown per leaderboard page
+LEADERBOARD_PAGE_SIZE = 10
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'span')
+
+    def __init__(self, key, level: int):
+        self.key = key
+        self.next: List[Optional['_Node']] = [None] * level
+        self.span: List[int] = [0] * level
+
+
+class RankedSkipList:
+    """Indexable skip list: insert, remove, rank and select in O(log n)
+
+    Every forward pointer also stores how many entries it skips over, so the
+    1-based position of a key is the sum of the spans on its search path.
+    """
+
+    def __init__(self):
+        self._head = _Node(None, MAX_LEVEL)
+        self._level = 1
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    @staticmethod
+    def _random_level() -> int:
+        level = 1
+        while level < MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def build(self, keys: Iterable) -> None:
+        """Replace the contents with already-sorted keys in O(n)"""
+        self._head = _Node(None, MAX_LEVEL)
+        self._level = 1
+        last = [self._head] * MAX_LEVEL
+        last_rank = [0] * MAX_LEVEL
+        length = 0
+        for key in keys:
+            length += 1
+            level = self._random_level()
+            node = _Node(key, level)
+            for i in range(level):
+                last[i].next[i] = node
+                last[i].span[i] = length - last_rank[i]
+                last[i] = node
+                last_rank[i] = length
+            if level > self._level:
+                self._level = level
+        for i in range(self._level):
+            last[i].span[i] = length - last_rank[i]
+        self._length = length
+
+    def insert(self, key) -> None:
+        update = [self._head] * MAX_LEVEL
+        rank = [0] * MAX_LEVEL
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            rank[i] = 0 if i == self._level - 1 else rank[i + 1]
+            while node.next[i] is not None and node.next[i].key < key:
+                rank[i] += node.span[i]
+                node = node.next[i]
+            update[i] = node
+
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                rank[i] = 0
+                update[i] = self._head
+                self._head.span[i] = self._length
+            self._level = level
+
+        new = _Node(key, level)
+        for i in range(level):
+            new.next[i] = update[i].next[i]
+            update[i].next[i] = new
+            new.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = (rank[0] - rank[i]) + 1
+        for i in range(level, self._level):
+            update[i].span[i] += 1
+        self._length += 1
+
+    def remove(self, key) -> bool:
+        update = [self._head] * MAX_LEVEL
+        node = self._head
+        for i in range(self._level - 1, -1, -1):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            update[i] = node
+
+        target = node.next[0]
+        if target is None or target.key != key:
+            return False
+        for i in range(self._level):
+            if update[i].next[i] is target:
+                update[i].span[i] += target.span[i] - 1
+                update[i].next[i] = target.next[i]
+            else:
+                update[i].span[i] -= 1
+        while self._level > 1 and self._head.next[self._level - 1] is None:
+            self._level -= 1
+        self._length -= 1
+        return True
+
+    def rank(self, key) -> int:
+        """1-based position of key, or 0 if absent"""
+        node = self._head
+        rank = 0
+        for i in range(self._level - 1, -1, -1):
+            while node.next[i] is not None and node.next[i].key <= key:
+                rank += node.span[i]
+                node = node.next[i]
+            if node is not self._head and node.key == key:
+                return rank
+        return 0
+
+    def _node_at(self, rank: int) -> Optional[_Node]:
+        node = self._head
+        traversed = 0
+        for i in range(self._level - 1, -1, -1):
+            while node.next[i] is not None and traversed + node.span[i] <= rank:
+                traversed += node.span[i]
+                node = node.next[i]
+            if traversed == rank:
+                return node if node is not self._head else None
+        return None
+
+    def slice(self, start_rank: int, count: int) -> Iterator:
+        """Yield up to count keys starting at the 1-based start_rank"""
+        node = self._node_at(max(start_rank, 1))
+        while node is not None and count > 0:
+            yield node.key
+            node = node.next[0]
+            count -= 1
+
+
+class Leaderboard:
+    """In-memory ranking of users by Doge Points
+
+    Entries are ordered by points (highest first) with ties broken by user id,
+    so top-N, a user's rank and their neighbours are all O(log n).
+    """
+
+    def __init__(self):
+        self._ranking = RankedSkipList()
+        self._points: Dict[int, int] = {}
+        self._usernames: Dict[int, Optional[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._points
+
+    def load(self, rows: Iterable[Tuple[int, Optional[str], int]]) -> None:
+        """Replace the ranking with (user_id, username, doge_points) rows"""
+        self._points = {}
+        self._usernames = {}
+        for user_id, username, doge_points in rows:
+            self._points[user_id] = doge_points or 0
+            self._usernames[user_id] = username
+        self._ranking.build(sorted((-points, user_id) for user_id, points in self._points.items()))
+
+    def add_user(self, user_id: int, username: Optional[str], doge_points: int = 0) -> None:
+        """Start ranking a user; no-op if they are already ranked"""
+        if user_id in self._points:
+            return
+        self._points[user_id] = doge_points
+        self._usernames[user_id] = username
+        self._ranking.insert((-doge_points, user_id))
+
+    def add_points(self, user_id: int, delta: int) -> None:
+        """Move a ranked user by delta points; unknown users are ignored"""
+        points = self._points.get(user_id)
+        if points is None or not delta:
+            return
+        self._ranking.remove((-points, user_id))
+        self._points[user_id] = points + delta
+        self._ranking.insert((-(points + delta), user_id))
+
+    def _entry(self, rank: int, key) -> Tuple[int, int, Optional[str], int]:
+        user_id = key[1]
+        return rank, user_id, self._usernames.get(user_id), -key[0]
+
+    def top(self, count: int, offset: int = 0) -> List[Tuple[int, int, Optional[str], int]]:
+        """Return (rank, user_id, username, doge_points) for ranks offset+1..offset+count"""
+        return [self._entry(offset + 1 + i, key)
+                for i, key in enumerate(self._ranking.slice(offset + 1, count))]
+
+    def rank(self, user_id: int) -> Optional[int]:
+        points = self._points.get(user_id)
+        if points is None:
+            return None
+        return self._ranking.rank((-points, user_id))
+
+    def points(self, user_id: int) -> Optional[int]:
+        return self._points.get(user_id)
+
+    def around(self, user_id: int, radius: int = 2) -> List[Tuple[int, int, Optional[str], int]]:
+        """Return the user's entry with up to radius neighbours on each side"""
+        rank = self.rank(user_id)
+        if not rank:
+            return []
+        start = max(rank - radius, 1)
+        return self.top(rank + radius - start + 1, start - 1)
@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Bot, Update
+
+import logs
+import metrics
+from bot import DogeBot
+from dispatch import DISPATCH_WORKERS, OutboundDispatcher
+from fakeapi import FakeTelegramAPI
+from sharding import ShardedStorage, reshard
+from storage import SQL_LATENCY, Storage
+
+logger = logging.getLogger(__name__)
+
+# Share of generated updates per kind
+MIXES = {
+    'default': {
+        'start_new': 0.10,       # /start from a new user, usually with a referral argument
+        'start_returning': 0.05,
+        'menu': 0.35,            # main-menu callbacks (tasks, leaderboard, referral ...)
+        'leaderboard_page': 0.10,
+        'task': 0.40,            # task_<id> completions
+    },
+    # Sign-up wave: new users arriving through referral links and finishing onboarding
+    'onboarding': {
+        'start_new': 0.50,
+        'start_repeat': 0.20,    # /start again from a user who signed up during the run
+        'start_returning': 0.10,
+        'social_done': 0.20,     # "I've joined all" from a user who signed up during the run
+    },
+    # Users browsing the menu: each taps through views on the message they were last shown
+    'browsing': {
+        'browse': 1.0,
+    },
+    # A few scripted accounts hammering /start and task buttons among normal traffic
+    'flood': {
+        'flood_start': 0.30,     # /start with a fresh referral argument each time
+        'flood_task': 0.30,      # task_<id> taps
+        'menu': 0.20,
+        'task': 0.20,
+    },
+}
+
+MENU_CALLBACKS = ('tasks', 'leaderboard', 'referral', 'my_referrals', 'referral_link')
+
+# Users browsing at the same time in the 'browsing' mix...
+BROWSING_USERS = 200
+# ...and the share of their taps that repeat the previous one
+BROWSING_REPEAT = 0.2
+
+# Scripted accounts sending the 'flood' updates
+FLOOD_USERS = 5
+
+# Bot API methods that are not replies to updates
+BACKGROUND_METHODS = frozenset({'getMe', 'getUpdates', 'deleteWebhook', 'setWebhook'})
+
+
+def seed_database(conn: sqlite3.Connection, users: int, extra_tasks: int,
+                  completions_per_user: int, referral_fraction: float, rng: random.Random) -> None:
+    """Fill a fresh database with users 1..users, tasks and consistent point totals"""
+    c = conn.cursor()
+    c.executemany('INSERT INTO tasks (task_name, task_description, doge_reward) VALUES (?, ?, ?)',
+                  [(f'Task {n}', f'Synthetic task {n}', rng.choice((10, 25, 50, 100)))
+                   for n in range(extra_tasks)])
+    rewards = dict(c.execute('SELECT task_id, doge_reward FROM tasks').fetchall())
+    task_ids = list(rewards)
+
+    referrers: Dict[int, Optional[int]] = {}
+    points: Dict[int, int] = {}
+    completions: List[tuple] = []
+    for user_id in range(1, users + 1):
+        referrer = rng.randint(1, user_id - 1) if user_id > 1 and rng.random() < referral_fraction else None
+        referrers[user_id] = referrer
+        points[user_id] = 0
+        for task_id in rng.sample(task_ids, min(rng.randint(0, completions_per_user * 2), len(task_ids))):
+            completions.append((user_id, task_id))
+            points[user_id] += rewards[task_id]
+            if referrer:
+                points[referrer] += rewards[task_id] // 2
+
+    c.executemany('''INSERT INTO users (user_id, username, referred_by, doge_points, social_tasks_completed)
+                     VALUES (?, ?, ?, ?, TRUE)''',
+                  [(user_id, f'doge{user_id}', referrers[user_id], points[user_id])
+                   for user_id in range(1, users + 1)])
+    c.executemany('INSERT INTO completed_tasks (user_id, task_id) VALUES (?, ?)', completions)
+    c.execute('''INSERT INTO points_ledger (user_id, delta, reason, created_at)
+                 SELECT user_id, doge_points, 'opening', ? FROM users WHERE doge_points != 0''', (time.time(),))
+
+
+class UpdateFactory:
+    """Generates synthetic Update objects for a seeded user base"""
+
+    def __init__(self, bot: Bot, users: int, task_ids: List[int], mix: Dict[str, float],
+                 rng: random.Random):
+        self.bot = bot
+        self.users = users
+        self.task_ids = task_ids
+        self.kinds = list(mix)
+        self.weights = [mix[kind] for kind in self.kinds]
+        self.rng = rng
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._next_user = users + 1
+        self._sessions: Dict[int, Tuple[int, str, Optional[str]]] = {}
+        self.navigation = 'edit'
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Doge', 'username': f'doge{user_id}'}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'text': text,
+                   'chat': {'id': user_id, 'type': 'private'}, 'from': self._user(user_id)}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return message
+
+    def command(self, user_id: int, text: str) -> Update:
+        return Update.de_json({'update_id': next(self._update_ids),
+                               'message': self._message(user_id, text)}, self.bot)
+
+    def callback(self, user_id: int, data: str, message_id: Optional[int] = None) -> Update:
+        message = self._message(user_id, 'menu')
+        if message_id is not None:
+            message['message_id'] = message_id
+        query = {'id': str(next(self._update_ids)), 'chat_instance': str(user_id), 'data': data,
+                 'from': self._user(user_id), 'message': message}
+        return Update.de_json({'update_id': next(self._update_ids), 'callback_query': query}, self.bot)
+
+    def browse(self) -> Update:
+        """Next tap of a browsing user, on the buttons their last view offered
+
+        With edit navigation the views replace each other in one message and
+        offer a back button; with send navigation every view is a new message,
+        so the user returns to the menu message to tap again. Some taps repeat
+        the previous one (impatient double taps, refreshing the same view).
+        """
+        user_id = self.rng.randint(1, min(BROWSING_USERS, self.users))
+        message_id, view, last = self._sessions.get(user_id) or (next(self._message_ids), 'main_menu', None)
+        if last and self.rng.random() < BROWSING_REPEAT:
+            data = last
+        elif view == 'main_menu' or self.navigation != 'edit':
+            data = self.rng.choice(MENU_CALLBACKS)
+        elif view == 'leaderboard' and self.rng.random() < 0.5:
+            data = self.rng.choice(('leaderboard_me', 'leaderboard_page_0', 'leaderboard_page_1'))
+        else:
+            data = 'main_menu'
+        self._sessions[user_id] = (message_id, 'leaderboard' if data.startswith('leaderboard') else data, data)
+        return self.callback(user_id, data, message_id)
+
+    def next(self) -> Update:
+        kind = self.rng.choices(self.kinds, self.weights)[0]
+        known = self.rng.randint(1, self._next_user - 1)
+        if kind == 'start_new':
+            user_id, self._next_user = self._next_user, self._next_user + 1
+            if self.rng.random() < 0.7:
+                return self.command(user_id, f'/start {known}')
+            return self.command(user_id, '/start')
+        if kind == 'start_returning':
+            return self.command(known, '/start')
+        newcomer = self.rng.randint(self.users + 1, self._next_user - 1) \
+            if self._next_user > self.users + 1 else known
+        if kind == 'start_repeat':
+            return self.command(newcomer, '/start')
+        if kind == 'social_done':
+            return self.callback(newcomer, 'social_tasks_completed')
+        if kind == 'menu':
+            return self.callback(known, self.rng.choice(MENU_CALLBACKS))
+        if kind == 'browse':
+            return self.browse()
+        if kind == 'flood_start':
+            return self.command(self.rng.randint(1, FLOOD_USERS), f'/start {known}')
+        if kind == 'flood_task':
+            return self.callback(self.rng.randint(1, FLOOD_USERS), f'task_{self.rng.choice(self.task_ids)}')
+        if kind == 'leaderboard_page':
+            return self.callback(known, f'leaderboard_page_{self.rng.randint(1, 20)}')
+        return self.callback(known, f'task_{self.rng.choice(self.task_ids)}')
+
+
+def _percentiles(family: metrics.Family) -> Dict[str, dict]:
+    results = {}
+    for values, series in family.series():
+        p50, p95, p99 = series.quantiles()
+        results[' '.join(values)] = {'count': series.count, 'p50_ms': p50 * 1000,
+                                     'p95_ms': p95 * 1000, 'p99_ms': p99 * 1000}
+    return results
+
+
+async def run_load(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix='doge-loadtest-'), 'loadtest.db')
+    storage = Storage(path, args.pool_size)
+    storage.open()
+    await storage.init_db()
+    started = time.perf_counter()
+    await storage.transaction(seed_database, args.users, args.tasks, args.completions,
+                              args.referral_fraction, rng)
+    print(f"Seeded {args.users} users and {args.tasks} extra tasks into {path} "
+          f"in {time.perf_counter() - started:.1f}s")
+    if args.shards > 1:
+        await storage.close()
+        pattern = os.path.splitext(path)[0] + '.{shard}.db'
+        reshard([path], pattern, args.shards, force=True)
+        storage = ShardedStorage(pattern, args.shards, args.pool_size)
+        storage.open()
+        await storage.init_db()
+        print(f"Split into {args.shards} shards matching {pattern}")
+
+    api = FakeTelegramAPI(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                          rate_limit=args.rate_limit, retry_after=args.retry_after)
+    dispatcher = OutboundDispatcher(global_rate=args.global_rate, chat_rate=args.chat_rate,
+                                    chat_burst=args.chat_burst, workers=args.dispatch_workers)
+    metrics.METRICS_PORT = args.metrics_port
+    doge = DogeBot('1:loadtest', storage, request=api, dispatcher=dispatcher)
+    doge.navigation = args.navigation
+    if not args.throttle:
+        doge.throttle = None
+    application = await doge.initialize()
+    await application.initialize()
+    await doge.post_init(application)
+    await application.start()
+
+    # Measure the load only, not seeding and startup
+    for family in (metrics.HANDLER_LATENCY, metrics.API_LATENCY, SQL_LATENCY,
+                   logs.LOG_EMIT, logs.LOG_DROPPED):
+        family.reset()
+    write_waits = storage.stats.snapshot()
+
+    task_ids = [task_id for task_id, *_ in await storage.get_tasks()]
+    factory = UpdateFactory(application.bot, args.users, task_ids, MIXES[args.mix], rng)
+    factory.navigation = args.navigation
+    calls_before = sum(count for method, count in api.calls.items() if method not in BACKGROUND_METHODS)
+    processor = doge.update_processor
+    processed_before = processor.processed + processor.shed
+    started = time.perf_counter()
+    for n in range(args.updates):
+        if args.rate:
+            delay = started + n / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await application.update_queue.put(factory.next())
+    while processor.processed + processor.shed - processed_before < args.updates:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await doge.batcher.flush()
+
+    db = storage.stats.snapshot()
+    log_emit = logs.LOG_EMIT.labels()
+    result = {
+        'updates': args.updates,
+        'elapsed_s': elapsed,
+        'throughput_per_s': args.updates / elapsed,
+        'shed': processor.shed,
+        'handlers': _percentiles(metrics.HANDLER_LATENCY),
+        'api': _percentiles(metrics.API_LATENCY),
+        'api_calls': dict(api.calls),
+        'api_calls_per_update': (sum(count for method, count in api.calls.items()
+                                     if method not in BACKGROUND_METHODS) - calls_before) / args.updates,
+        'api_rate_limited': sum(api.rate_limited.values()),
+        'dispatcher': dispatcher.stats(),
+        'logging': {
+            'records': log_emit.count,
+            'loop_ms': log_emit.sum * 1000,
+            'loop_share': log_emit.sum / elapsed,
+            'dropped': logs.LOG_DROPPED.labels().value,
+        },
+        'sqlite': {
+            'write_lock_waits': db['write_lock_waits'] - write_waits['write_lock_waits'],
+            'write_lock_wait_ms': db['write_lock_wait_ms'] - write_waits['write_lock_wait_ms'],
+            'avg_pool_wait_ms': db['avg_pool_wait_ms'],
+            'max_pool_wait_ms': db['max_pool_wait_ms'],
+            'statements': dict(sorted(_percentiles(SQL_LATENCY).items(),
+                                      key=lambda item: item[1]['p99_ms'], reverse=True)[:8]),
+        },
+    }
+    await doge.shutdown()
+    await storage.close()
+    return result
+
+
+def print_report(result: dict) -> None:
+    print(f"\n{result['updates']} updates in {result['elapsed_s']:.2f}s "
+          f"= {result['throughput_per_s']:.0f} updates/s")
+
+    def table(title: str, rows: Dict[str, dict]) -> None:
+        print(f"\n{title:<52} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+        for name, row in sorted(rows.items(), key=lambda item: -item[1]['count']):
+            print(f"{name[:52]:<52} {row['count']:>7} {row['p50_ms']:>8.2f} "
+                  f"{row['p95_ms']:>8.2f} {row['p99_ms']:>8.2f}")
+
+    table('handler / route', result['handlers'])
+    table('Bot API method', result['api'])
+    print(f"\nBot API calls per update: {result['api_calls_per_update']:.2f}   "
+          f"shed by the ingress throttle: {result['shed']}")
+    print(f"\n429 responses: {result['api_rate_limited']}   dispatcher: {result['dispatcher']}")
+    sqlite = result['sqlite']
+    print(f"SQLite write lock: {sqlite['write_lock_waits']} waits, "
+          f"{sqlite['write_lock_wait_ms']:.0f} ms total; pool wait avg "
+          f"{sqlite['avg_pool_wait_ms']:.2f} ms, max {sqlite['max_pool_wait_ms']:.2f} ms")
+    table('slowest SQL statements (by p99)', sqlite['statements'])
+    logged = result['logging']
+    print(f"\nLogging: {logged['records']} records, {logged['loop_ms']:.1f} ms on the event loop "
+          f"({logged['loop_share']:.2%} of the run), {logged['dropped']} dropped")
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Throughput drops and per-route p95 increases beyond max_regression"""
+    problems = []
+    if result['throughput_per_s'] < baseline['throughput_per_s'] * (1 - max_regression):
+        problems.append(f"throughput {result['throughput_per_s']:.0f}/s vs "
+                        f"baseline {baseline['throughput_per_s']:.0f}/s")
+    for route, row in result['handlers'].items():
+        before = baseline['handlers'].get(route)
+        # Ignore sub-millisecond noise
+        if before and row['p95_ms'] > max(before['p95_ms'] * (1 + max_regression), before['p95_ms'] + 1):
+            problems.append(f"{route}: p95 {row['p95_ms']:.2f} ms vs baseline {before['p95_ms']:.2f} ms")
+    return problems
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Drive DogeBot handlers with synthetic load against a fake Bot API")
+    parser.add_argument('--updates', type=int, default=5000, help="updates to send")
+    parser.add_argument('--mix', choices=sorted(MIXES), default='default', help="kinds of updates to send")
+    parser.add_argument('--rate', type=float, default=0, help="updates per second (0 = as fast as possible)")
+    parser.add_argument('--users', type=int, default=10000, help="users seeded into the database")
+    parser.add_argument('--tasks', type=int, default=20, help="tasks seeded on top of the default ones")
+    parser.add_argument('--completions', type=int, default=3, help="average completed tasks per seeded user")
+    parser.add_argument('--referral-fraction', type=float, default=0.5)
+    parser.add_argument('--db', help="database file (default: a fresh temporary file)")
+    parser.add_argument('--pool-size', type=int, default=4, help="connections per database file")
+    parser.add_argument('--shards', type=int, default=1, help="split the seeded database into this many shards")
+    parser.add_argument('--navigation', choices=('edit', 'send'), default='edit',
+                        help="show menu views by editing the menu message or by sending new ones")
+    parser.add_argument('--throttle', action='store_true',
+                        help="apply the per-user ingress throttle (synthetic users send far faster than real ones)")
+    parser.add_argument('--latency-ms', type=float, default=20, help="simulated Bot API latency")
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="fraction of message calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    # Telegram's real limits would cap throughput at ~30 replies/s and measure only
+    # the dispatcher, so they are effectively disabled unless given
+    parser.add_argument('--global-rate', type=float, default=1e6)
+    parser.add_argument('--chat-rate', type=float, default=1e6)
+    parser.add_argument('--chat-burst', type=float, default=1e6)
+    parser.add_argument('--dispatch-workers', type=int, default=DISPATCH_WORKERS,
+                        help="concurrent outbound calls; with the limits disabled this caps reply throughput")
+    parser.add_argument('--metrics-port', default='', help="serve /metrics while running")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING',
+                        help='root log level while the load runs (INFO includes the sampled access log)')
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--baseline', help="results file from an earlier run to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="allowed relative throughput drop / p95 increase")
+    args = parser.parse_args(argv)
+
+    # bot.py has already routed logging through the background writer (see logs.py)
+    logging.getLogger().setLevel(args.log_level.upper())
+    result = asyncio.run(run_load(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            problems = compare(result, json.load(f), args.max_regression)
+        if problems:
+            print("\nRegressions against baseline:\n  " + "\n  ".join(problems))
+            sys.exit(1)
+        print("\nNo regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
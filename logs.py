@@ -0,0 +1,261 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Hashable, List, Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 'json' writes one JSON object per line, 'text' the classic one-line format
+LOG_FORMAT = os.environ.get('DOGE_LOG_FORMAT', 'json')
+LOG_LEVEL = os.environ.get('DOGE_LOG_LEVEL', 'INFO')
+# File to append log lines to; stderr when empty
+LOG_FILE = os.environ.get('DOGE_LOG_FILE', '')
+# Records waiting for the writer thread; beyond this they are dropped (and counted)
+# rather than ever blocking the event loop
+LOG_QUEUE_SIZE = int(os.environ.get('DOGE_LOG_QUEUE_SIZE', '10000'))
+# Longest message or field value written, in characters; tracebacks get four times this
+LOG_FIELD_MAX = int(os.environ.get('DOGE_LOG_FIELD_MAX', '2000'))
+# Share of handled updates written to the access log; failed and slow ones always are
+LOG_UPDATE_SAMPLE = float(os.environ.get('DOGE_LOG_UPDATE_SAMPLE', '0.01'))
+LOG_SLOW_MS = float(os.environ.get('DOGE_LOG_SLOW_MS', '500'))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+LOG_EMIT = metrics.histogram('doge_log_emit_seconds',
+                             'Event-loop time per log record, from creation to being queued')
+LOG_WRITE = metrics.histogram('doge_log_write_seconds',
+                              'Writer-thread time per log record, formatting and I/O')
+LOG_DROPPED = metrics.counter('doge_log_dropped_total', 'Log records dropped because the queue was full')
+LOG_SUPPRESSED = metrics.counter('doge_log_suppressed_total',
+                                 'Log records skipped by a rate limit', ('logger',))
+
+# Attributes every LogRecord has; anything else was passed in extra= and becomes a field
+_RESERVED = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+def cap(value: str, limit: int = LOG_FIELD_MAX) -> str:
+    """value cut to limit characters, saying how much was left out"""
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}... [{len(value) - limit} more chars]"
+
+
+def _field(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return cap(value if isinstance(value, str) else str(value))
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with every field capped at LOG_FIELD_MAX"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': cap(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED:
+                entry[key] = _field(value)
+        if record.exc_info:
+            entry['exc'] = cap(self.formatException(record.exc_info), LOG_FIELD_MAX * 4)
+        elif record.exc_text:
+            entry['exc'] = cap(record.exc_text, LOG_FIELD_MAX * 4)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """TEXT_FORMAT with the message capped at LOG_FIELD_MAX"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = cap(record.message)
+        return super().formatMessage(record)
+
+    def formatException(self, ei) -> str:
+        return cap(super().formatException(ei), LOG_FIELD_MAX * 4)
+
+
+class LoopQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread without formatting them
+
+    The stock QueueHandler formats the message on the calling thread; here
+    the record is only stamped with the current handler context and put on
+    a bounded queue, so the event loop never formats, serialises or writes.
+    A full queue drops the record instead of blocking. Message arguments
+    are interpolated on the writer thread, so they must not be mutated
+    after the call (the bot's own messages are f-strings).
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        current = metrics.current_update()
+        if current is not None and 'handler' not in record.__dict__:
+            handler, route, user_id, started = current
+            record.handler = handler
+            record.route = route
+            record.user_id = user_id
+            record.elapsed_ms = round((time.perf_counter() - started) * 1000, 3)
+        if record.exc_info and not record.exc_text:
+            # The traceback must be rendered before the frames go away
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.labels().inc()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.enqueue(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+        LOG_EMIT.labels().observe(max(time.time() - record.created, 0.0))
+
+
+class TimedQueueListener(logging.handlers.QueueListener):
+    """QueueListener recording how long each record takes to write"""
+
+    def enqueue_sentinel(self) -> None:
+        # Wait for room rather than fail when stopping with a full queue
+        self.queue.put(self._sentinel)
+
+    def handle(self, record: logging.LogRecord) -> None:
+        started = time.perf_counter()
+        super().handle(record)
+        LOG_WRITE.labels().observe(time.perf_counter() - started)
+
+
+class RateLimitedLog:
+    """Lets at most `limit` records per key through every `interval` seconds
+
+    Meant for warnings that can fire once per update or per API call during
+    an incident. The first record let through after some were skipped
+    carries how many were, in the `suppressed` field.
+    """
+
+    def __init__(self, log: logging.Logger, limit: int = 10, interval: float = 60.0,
+                 max_keys: int = 10000):
+        self.log = log
+        self.limit = limit
+        self.interval = interval
+        self.max_keys = max_keys
+        # key -> [window start, records let through, records skipped]
+        self._windows: Dict[Hashable, List[Any]] = {}
+
+    def _allow(self, key: Hashable) -> Optional[int]:
+        """None if the record is skipped, otherwise how many were skipped before it"""
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.interval:
+            if window is None and len(self._windows) >= self.max_keys:
+                self._windows.clear()
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            return suppressed
+        if window[1] < self.limit:
+            window[1] += 1
+            return 0
+        window[2] += 1
+        LOG_SUPPRESSED.labels(self.log.name).inc()
+        return None
+
+    def log_at(self, level: int, msg: str, *args, key: Hashable = None, **kwargs) -> None:
+        if not self.log.isEnabledFor(level):
+            return
+        suppressed = self._allow(key)
+        if suppressed is None:
+            return
+        if suppressed:
+            kwargs['extra'] = {**kwargs.get('extra', {}), 'suppressed': suppressed}
+        self.log.log(level, msg, *args, **kwargs)
+
+    def info(self, msg: str, *args, key: Hashable = None, **kwargs) -> None:
+        self.log_at(logging.INFO, msg, *args, key=key, **kwargs)
+
+    def warning(self, msg: str, *args, key: Hashable = None, **kwargs) -> None:
+        self.log_at(logging.WARNING, msg, *args, key=key, **kwargs)
+
+    def error(self, msg: str, *args, key: Hashable = None, **kwargs) -> None:
+        self.log_at(logging.ERROR, msg, *args, key=key, **kwargs)
+
+
+# Access log of handled updates, sampled
+update_log = logging.getLogger('doge.updates')
+
+
+def log_handled(handler: str, route: str, user_id: Optional[int], seconds: float, failed: bool) -> None:
+    """metrics.on_handled hook writing a sample of handled updates, plus every failed or slow one"""
+    latency_ms = seconds * 1000
+    always = failed or latency_ms >= LOG_SLOW_MS
+    if not always and random.random() >= LOG_UPDATE_SAMPLE:
+        return
+    level = logging.WARNING if always else logging.INFO
+    if not update_log.isEnabledFor(level):
+        return
+    update_log.log(level, 'Handled update', extra={
+        'handler': handler,
+        'route': route,
+        'user_id': user_id,
+        'latency_ms': round(latency_ms, 3),
+        'failed': failed,
+        'sample_rate': 1.0 if always else LOG_UPDATE_SAMPLE,
+    })
+
+
+_listener: Optional[TimedQueueListener] = None
+
+
+def configure(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, path: str = LOG_FILE) -> TimedQueueListener:
+    """Route the root logger through a bounded queue to a background writer thread
+
+    Other handlers already on the root logger (such as metrics.ErrorCounter)
+    are kept; a previous basicConfig() stream handler is replaced.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if type(handler) is logging.StreamHandler:
+            root.removeHandler(handler)
+    target = logging.FileHandler(path, encoding='utf-8') if path else logging.StreamHandler()
+    target.setFormatter(TextFormatter() if fmt == 'text' else JsonFormatter())
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    _listener = TimedQueueListener(log_queue, target)
+    root.addHandler(LoopQueueHandler(log_queue))
+    root.setLevel(level.upper())
+    _listener.start()
+    metrics.on_handled = log_handled
+    atexit.register(shutdown)
+    return _listener
+
+
+def shutdown() -> None:
+    """Write out queued records and stop the writer thread"""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    metrics.on_handled = None
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, LoopQueueHandler) and handler.queue is listener.queue:
+            root.removeHandler(handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,373 @@
+import functools
+import logging
+import math
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+from httpserver import HTTPServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+# Address of the Prometheus endpoint (GET /metrics); leave the port empty to disable it
+METRICS_LISTEN = os.environ.get('DOGE_METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = os.environ.get('DOGE_METRICS_PORT', '9090')
+
+# Distinct label sets kept per metric; further ones are folded into 'other'
+MAX_SERIES = 500
+
+# Each power of two is split into 2**SUB_BUCKET_BITS linear buckets, which
+# bounds the error of any reported quantile to about 1.5%
+SUB_BUCKET_BITS = 5
+_SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _bucket_index(micros: int) -> int:
+    if micros < 2 * _SUB_BUCKETS:
+        return micros
+    shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * _SUB_BUCKETS + (micros >> shift)
+
+
+def _bucket_value(index: int) -> float:
+    """Midpoint, in microseconds, of the values recorded under index"""
+    if index < 2 * _SUB_BUCKETS:
+        return float(index)
+    shift, top = divmod(index, _SUB_BUCKETS)
+    shift -= 1
+    top += _SUB_BUCKETS
+    return ((top << shift) + ((top + 1) << shift)) / 2
+
+
+class Histogram:
+    """Log-linear latency histogram in the style of HdrHistogram
+
+    Durations are recorded at microsecond resolution into a fixed set of
+    buckets, so memory stays constant however many samples are recorded and
+    quantiles can be read at any time. Safe to use from executor threads.
+    """
+
+    __slots__ = ('_counts', '_lock', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self._counts: List[int] = []
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        index = _bucket_index(max(int(seconds * 1_000_000), 0))
+        with self._lock:
+            if index >= len(self._counts):
+                self._counts.extend([0] * (index + 1 - len(self._counts)))
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantiles(self, qs: Sequence[float] = QUANTILES) -> List[float]:
+        """Values in seconds at each quantile in qs (ascending)"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self.count
+            largest = self.max
+        results: List[float] = []
+        if not total:
+            return [0.0] * len(qs)
+        targets = iter(max(1, math.ceil(q * total)) for q in qs)
+        target = next(targets)
+        running = 0
+        for index, n in enumerate(counts):
+            running += n
+            while target is not None and running >= target:
+                results.append(min(_bucket_value(index) / 1_000_000, largest))
+                target = next(targets, None)
+            if target is None:
+                break
+        return results
+
+
+class Counter:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    """Current value, either set directly or read from a function when scraped"""
+    __slots__ = ('_value', '_function')
+
+    def __init__(self):
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    @property
+    def value(self) -> float:
+        return self._function() if self._function is not None else self._value
+
+
+_SERIES_TYPES = {'summary': Histogram, 'counter': Counter, 'gauge': Gauge}
+
+
+class Family:
+    """A named metric with one Histogram, Counter or Gauge per label set"""
+
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: Sequence[str]):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = _SERIES_TYPES[kind]
+        self._series: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> Any:
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                if values not in self._series and len(self._series) >= MAX_SERIES:
+                    values = ('other',) * len(self.labelnames)
+                series = self._series.get(values)
+                if series is None:
+                    series = self._series[values] = self._factory()
+        return series
+
+    def series(self) -> List[Tuple[Tuple[str, ...], Any]]:
+        with self._lock:
+            return list(self._series.items())
+
+    def reset(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+
+class Registry:
+    def __init__(self):
+        self.families: Dict[str, Family] = {}
+
+    def _family(self, name: str, help_text: str, kind: str, labelnames: Sequence[str]) -> Family:
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, help_text, kind, labelnames)
+            if not family.labelnames:
+                # Export an unlabelled metric as 0 before anything is recorded
+                family.labels()
+        return family
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Family:
+        return self._family(name, help_text, 'summary', labelnames)
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Family:
+        return self._family(name, help_text, 'counter', labelnames)
+
+    def gauge(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Family:
+        return self._family(name, help_text, 'gauge', labelnames)
+
+    def render(self) -> str:
+        """Prometheus text exposition format; histograms are exported as summaries"""
+        lines: List[str] = []
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, series in sorted(family.series()):
+                labels = list(zip(family.labelnames, values))
+                if family.kind != 'summary':
+                    lines.append(f"{family.name}{_labels(labels)} {series.value}")
+                    continue
+                for q, value in zip(QUANTILES, series.quantiles()):
+                    lines.append(f"{family.name}{_labels(labels + [('quantile', str(q))])} {value:.6f}")
+                lines.append(f"{family.name}_sum{_labels(labels)} {series.sum:.6f}")
+                lines.append(f"{family.name}_count{_labels(labels)} {series.count}")
+        return '\n'.join(lines) + '\n'
+
+    def report(self, limit: int = 8) -> str:
+        """p50/p95/p99 of every histogram, label sets with the most total time first"""
+        lines: List[str] = []
+        for family in self.families.values():
+            if family.kind != 'summary':
+                continue
+            rows = sorted((item for item in family.series() if item[1].count),
+                          key=lambda item: item[1].sum, reverse=True)[:limit]
+            if not rows:
+                continue
+            lines.append(f"{family.name} (ms: p50 / p95 / p99, count)")
+            for values, series in rows:
+                p50, p95, p99 = (value * 1000 for value in series.quantiles())
+                label = ' '.join(values)[:40]
+                lines.append(f"  {label:<40} {p50:7.1f} {p95:7.1f} {p99:7.1f} {series.count:>7}")
+        return '\n'.join(lines) or 'No samples recorded yet'
+
+
+def _labels(pairs: List[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REGISTRY = Registry()
+histogram = REGISTRY.histogram
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+
+
+# Update handlers
+
+HANDLER_LATENCY = histogram('doge_handler_seconds', 'Time spent in update handlers',
+                            ('handler', 'route'))
+HANDLER_ERRORS = counter('doge_handler_errors_total',
+                         'Errors logged or raised while handling an update', ('handler', 'route'))
+LOG_ERRORS = counter('doge_log_errors_total', 'ERROR log records by logger', ('logger',))
+
+# (handler, route, user_id, perf_counter() at start) of the update being handled in the current task
+_current_handler: ContextVar[Optional[Tuple[str, str, Optional[int], float]]] = \
+    ContextVar('doge_current_handler', default=None)
+
+# Called with (handler, route, user_id, seconds, failed) after every instrumented handler
+on_handled: Optional[Callable[[str, str, Optional[int], float, bool], None]] = None
+
+_NUMBERS = re.compile(r'\d+')
+
+
+def route_of(update: object) -> str:
+    """Low-cardinality name for what an update asked for, e.g. '/start' or 'cb:task_N'"""
+    if isinstance(update, Update):
+        if update.callback_query:
+            return 'cb:' + _NUMBERS.sub('N', update.callback_query.data or '')[:32]
+        if update.message and update.message.text:
+            if update.message.text.startswith('/'):
+                return update.message.text.split(maxsplit=1)[0].split('@', 1)[0][:32]
+            return 'text'
+    return 'other'
+
+
+def current_update() -> Optional[Tuple[str, str, Optional[int], float]]:
+    """(handler, route, user_id, perf_counter() at start) of the update being handled, if any"""
+    return _current_handler.get()
+
+
+def instrument(callback: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Wrap a handler callback to record its latency and errors per route"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update: object, context: Any) -> Any:
+        route = route_of(update)
+        user = getattr(update, 'effective_user', None)
+        user_id = user.id if user is not None else None
+        started = time.perf_counter()
+        token = _current_handler.set((name, route, user_id, started))
+        failed = False
+        try:
+            return await callback(update, context)
+        except Exception:
+            failed = True
+            HANDLER_ERRORS.labels(name, route).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.labels(name, route).observe(elapsed)
+            _current_handler.reset(token)
+            if on_handled is not None:
+                on_handled(name, route, user_id, elapsed, failed)
+
+    return wrapper
+
+
+class ErrorCounter(logging.Handler):
+    """Counts ERROR records, attributing them to the handler that logged them
+
+    Handlers catch their own exceptions and log "Error in ...", so this is
+    where those failures become visible as metrics.
+    """
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        LOG_ERRORS.labels(record.name).inc()
+        current = _current_handler.get()
+        if current is not None:
+            HANDLER_ERRORS.labels(current[0], current[1]).inc()
+
+
+# Outbound Bot API requests
+
+API_LATENCY = histogram('doge_api_seconds', 'Bot API request latency', ('method',))
+API_ERRORS = counter('doge_api_errors_total', 'Bot API requests that failed', ('method', 'status'))
+
+
+class InstrumentedRequest(BaseRequest):
+    """BaseRequest wrapper timing every Bot API request by method"""
+
+    def __init__(self, request: BaseRequest):
+        self.request = request
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.request.read_timeout
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self.request.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+        except Exception as e:
+            API_ERRORS.labels(endpoint, type(e).__name__).inc()
+            raise
+        finally:
+            API_LATENCY.labels(endpoint).observe(time.perf_counter() - started)
+        if status >= 300:
+            API_ERRORS.labels(endpoint, str(status)).inc()
+        return status, payload
+
+
+# Local endpoint
+
+async def _metrics(request: Request) -> Response:
+    return 200, 'text/plain; version=0.0.4; charset=utf-8', REGISTRY.render().encode()
+
+
+def metrics_server(host: str = METRICS_LISTEN, port: Optional[int] = None) -> Optional[HTTPServer]:
+    """HTTP server exposing GET /metrics, or None when DOGE_METRICS_PORT is empty"""
+    if port is None:
+        if not METRICS_PORT:
+            return None
+        port = int(METRICS_PORT)
+    return HTTPServer(host, port, {'/metrics': _metrics})
@@ -0,0 +1,477 @@
+import argparse
+import logging
+import os
+import sqlite3
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Referral levels tracked in the closure table for multi-level stats (1 disables it)
+REFERRAL_LEVELS = int(os.environ.get('DOGE_REFERRAL_LEVELS', '3'))
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection, bool], None]
+    # Index builds that may run after startup instead of before it
+    online: bool = False
+
+
+def _baseline(conn: sqlite3.Connection, sharded: bool) -> None:
+    """Every table up to the introduction of versioning; safe on databases that predate it"""
+    c = conn.cursor()
+
+    # Users table
+    c.execute('''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        referred_by INTEGER,
+        doge_points INTEGER DEFAULT 0,
+        social_tasks_completed BOOLEAN DEFAULT FALSE
+    )''')
+
+    # Tasks table
+    c.execute('''CREATE TABLE IF NOT EXISTS tasks (
+        task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_name TEXT,
+        task_description TEXT,
+        doge_reward INTEGER
+    )''')
+
+    # Completed tasks table
+    c.execute('''CREATE TABLE IF NOT EXISTS completed_tasks (
+        user_id INTEGER,
+        task_id INTEGER,
+        FOREIGN KEY(user_id) REFERENCES users(user_id),
+        FOREIGN KEY(task_id) REFERENCES tasks(task_id),
+        PRIMARY KEY (user_id, task_id)
+    )''')
+
+    # Broadcast checkpoints: every user_id <= last_user_id has been handled
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+        broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message TEXT,
+        admin_chat_id INTEGER,
+        progress_message_id INTEGER,
+        status TEXT DEFAULT 'running',
+        last_user_id INTEGER DEFAULT 0,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        started_at REAL,
+        updated_at REAL
+    )''')
+
+    # Recipients a broadcast could not be delivered to
+    c.execute('''CREATE TABLE IF NOT EXISTS broadcast_failures (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        reason TEXT,
+        FOREIGN KEY(broadcast_id) REFERENCES broadcasts(broadcast_id),
+        PRIMARY KEY (broadcast_id, user_id)
+    )''')
+
+    # Pending delayed/recurring actions, restored by the scheduler on startup
+    c.execute('''CREATE TABLE IF NOT EXISTS scheduled_actions (
+        action_id INTEGER PRIMARY KEY,
+        run_at REAL,
+        action TEXT,
+        payload TEXT,
+        interval REAL
+    )''')
+
+    # Referral graph: invitees by referrer, per-referrer aggregates and the
+    # ancestor/descendant pairs up to REFERRAL_LEVELS apart
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by, user_id)')
+    c.execute('''CREATE TABLE IF NOT EXISTS referral_stats (
+        user_id INTEGER PRIMARY KEY,
+        invitees INTEGER DEFAULT 0,
+        invitee_points INTEGER DEFAULT 0,
+        bonus_earned INTEGER DEFAULT 0
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS referral_closure (
+        ancestor INTEGER,
+        descendant INTEGER,
+        depth INTEGER,
+        PRIMARY KEY (ancestor, descendant)
+    )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_referral_closure_depth ON referral_closure (ancestor, depth)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_referral_closure_descendant ON referral_closure (descendant)')
+
+    if sharded:
+        # Changes to users on other shards, relayed in order (see sharding.py)
+        c.execute('''CREATE TABLE IF NOT EXISTS outbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT,
+            user_id INTEGER,
+            amount INTEGER,
+            payload TEXT
+        )''')
+        # Last outbox_id applied here from each source shard
+        c.execute('''CREATE TABLE IF NOT EXISTS outbox_applied (
+            source INTEGER PRIMARY KEY,
+            last_id INTEGER
+        )''')
+
+    # Create some initial tasks if the tasks table is empty
+    c.execute('SELECT COUNT(*) FROM tasks')
+    if c.fetchone()[0] == 0:
+        initial_tasks = [
+            ('Join Community', 'Join our Telegram community', 100),
+            ('Share Invite', 'Share your referral link with friends', 50),
+            ('Daily Check-in', 'Check in daily to earn points', 25),
+            ('Complete Profile', 'Fill in your profile information', 75)
+        ]
+        c.executemany('INSERT INTO tasks (task_name, task_description, doge_reward) VALUES (?, ?, ?)',
+                      initial_tasks)
+
+
+def _referral_trigger_body(closure: bool) -> str:
+    statements = ['''INSERT INTO referral_stats (user_id, invitees, invitee_points)
+                     VALUES (NEW.referred_by, 1, NEW.doge_points)
+                     ON CONFLICT (user_id) DO UPDATE
+                         SET invitees = invitees + 1,
+                             invitee_points = invitee_points + excluded.invitee_points;''']
+    if closure and REFERRAL_LEVELS > 1:
+        # Link the new referrer and its ancestors to the user and to anyone
+        # the user had already invited
+        statements.append(f'''INSERT OR IGNORE INTO referral_closure (ancestor, descendant, depth)
+                     SELECT a.ancestor, d.descendant, a.depth + d.depth
+                     FROM (SELECT NEW.referred_by AS ancestor, 1 AS depth
+                           UNION ALL
+                           SELECT ancestor, depth + 1 FROM referral_closure
+                           WHERE descendant = NEW.referred_by) AS a,
+                          (SELECT NEW.user_id AS descendant, 0 AS depth
+                           UNION ALL
+                           SELECT descendant, depth FROM referral_closure
+                           WHERE ancestor = NEW.user_id) AS d
+                     WHERE a.depth + d.depth <= {REFERRAL_LEVELS} AND a.ancestor != d.descendant;''')
+    return '\n'.join(statements)
+
+
+def _install_referral_triggers(conn: sqlite3.Connection, closure: bool = True) -> None:
+    """Keep referral_stats and referral_closure in step with users.referred_by
+
+    The triggers fire only when a referrer is first set, which is the only
+    way register_user changes it. Existing referrals are backfilled the first
+    time the triggers are installed, and the closure is rebuilt whenever
+    DOGE_REFERRAL_LEVELS changes. Sharded databases maintain the closure
+    themselves, since a user's referral chain spans shards.
+    """
+    body = _referral_trigger_body(closure)
+    triggers = {
+        'users_referred_insert': f'''CREATE TRIGGER users_referred_insert AFTER INSERT ON users
+                                     WHEN NEW.referred_by IS NOT NULL
+                                     BEGIN
+                                     {body}
+                                     END''',
+        'users_referred_update': f'''CREATE TRIGGER users_referred_update AFTER UPDATE OF referred_by ON users
+                                     WHEN OLD.referred_by IS NULL AND NEW.referred_by IS NOT NULL
+                                     BEGIN
+                                     {body}
+                                     END''',
+    }
+    installed = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND name IN (?, ?)",
+                                  tuple(triggers)).fetchall())
+    if installed == triggers:
+        return
+    for name, sql in triggers.items():
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+        conn.execute(sql)
+
+    if not installed:
+        # Bonuses are estimated from the invitees' completed tasks
+        conn.execute('DELETE FROM referral_stats')
+        conn.execute('''INSERT INTO referral_stats (user_id, invitees, invitee_points, bonus_earned)
+                        SELECT u.referred_by, COUNT(*), SUM(u.doge_points),
+                               COALESCE((SELECT SUM(t.doge_reward / 2) FROM users i
+                                         JOIN completed_tasks c ON c.user_id = i.user_id
+                                         JOIN tasks t ON t.task_id = c.task_id
+                                         WHERE i.referred_by = u.referred_by), 0)
+                        FROM users u WHERE u.referred_by IS NOT NULL
+                        GROUP BY u.referred_by''')
+    if not closure:
+        return
+    conn.execute('DELETE FROM referral_closure')
+    if REFERRAL_LEVELS > 1:
+        conn.execute(f'''INSERT OR IGNORE INTO referral_closure (ancestor, descendant, depth)
+                         WITH RECURSIVE chain (ancestor, descendant, depth) AS (
+                             SELECT referred_by, user_id, 1 FROM users WHERE referred_by IS NOT NULL
+                             UNION ALL
+                             SELECT u.referred_by, chain.descendant, chain.depth + 1
+                             FROM chain JOIN users u ON u.user_id = chain.ancestor
+                             WHERE u.referred_by IS NOT NULL AND chain.depth < {REFERRAL_LEVELS})
+                         SELECT ancestor, descendant, MIN(depth) FROM chain
+                         WHERE ancestor != descendant
+                         GROUP BY ancestor, descendant''')
+    logger.info(f"Installed referral triggers tracking {REFERRAL_LEVELS} level(s)")
+
+
+def _points_ledger(conn: sqlite3.Connection, sharded: bool) -> None:
+    """Append-only history of every points change; users.doge_points is its running total"""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'points_ledger'").fetchone():
+        return
+    conn.execute('''CREATE TABLE points_ledger (
+        entry_id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        delta INTEGER,
+        reason TEXT,
+        task_id INTEGER,
+        source_user_id INTEGER,
+        created_at REAL
+    )''')
+    # Balances from before the ledger existed become opening entries
+    conn.execute('''INSERT INTO points_ledger (user_id, delta, reason, created_at)
+                    SELECT user_id, doge_points, 'opening', ? FROM users
+                    WHERE doge_points != 0''', (time.time(),))
+
+
+def _stats_counters(conn: sqlite3.Connection, sharded: bool) -> None:
+    """Counters behind the admin /stats command, with hourly and daily rollups
+
+    Counters are keyed by name and task_id (0 for counters that are not per
+    task); hour and day are the UTC start of the bucket in unix seconds. The
+    bot only ever adds to them. Totals are backfilled from this file's
+    existing users and completions, and rollups from the points ledger.
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'stats_counters'").fetchone():
+        return
+    c = conn.cursor()
+    c.execute('''CREATE TABLE stats_counters (
+        name TEXT,
+        task_id INTEGER,
+        value INTEGER DEFAULT 0,
+        PRIMARY KEY (name, task_id)
+    ) WITHOUT ROWID''')
+    for table, bucket in (('stats_hourly', 'hour'), ('stats_daily', 'day')):
+        c.execute(f'''CREATE TABLE {table} (
+            {bucket} INTEGER,
+            name TEXT,
+            task_id INTEGER,
+            value INTEGER DEFAULT 0,
+            PRIMARY KEY ({bucket}, name, task_id)
+        ) WITHOUT ROWID''')
+
+    # One pass over users and one over completions; starts, views and taps
+    # were never recorded and begin at zero
+    c.execute('''INSERT INTO stats_counters (name, task_id, value)
+                 SELECT 'users', 0, COUNT(*) FROM users
+                 UNION ALL SELECT 'referred_users', 0, COUNT(referred_by) FROM users
+                 UNION ALL SELECT 'social_completed', 0, COALESCE(SUM(social_tasks_completed = TRUE), 0) FROM users
+                 UNION ALL SELECT 'points_issued', 0, COALESCE(SUM(doge_points), 0) FROM users''')
+    c.execute('''INSERT INTO stats_counters (name, task_id, value)
+                 SELECT 'task_completions', task_id, COUNT(*) FROM completed_tasks GROUP BY task_id''')
+    # Rollups of what the ledger dates: completions and the points they issued
+    for table, bucket, width in (('stats_hourly', 'hour', 3600), ('stats_daily', 'day', 86400)):
+        c.execute(f'''INSERT INTO {table} ({bucket}, name, task_id, value)
+                      SELECT CAST(created_at / {width} AS INTEGER) * {width}, 'task_completions', task_id, COUNT(*)
+                      FROM points_ledger WHERE reason = 'task' GROUP BY 1, task_id
+                      UNION ALL
+                      SELECT CAST(created_at / {width} AS INTEGER) * {width}, 'points_issued', 0, SUM(delta)
+                      FROM points_ledger WHERE reason IN ('task', 'referral') GROUP BY 1''')
+
+
+def _recurring_tasks(conn: sqlite3.Connection, sharded: bool) -> None:
+    """Daily, weekly and limited-time tasks with per-user streaks
+
+    A task's schedule says how often it can be completed again, and
+    starts_at/ends_at (unix seconds, either may be NULL) when it is
+    offered. completed_tasks keeps one row per user and task: its period
+    is the last one the task was completed in (0 for one-time tasks),
+    next to the streak of consecutive periods that ended there. A task is
+    due again once the current period is later, so nothing is reset when a
+    period ends. Every completion of a recurring task is also kept in
+    task_period_completions, keyed by period.
+
+    The seeded "Daily Check-in" task becomes a daily task; the day of each
+    user's last check-in is taken from the ledger.
+    """
+    if 'schedule' in [name for _, name, *_ in conn.execute('PRAGMA table_info(tasks)')]:
+        return
+    c = conn.cursor()
+    # Columns with constant defaults are added without rewriting the tables
+    c.execute("ALTER TABLE tasks ADD COLUMN schedule TEXT DEFAULT 'once'")
+    c.execute('ALTER TABLE tasks ADD COLUMN starts_at REAL')
+    c.execute('ALTER TABLE tasks ADD COLUMN ends_at REAL')
+    c.execute('ALTER TABLE completed_tasks ADD COLUMN period INTEGER DEFAULT 0')
+    c.execute('ALTER TABLE completed_tasks ADD COLUMN streak INTEGER DEFAULT 0')
+    c.execute('ALTER TABLE completed_tasks ADD COLUMN best_streak INTEGER DEFAULT 0')
+    c.execute('''CREATE TABLE task_period_completions (
+        user_id INTEGER,
+        task_id INTEGER,
+        period INTEGER,
+        completed_at REAL,
+        PRIMARY KEY (user_id, task_id, period)
+    ) WITHOUT ROWID''')
+
+    task_ids = [task_id for task_id, in c.execute(
+        '''UPDATE tasks SET schedule = 'daily'
+           WHERE task_name = 'Daily Check-in' AND task_description = 'Check in daily to earn points'
+           RETURNING task_id''').fetchall()]
+    if not task_ids:
+        return
+    # One pass over the ledger rather than a lookup per completion: the
+    # ledger's user index may not be built yet
+    marks = ', '.join('?' * len(task_ids))
+    c.execute('''CREATE TEMP TABLE check_ins (
+        user_id INTEGER,
+        task_id INTEGER,
+        completed_at REAL,
+        PRIMARY KEY (user_id, task_id)
+    )''')
+    c.execute(f'''INSERT INTO check_ins (user_id, task_id, completed_at)
+                  SELECT user_id, task_id, MAX(created_at) FROM points_ledger
+                  WHERE reason = 'task' AND task_id IN ({marks})
+                  GROUP BY user_id, task_id''', task_ids)
+    c.execute('''UPDATE completed_tasks SET period = CAST(i.completed_at / 86400 AS INTEGER),
+                                            streak = 1, best_streak = 1
+                 FROM check_ins AS i
+                 WHERE completed_tasks.user_id = i.user_id AND completed_tasks.task_id = i.task_id''')
+    c.execute('''INSERT INTO task_period_completions (user_id, task_id, period, completed_at)
+                 SELECT user_id, task_id, CAST(completed_at / 86400 AS INTEGER), completed_at FROM check_ins''')
+    c.execute('DROP TABLE check_ins')
+
+
+def _registration_times(conn: sqlite3.Connection, sharded: bool) -> None:
+    """When each user was created and when their referrer was recorded
+
+    Registration sets both in the same UPSERT that creates or touches the
+    user, so comparing them with the time it passed tells it what changed
+    without reading the row first. They stay NULL for existing users.
+    """
+    if 'created_at' in [name for _, name, *_ in conn.execute('PRAGMA table_info(users)')]:
+        return
+    conn.execute('ALTER TABLE users ADD COLUMN created_at REAL')
+    conn.execute('ALTER TABLE users ADD COLUMN referred_at REAL')
+
+
+def _index(sql: str) -> Callable[[sqlite3.Connection, bool], None]:
+    return lambda conn, sharded: conn.execute(sql)
+
+
+MIGRATIONS = (
+    Migration(1, 'baseline', _baseline),
+    Migration(2, 'points ledger', _points_ledger),
+    Migration(3, 'users by points', _index(
+        'CREATE INDEX IF NOT EXISTS idx_users_doge_points ON users (doge_points DESC, user_id)'), online=True),
+    Migration(4, 'ledger by user', _index(
+        'CREATE INDEX IF NOT EXISTS idx_points_ledger_user ON points_ledger (user_id, delta)'), online=True),
+    Migration(5, 'stats counters', _stats_counters),
+    Migration(6, 'recurring tasks', _recurring_tasks),
+    Migration(7, 'registration times', _registration_times),
+)
+
+
+def applied_versions(conn: sqlite3.Connection) -> List[int]:
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at REAL
+    )''')
+    return [version for version, in conn.execute('SELECT version FROM schema_version ORDER BY version')]
+
+
+def pending(conn: sqlite3.Connection, online: Optional[bool] = None) -> List[Migration]:
+    """Migrations not applied yet, optionally only the online (or only the blocking) ones"""
+    applied = set(applied_versions(conn))
+    return [migration for migration in MIGRATIONS
+            if migration.version not in applied and (online is None or migration.online == online)]
+
+
+def apply(conn: sqlite3.Connection, migration: Migration, sharded: bool = False) -> None:
+    started = time.perf_counter()
+    migration.apply(conn, sharded)
+    conn.execute('INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                 (migration.version, migration.name, time.time()))
+    logger.info(f"Applied migration {migration.version} ({migration.name}) "
+                f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def migrate(conn: sqlite3.Connection, sharded: bool = False, online: bool = False) -> List[int]:
+    """Apply pending migrations in order and (re)install the referral triggers
+
+    Online migrations are skipped unless online is set; the bot builds
+    them in the background after it starts. Returns the versions applied.
+    """
+    migrations = pending(conn) if online else pending(conn, online=False)
+    for migration in migrations:
+        apply(conn, migration, sharded)
+    _install_referral_triggers(conn, closure=not sharded)
+    return [migration.version for migration in migrations]
+
+
+def rebuild_balances(conn: sqlite3.Connection) -> dict:
+    """Recompute users.doge_points and invitee totals from the ledger
+
+    The ledger is summed once, in user_id order from its covering index
+    so the sums stream without sorting, into a temporary table. Drift is
+    measured against it and the balances that differ are fixed by a single
+    UPDATE joined to it. Returns how many balances changed and by how much
+    in total.
+    """
+    c = conn.cursor()
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS ledger_totals (
+        user_id INTEGER PRIMARY KEY,
+        total INTEGER
+    )''')
+    c.execute('DELETE FROM ledger_totals')
+    c.execute('''INSERT INTO ledger_totals (user_id, total)
+                 SELECT user_id, SUM(delta) FROM points_ledger GROUP BY user_id''')
+    changed, drift = c.execute('''SELECT COUNT(*), COALESCE(SUM(ABS(COALESCE(t.total, 0) - u.doge_points)), 0)
+                                FROM users u LEFT JOIN ledger_totals t ON t.user_id = u.user_id
+                                WHERE u.doge_points IS NOT COALESCE(t.total, 0)''').fetchone()
+    if changed:
+        # Users without ledger entries are joined too, with a total of 0
+        c.execute('''UPDATE users SET doge_points = b.total
+                     FROM (SELECT u.user_id, COALESCE(t.total, 0) AS total
+                           FROM users u LEFT JOIN ledger_totals t ON t.user_id = u.user_id) AS b
+                     WHERE users.user_id = b.user_id AND users.doge_points IS NOT b.total''')
+        c.execute('''UPDATE referral_stats SET invitee_points = COALESCE(
+                         (SELECT SUM(doge_points) FROM users WHERE referred_by = referral_stats.user_id), 0)''')
+    c.execute('DELETE FROM ledger_totals')
+    return {'changed': changed, 'drift': drift}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from sharding import DB_SHARDS, DB_SHARD_PATH, shard_path
+    from storage import DB_PATH
+
+    default_paths = ([shard_path(DB_SHARD_PATH, n) for n in range(DB_SHARDS)] if DB_SHARDS > 1 else [DB_PATH])
+    parser = argparse.ArgumentParser(description="Doge World schema migrations and ledger maintenance")
+    parser.add_argument('command', choices=('status', 'migrate', 'rebuild-balances'))
+    parser.add_argument('--db', action='append',
+                        help="database file; repeat for every shard (default: the configured database)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    for path in args.db or default_paths:
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA busy_timeout=5000')
+            if args.command == 'status':
+                print(f"{path}: applied {applied_versions(conn)}, "
+                      f"pending {[migration.version for migration in pending(conn)]}")
+                continue
+            started = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if args.command == 'migrate':
+                    # Shard files are the ones created with an outbox
+                    sharded = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'outbox'").fetchone() is not None
+                    result = migrate(conn, sharded, online=True)
+                else:
+                    result = rebuild_balances(conn)
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+            print(f"{path}: {args.command} {result} in {time.perf_counter() - started:.2f}s")
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
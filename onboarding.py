@@ -0,0 +1,52 @@
+import os
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+# Users whose onboarding state is kept in memory
+ONBOARDING_CACHE_SIZE = int(os.environ.get('DOGE_ONBOARDING_CACHE_SIZE', '200000'))
+
+
+class OnboardingState(NamedTuple):
+    social_tasks_completed: bool
+    referrer_id: Optional[int]
+
+
+class OnboardingCache:
+    """LRU of registered users' onboarding state
+
+    A user present here is known to exist in the database, so a repeat
+    /start only needs the database again when it carries a referral and the
+    user has no referrer yet.
+    """
+
+    def __init__(self, max_entries: int = ONBOARDING_CACHE_SIZE):
+        self.max_entries = max(max_entries, 1)
+        self._entries: 'OrderedDict[int, OnboardingState]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, user_id: int) -> Optional[OnboardingState]:
+        state = self._entries.get(user_id)
+        if state is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return state
+
+    def put(self, user_id: int, state: OnboardingState) -> None:
+        self._entries[user_id] = state
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def complete_social_tasks(self, user_id: int) -> None:
+        state = self._entries.get(user_id)
+        if state is not None:
+            self._entries[user_id] = state._replace(social_tasks_completed=True)
+
+    def stats(self) -> dict:
+        return {'users': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Milliseconds between writes of new/finished actions to SQLite
+SCHEDULER_FLUSH_INTERVAL = float(os.environ.get('DOGE_SCHEDULER_FLUSH_MS', '200')) / 1000
+# Actions allowed to run at the same time (e.g. after a restart with a backlog)
+SCHEDULER_MAX_RUNNING = int(os.environ.get('DOGE_SCHEDULER_MAX_RUNNING', '100'))
+
+Action = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class _Job:
+    __slots__ = ('action_id', 'run_at', 'action', 'payload', 'interval')
+
+    def __init__(self, action_id: int, run_at: float, action: str,
+                 payload: Dict[str, Any], interval: Optional[float]):
+        self.action_id = action_id
+        self.run_at = run_at
+        self.action = action
+        self.payload = payload
+        self.interval = interval
+
+    def row(self) -> tuple:
+        return self.action_id, self.run_at, self.action, json.dumps(self.payload), self.interval
+
+
+class Scheduler:
+    """Delayed and recurring actions on a min-heap, persisted to SQLite
+
+    Handlers call schedule() and return immediately; a single task sleeps
+    until the earliest deadline and starts due actions. Actions are looked up
+    by name from register() so pending ones can be restored after a restart.
+    New and finished actions are written in batches every
+    SCHEDULER_FLUSH_INTERVAL seconds. Cancelled entries stay in the heap and
+    are skipped when they surface.
+
+    With partition=(index, count), several schedulers share the table: each
+    uses and restores only the action ids congruent to index modulo count.
+    """
+
+    def __init__(self, storage: Storage, partition: Tuple[int, int] = (0, 1)):
+        self.storage = storage
+        self.partition = partition
+        self._actions: Dict[str, Action] = {}
+        self._heap: List[Tuple[float, int]] = []
+        self._jobs: Dict[int, _Job] = {}
+        self._dirty: Dict[int, Optional[_Job]] = {}
+        self._next_id = partition[0] + partition[1]
+        self._wakeup = asyncio.Event()
+        self._running = asyncio.Semaphore(SCHEDULER_MAX_RUNNING)
+        self._tasks: List[asyncio.Task] = []
+        # Actions started and not finished yet
+        self._fired: Set[asyncio.Task] = set()
+        self.fired = 0
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def register(self, name: str, action: Action) -> None:
+        """Make an action available to schedule() under name"""
+        self._actions[name] = action
+
+    async def start(self) -> None:
+        """Restore pending actions from the database and start the timer"""
+        if self._tasks:
+            return
+        index, count = self.partition
+        for action_id, run_at, action, payload, interval in await self.storage.get_scheduled_actions():
+            if action_id % count != index:
+                continue
+            self._push(_Job(action_id, run_at, action, json.loads(payload), interval))
+            self._next_id = max(self._next_id, action_id + count)
+        if self._jobs:
+            logger.info(f"Restored {len(self._jobs)} scheduled actions")
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._flush_loop())]
+
+    async def close(self, timeout: float = 10.0) -> None:
+        """Stop the timer, give running actions a chance to finish and save pending ones"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._fired:
+            _, running = await asyncio.wait(set(self._fired), timeout=timeout)
+            if running:
+                logger.warning(f"Cancelling {len(running)} scheduled actions still running on shutdown")
+                for task in running:
+                    task.cancel()
+                await asyncio.gather(*running, return_exceptions=True)
+        await self.flush()
+
+    def schedule(self, delay: float, action: str, payload: Optional[Dict[str, Any]] = None,
+                 interval: Optional[float] = None) -> int:
+        """Run action(payload) after delay seconds, then every interval seconds if given"""
+        if action not in self._actions:
+            raise ValueError(f"Unknown scheduled action {action!r}")
+        job = _Job(self._next_id, time.time() + delay, action, payload or {}, interval)
+        self._next_id += self.partition[1]
+        self._push(job)
+        self._dirty[job.action_id] = job
+        return job.action_id
+
+    def cancel(self, action_id: int) -> bool:
+        if self._jobs.pop(action_id, None) is None:
+            return False
+        self._dirty[action_id] = None
+        return True
+
+    def _push(self, job: _Job) -> None:
+        self._jobs[job.action_id] = job
+        heapq.heappush(self._heap, (job.run_at, job.action_id))
+        if self._heap[0][1] == job.action_id:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            run_at, action_id = heapq.heappop(self._heap)
+            job = self._jobs.get(action_id)
+            if job is None or job.run_at != run_at:
+                # Cancelled or rescheduled since it was pushed
+                continue
+            if job.interval:
+                job.run_at += job.interval
+                now = time.time()
+                if job.run_at <= now:
+                    # Skip runs missed while the bot was down
+                    job.run_at += ((now - job.run_at) // job.interval + 1) * job.interval
+                self._push(job)
+                self._dirty[action_id] = job
+            else:
+                del self._jobs[action_id]
+                self._dirty[action_id] = None
+            task = asyncio.create_task(self._fire(job.action, job.payload))
+            self._fired.add(task)
+            task.add_done_callback(self._fired.discard)
+
+    async def _fire(self, name: str, payload: Dict[str, Any]) -> None:
+        async with self._running:
+            try:
+                await self._actions[name](payload)
+                self.fired += 1
+            except Exception as e:
+                logger.error(f"Error in scheduled action {name}: {str(e)}")
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(SCHEDULER_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error saving scheduled actions: {str(e)}")
+
+    async def flush(self) -> None:
+        """Write actions scheduled, rescheduled or finished since the last flush"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        upserts = [job.row() for job in dirty.values() if job is not None]
+        deletes = [(action_id,) for action_id, job in dirty.items() if job is None]
+        try:
+            await self.storage.save_scheduled_actions(upserts, deletes)
+        except Exception:
+            # Merge back so nothing newer is overwritten, and retry next flush
+            dirty.update(self._dirty)
+            self._dirty = dirty
+            raise
@@ -0,0 +1,608 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import migrations
+from migrations import REFERRAL_LEVELS
+from storage import (Storage, Registration, CompletionInfo, DB_PATH, DB_POOL_SIZE, _record_completions, _post_ledger_entries,
+                     _apply_pending, _referral_totals, _invitees_page, _create_broadcast, _get_stats)
+
+logger = logging.getLogger(__name__)
+
+# Number of database files users are spread over; 1 keeps the single DOGE_DB_PATH file
+DB_SHARDS = int(os.environ.get('DOGE_DB_SHARDS', '1'))
+# Shard file names; {shard} is replaced by the shard number
+DB_SHARD_PATH = os.environ.get('DOGE_DB_SHARD_PATH', 'doge_world.{shard}.db')
+
+# Relay cross-shard changes at least this often (milliseconds)
+OUTBOX_INTERVAL = float(os.environ.get('DOGE_OUTBOX_FLUSH_MS', '100')) / 1000
+# Outbox rows moved per transaction
+OUTBOX_BATCH = 1000
+
+# Tables that are not partitioned by user and live on shard 0 only
+HOME_TABLES = ('broadcasts', 'broadcast_failures', 'scheduled_actions')
+# Counters added to on shard 0 and summed over every shard on read (each shard
+# starts with the backfill of its own users)
+STATS_TABLES = {'stats_counters': ('name', 'task_id'), 'stats_hourly': ('hour', 'name', 'task_id'),
+                'stats_daily': ('day', 'name', 'task_id')}
+
+
+def shard_for(user_id: int, shards: int) -> int:
+    """Shard number of a user; Fibonacci hashing spreads consecutive ids evenly"""
+    return (((user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % shards
+
+
+def shard_path(pattern: str, shard: int) -> str:
+    return pattern.format(shard=shard)
+
+
+def create_storage() -> Union[Storage, 'ShardedStorage']:
+    """Storage for the configured layout: one database file or DOGE_DB_SHARDS of them"""
+    if DB_SHARDS > 1:
+        return ShardedStorage()
+    return Storage()
+
+
+class ShardedStats:
+    """StorageStats-compatible totals over every shard"""
+
+    def __init__(self, shards: Sequence[Storage]):
+        self.shards = shards
+
+    def snapshot(self) -> dict:
+        snapshots = [shard.stats.snapshot() for shard in self.shards]
+        queries = sum(s['queries'] for s in snapshots)
+        weight = queries or 1
+        return {
+            'queries': queries,
+            'avg_query_ms': sum(s['avg_query_ms'] * s['queries'] for s in snapshots) / weight,
+            'max_query_ms': max(s['max_query_ms'] for s in snapshots),
+            'avg_pool_wait_ms': sum(s['avg_pool_wait_ms'] * s['queries'] for s in snapshots) / weight,
+            'max_pool_wait_ms': max(s['max_pool_wait_ms'] for s in snapshots),
+            'write_lock_waits': sum(s['write_lock_waits'] for s in snapshots),
+            'write_lock_wait_ms': sum(s['write_lock_wait_ms'] for s in snapshots),
+        }
+
+
+class ShardedStorage:
+    """The Storage API over several SQLite files partitioned by user_id
+
+    Each shard has its own writer, so writes for users on different shards
+    commit in parallel. A user's row, completions and closure rows live on
+    the shard their user_id hashes to; tasks are replicated to every shard
+    and broadcasts, scheduled actions and new stats counts live on shard 0.
+
+    A write that also affects a user on another shard (a referrer's bonus,
+    a late referral extending a chain) records that effect in its shard's
+    outbox in the same transaction. A background relay applies outbox rows
+    to their target shard in order, exactly once, using a per-source high
+    water mark. Referral aggregates are kept per shard for the invitees on
+    that shard and summed on read.
+    """
+
+    def __init__(self, path: str = DB_SHARD_PATH, shards: int = DB_SHARDS, pool_size: int = DB_POOL_SIZE):
+        self.path = path
+        self.shards = [Storage(shard_path(path, n), pool_size) for n in range(shards)]
+        self.home = self.shards[0]
+        self.stats = ShardedStats(self.shards)
+        self._relay_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._relay_task: Optional[asyncio.Task] = None
+        self._open = False
+        self.relayed = 0
+
+    def shard(self, user_id: int) -> Storage:
+        return self.shards[shard_for(user_id, len(self.shards))]
+
+    def _is_remote(self, shard: int):
+        return lambda user_id: shard_for(user_id, len(self.shards)) != shard
+
+    def open(self) -> None:
+        for shard in self.shards:
+            shard.open()
+        self._open = True
+
+    async def close(self) -> None:
+        """Stop the relay, deliver what is left in the outboxes and close every shard"""
+        if self._relay_task:
+            self._relay_task.cancel()
+            try:
+                await self._relay_task
+            except asyncio.CancelledError:
+                pass
+            self._relay_task = None
+        if not self._open:
+            return
+        await self.relay()
+        for shard in self.shards:
+            await shard.close()
+        self._open = False
+        logger.info(f"Closed {len(self.shards)} shards after relaying {self.relayed} changes")
+
+    async def init_db(self) -> None:
+        await asyncio.gather(*(shard.transaction(migrations.migrate, True) for shard in self.shards))
+        # Deliver anything left over from the previous run
+        await self.relay()
+
+    async def migrate_online(self) -> List[int]:
+        """Build deferred indexes on every shard, one shard at a time"""
+        applied = set()
+        for shard in self.shards:
+            for migration in await shard.read(migrations.pending, True):
+                if await shard.transaction(_apply_pending, migration, True):
+                    applied.add(migration.version)
+        return sorted(applied)
+
+    async def _gather(self, fn, *args) -> list:
+        return await asyncio.gather(*(shard.read(fn, *args) for shard in self.shards))
+
+    # Outbox relay
+
+    def _kick(self) -> None:
+        if self._relay_task is None:
+            self._relay_task = asyncio.create_task(self._run_relay())
+        self._wakeup.set()
+
+    async def _run_relay(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.relay()
+            except Exception as e:
+                logger.error(f"Error relaying cross-shard changes: {str(e)}")
+
+    async def relay(self) -> int:
+        """Apply every pending outbox row to its target shard; returns how many were moved"""
+        moved = 0
+        async with self._relay_lock:
+            for source, storage in enumerate(self.shards):
+                while True:
+                    ops = await storage.fetchall('''SELECT outbox_id, op, user_id, amount, payload FROM outbox
+                                                    ORDER BY outbox_id LIMIT ?''', (OUTBOX_BATCH,))
+                    if not ops:
+                        break
+                    targets: Dict[int, List[tuple]] = defaultdict(list)
+                    for op in ops:
+                        if op[1] == 'adopt':
+                            for target in range(len(self.shards)):
+                                targets[target].append(op)
+                        else:
+                            targets[shard_for(op[2], len(self.shards))].append(op)
+                    await asyncio.gather(*(self.shards[target].transaction(_apply_outbox, source, target_ops)
+                                           for target, target_ops in targets.items()))
+                    await storage.execute('DELETE FROM outbox WHERE outbox_id <= ?', (ops[-1][0],))
+                    moved += len(ops)
+                    if len(ops) < OUTBOX_BATCH:
+                        break
+        self.relayed += moved
+        return moved
+
+    # Domain queries used by the handlers
+
+    async def register_user(self, user_id: int, username: Optional[str],
+                            referrer_id: Optional[int]) -> Registration:
+        """Storage.register_user, validating the referrer on its own shard first"""
+        chain: Tuple[Tuple[int, int], ...] = ()
+        if referrer_id is not None and referrer_id != user_id:
+            chain = await self._referral_chain(user_id, referrer_id)
+        registration, adopted = await self.shard(user_id).transaction(
+            _register_sharded_user, user_id, username, chain)
+        if adopted:
+            self._kick()
+        return registration
+
+    async def _referral_chain(self, user_id: int, referrer_id: int) -> Tuple[Tuple[int, int], ...]:
+        """(ancestor, depth) pairs the user would join below, or () for an invalid referrer
+
+        The referrer is invalid if it does not exist or if the user is among
+        its ancestors at any depth, so the whole chain is walked even past
+        REFERRAL_LEVELS.
+        """
+        sql = 'SELECT referred_by FROM users WHERE user_id = ?'
+        row = await self.shard(referrer_id).fetchone(sql, (referrer_id,))
+        if row is None:
+            return ()
+        chain = [(referrer_id, 1)]
+        seen = {referrer_id}
+        ancestor = row[0]
+        # Stops at the top of the chain or on a loop stored before this check existed
+        while ancestor is not None and ancestor not in seen:
+            if ancestor == user_id:
+                return ()
+            seen.add(ancestor)
+            if len(chain) < REFERRAL_LEVELS:
+                chain.append((ancestor, len(chain) + 1))
+            row = await self.shard(ancestor).fetchone(sql, (ancestor,))
+            ancestor = row[0] if row else None
+        return tuple(chain)
+
+    async def complete_social_tasks(self, user_id: int) -> bool:
+        return await self.shard(user_id).complete_social_tasks(user_id)
+
+    async def get_tasks(self) -> List[tuple]:
+        return await self.home.get_tasks()
+
+    async def get_completions(self, user_id: int) -> List[Tuple[int, int]]:
+        return await self.shard(user_id).get_completions(user_id)
+
+    async def get_completion_info(self, user_id: int, task_id: int) -> Optional[CompletionInfo]:
+        return await self.shard(user_id).get_completion_info(user_id, task_id)
+
+    async def record_completions(self, events: Sequence[tuple]) -> List[tuple]:
+        """Write each shard's share of the batch in parallel, one transaction per shard"""
+        by_shard: Dict[int, List[tuple]] = defaultdict(list)
+        for event in events:
+            by_shard[shard_for(event[0], len(self.shards))].append(event)
+        recorded = await asyncio.gather(*(
+            self.shards[shard].transaction(_record_completions, shard_events, self._is_remote(shard))
+            for shard, shard_events in by_shard.items()))
+        self._kick()
+        return [event for shard_events in recorded for event in shard_events]
+
+    async def get_scores(self) -> List[Tuple[int, Optional[str], int]]:
+        scores = []
+        for rows in await asyncio.gather(*(shard.get_scores() for shard in self.shards)):
+            scores.extend(rows)
+        return scores
+
+    async def get_referral_summary(self, user_id: int) -> Optional[dict]:
+        row = await self.shard(user_id).fetchone('SELECT referred_by FROM users WHERE user_id = ?', (user_id,))
+        if row is None:
+            return None
+        referrer = None
+        if row[0] is not None:
+            referrer = await self.shard(row[0]).fetchone('SELECT user_id, username FROM users WHERE user_id = ?',
+                                                         (row[0],))
+        summary = {'referrer': referrer, 'invitees': 0, 'invitee_points': 0, 'bonus_earned': 0, 'levels': {}}
+        for totals in await self._gather(_referral_totals, user_id):
+            for key in ('invitees', 'invitee_points', 'bonus_earned'):
+                summary[key] += totals[key]
+            for depth, count in totals['levels'].items():
+                summary['levels'][depth] = summary['levels'].get(depth, 0) + count
+        summary['levels'] = dict(sorted(summary['levels'].items()))
+        return summary
+
+    async def get_invitees_page(self, referrer_id: int, after: Optional[int] = None,
+                                before: Optional[int] = None, limit: int = 20) -> dict:
+        """Merge each shard's keyset page into one"""
+        pages = await self._gather(_invitees_page, referrer_id, after, before, limit)
+        rows = sorted(row for page in pages for row in page['invitees'])
+        has_prev = any(page['has_prev'] for page in pages)
+        has_next = any(page['has_next'] for page in pages)
+        if before is not None:
+            has_prev = has_prev or len(rows) > limit
+            rows = rows[-limit:]
+        else:
+            has_next = has_next or len(rows) > limit
+            rows = rows[:limit]
+        return {'total': sum(page['total'] for page in pages), 'invitees': rows,
+                'has_prev': has_prev, 'has_next': has_next}
+
+    async def add_task(self, task_name: str, task_description: str, doge_reward: int,
+                       schedule: str = 'once', starts_at: Optional[float] = None,
+                       ends_at: Optional[float] = None) -> None:
+        """Add the task on shard 0 and copy it, with the same task_id, to the others"""
+        task = (task_name, task_description, doge_reward, schedule, starts_at, ends_at)
+        task_id = await self.home.transaction(lambda conn: conn.execute(
+            '''INSERT INTO tasks (task_name, task_description, doge_reward, schedule, starts_at, ends_at)
+               VALUES (?, ?, ?, ?, ?, ?)''', task).lastrowid)
+        await asyncio.gather(*(shard.execute('''INSERT OR REPLACE INTO tasks (task_id, task_name, task_description,
+                                                                              doge_reward, schedule, starts_at, ends_at)
+                                                VALUES (?, ?, ?, ?, ?, ?, ?)''', (task_id,) + task)
+                               for shard in self.shards[1:]))
+
+    async def import_tasks(self, tasks: Sequence[tuple]) -> List[int]:
+        """Import on shard 0 and copy the new tasks, with the same task ids, to the others"""
+        task_ids = await self.home.import_tasks(tasks)
+        rows = [(task_id,) + tuple(task) for task_id, task in zip(task_ids, tasks)]
+        await asyncio.gather(*(shard.executemany('''INSERT OR REPLACE INTO tasks (task_id, task_name,
+                                                                                  task_description, doge_reward,
+                                                                                  schedule, starts_at, ends_at)
+                                                    VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+                               for shard in self.shards[1:]))
+        return task_ids
+
+    async def remove_task(self, task_id: int) -> Optional[tuple]:
+        removed = await asyncio.gather(*(shard.remove_task(task_id) for shard in self.shards))
+        return removed[0]
+
+    async def get_users_after(self, after_user_id: int, limit: int) -> List[tuple]:
+        pages = await asyncio.gather(*(shard.get_users_after(after_user_id, limit) for shard in self.shards))
+        return sorted((user for page in pages for user in page), key=lambda user: user[0])[:limit]
+
+    async def get_user_ids_after(self, after_user_id: int, limit: int) -> List[int]:
+        pages = await asyncio.gather(*(shard.get_user_ids_after(after_user_id, limit) for shard in self.shards))
+        return sorted(user_id for page in pages for user_id in page)[:limit]
+
+    async def create_broadcast(self, message: str, admin_chat_id: int) -> int:
+        counts = await asyncio.gather(*(shard.fetchone('SELECT COUNT(*) FROM users') for shard in self.shards))
+        return await self.home.transaction(_create_broadcast, message, admin_chat_id,
+                                           sum(count for count, in counts))
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[dict]:
+        return await self.home.get_broadcast(broadcast_id)
+
+    async def get_running_broadcast_ids(self) -> List[int]:
+        return await self.home.get_running_broadcast_ids()
+
+    async def checkpoint_broadcast(self, broadcast_id: int, last_user_id: int, sent: int,
+                                   failed: int, blocked: int, failures: Sequence[tuple]) -> None:
+        await self.home.checkpoint_broadcast(broadcast_id, last_user_id, sent, failed, blocked, failures)
+
+    async def set_broadcast_status(self, broadcast_id: int, status: str) -> None:
+        await self.home.set_broadcast_status(broadcast_id, status)
+
+    async def set_broadcast_progress_message(self, broadcast_id: int, message_id: int) -> None:
+        await self.home.set_broadcast_progress_message(broadcast_id, message_id)
+
+    async def add_stats(self, increments: Sequence[tuple]) -> None:
+        await self.home.add_stats(increments)
+
+    async def get_stats(self, since_hour: int, since_day: int) -> Dict[str, List[tuple]]:
+        """Every shard's stats, summed per counter and bucket"""
+        merged: Dict[str, Dict[tuple, int]] = defaultdict(lambda: defaultdict(int))
+        for stats in await self._gather(_get_stats, since_hour, since_day):
+            for kind, rows in stats.items():
+                for *key, value in rows:
+                    merged[kind][tuple(key)] += value
+        return {kind: [key + (merged[kind][key],) for key in merged[kind]]
+                for kind in ('totals', 'hourly', 'daily')}
+
+    async def get_scheduled_actions(self) -> List[tuple]:
+        return await self.home.get_scheduled_actions()
+
+    async def save_scheduled_actions(self, upserts: Sequence[tuple], deletes: Sequence[tuple]) -> None:
+        await self.home.save_scheduled_actions(upserts, deletes)
+
+
+def _register_sharded_user(conn: sqlite3.Connection, user_id: int, username: Optional[str],
+                           chain: Sequence[Tuple[int, int]]) -> tuple:
+    referrer_id = chain[0][0] if chain else None
+    now = time.time()
+    # As in Storage.register_user, the times tell what this call changed
+    social_tasks_completed, referred_by, created_at, referred_at = conn.execute(
+        '''INSERT INTO users (user_id, username, referred_by, social_tasks_completed, created_at, referred_at)
+           VALUES (?, ?, ?, FALSE, ?, ?)
+           ON CONFLICT (user_id) DO UPDATE
+               SET referred_by = COALESCE(users.referred_by, excluded.referred_by),
+                   referred_at = CASE WHEN users.referred_by IS NULL THEN excluded.referred_at
+                                      ELSE users.referred_at END
+           RETURNING social_tasks_completed, referred_by, created_at, referred_at''',
+        (user_id, username, referrer_id, now, now if referrer_id is not None else None)).fetchall()[0]
+    created = created_at == now
+    referred = referred_by is not None and referred_at == now
+    adopted = False
+    if referred and REFERRAL_LEVELS > 1:
+        # The referral was just recorded: the user joins below the referrer's chain...
+        conn.executemany('INSERT OR IGNORE INTO referral_closure (ancestor, descendant, depth) VALUES (?, ?, ?)',
+                         [(ancestor, user_id, depth) for ancestor, depth in chain])
+        if not created:
+            # ...and so do the users they had already invited, on any shard
+            conn.execute("INSERT INTO outbox (op, user_id, payload) VALUES ('adopt', ?, ?)",
+                         (user_id, json.dumps(chain)))
+            adopted = True
+    return Registration(bool(social_tasks_completed), referred_by, created, referred), adopted
+
+
+def _apply_outbox(conn: sqlite3.Connection, source: int, ops: Sequence[tuple]) -> None:
+    row = conn.execute('SELECT last_id FROM outbox_applied WHERE source = ?', (source,)).fetchone()
+    last_id = row[0] if row else 0
+    ops = [op for op in ops if op[0] > last_id]
+    if not ops:
+        return
+    c = conn.cursor()
+    _post_ledger_entries(c, [(user_id, amount, *(json.loads(payload) if payload else ('referral', None, None)))
+                             for _, op, user_id, amount, payload in ops if op == 'points'])
+    for _, op, user_id, _, payload in ops:
+        if op == 'adopt':
+            descendants = c.execute('SELECT descendant, depth FROM referral_closure WHERE ancestor = ?',
+                                    (user_id,)).fetchall()
+            c.executemany('INSERT OR IGNORE INTO referral_closure (ancestor, descendant, depth) VALUES (?, ?, ?)',
+                          [(ancestor, descendant, depth + below)
+                           for ancestor, depth in json.loads(payload)
+                           for descendant, below in descendants
+                           if depth + below <= REFERRAL_LEVELS and ancestor != descendant])
+    c.execute('''INSERT INTO outbox_applied (source, last_id) VALUES (?, ?)
+                 ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id''', (source, ops[-1][0]))
+
+
+# Offline re-sharding
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [name for _, name, *_ in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _has_table(conn: sqlite3.Connection, table: str) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def _copy_table(sources: Sequence[sqlite3.Connection], targets: Sequence[sqlite3.Connection], table: str,
+                key: Optional[str], chunk: int = 10000, skip: Sequence[str] = ()) -> int:
+    """Stream a table from every source into the shard its key column hashes to
+
+    With no key, rows from every source go to every target (replicated
+    tables) or, for HOME_TABLES, to shard 0 only. Columns in skip are left
+    for the target to assign.
+    """
+    columns = [column for column in _columns(targets[0], table)
+               if column in _columns(sources[0], table) and column not in skip]
+    insert = f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    position = columns.index(key) if key else None
+    copied = 0
+    for source in sources:
+        if not _has_table(source, table):
+            continue
+        buffers: Dict[int, List[tuple]] = defaultdict(list)
+        for row in source.execute(f"SELECT {', '.join(columns)} FROM {table}"):
+            if position is not None:
+                destinations = (shard_for(row[position], len(targets)),)
+            elif table in HOME_TABLES:
+                destinations = (0,)
+            else:
+                destinations = range(len(targets))
+            for shard in destinations:
+                buffers[shard].append(row)
+                if len(buffers[shard]) >= chunk:
+                    targets[shard].executemany(insert, buffers.pop(shard))
+            copied += 1
+        for shard, rows in buffers.items():
+            targets[shard].executemany(insert, rows)
+    return copied
+
+
+def _merge_counters(sources: Sequence[sqlite3.Connection], target: sqlite3.Connection, table: str,
+                    key: Sequence[str]) -> int:
+    """Add every source's counter rows into target, summing rows with the same key"""
+    columns = ', '.join(tuple(key) + ('value',))
+    upsert = (f"INSERT INTO {table} ({columns}) VALUES ({', '.join('?' * (len(key) + 1))}) "
+              f"ON CONFLICT ({', '.join(key)}) DO UPDATE SET value = value + excluded.value")
+    merged = 0
+    for source in sources:
+        if not _has_table(source, table):
+            continue
+        rows = source.execute(f"SELECT {columns} FROM {table}").fetchall()
+        target.executemany(upsert, rows)
+        merged += len(rows)
+    return merged
+
+
+def reshard(sources: Sequence[str], target_pattern: str, shards: int, force: bool = False) -> Dict[str, int]:
+    """Split one database (or an existing set of shards) into shards new files
+
+    Users, completions (with their streaks and period history) and closure
+    rows are routed by user_id, tasks are copied to every shard and
+    broadcasts and scheduled actions to shard 0, where the stats counters
+    of every source are also summed.
+    Referral aggregates are rebuilt for each shard by the referral triggers
+    as users are copied, keeping each referrer's bonus total on their own
+    shard. The bot must be stopped and the source outboxes empty.
+    """
+    paths = [shard_path(target_pattern, n) for n in range(shards)]
+    if len(set(paths)) != shards:
+        raise ValueError(f"Target pattern {target_pattern!r} must contain {{shard}}")
+    for path in paths:
+        if os.path.exists(path):
+            if not force:
+                raise FileExistsError(f"{path} already exists (use --force to replace it)")
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    source_conns = [sqlite3.connect(f'file:{path}?mode=ro', uri=True) for path in sources]
+    target_conns = [sqlite3.connect(path, isolation_level=None) for path in paths]
+    try:
+        for path, conn in zip(sources, source_conns):
+            if _has_table(conn, 'outbox') and conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]:
+                raise RuntimeError(f"{path} still has undelivered cross-shard changes; start and stop the bot first")
+        for conn in target_conns:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('BEGIN IMMEDIATE')
+            migrations.migrate(conn, True, online=True)
+            conn.execute('DELETE FROM tasks')
+
+        counts = {
+            'tasks': _copy_table(source_conns[:1], target_conns, 'tasks', None),
+            'users': _copy_table(source_conns, target_conns, 'users', 'user_id'),
+            'completed_tasks': _copy_table(source_conns, target_conns, 'completed_tasks', 'user_id'),
+            'task_period_completions': _copy_table(source_conns, target_conns, 'task_period_completions',
+                                                   'user_id'),
+            'referral_closure': _copy_table(source_conns, target_conns, 'referral_closure', 'descendant'),
+            'points_ledger': _copy_table(source_conns, target_conns, 'points_ledger', 'user_id', skip=('entry_id',)),
+        }
+        # Balances the copied ledger does not account for (sources from before
+        # the ledger existed) are carried over as opening entries
+        for conn in target_conns:
+            conn.execute('''INSERT INTO points_ledger (user_id, delta, reason, created_at)
+                            SELECT u.user_id, u.doge_points - COALESCE(l.total, 0), 'opening', ?
+                            FROM users u LEFT JOIN (SELECT user_id, SUM(delta) AS total FROM points_ledger
+                                                    GROUP BY user_id) l ON l.user_id = u.user_id
+                            WHERE u.doge_points != COALESCE(l.total, 0)''', (time.time(),))
+        for table in HOME_TABLES:
+            counts[table] = _copy_table(source_conns[:1], target_conns, table, None)
+        for table, key in STATS_TABLES.items():
+            counts[table] = _merge_counters(source_conns, target_conns[0], table, key)
+
+        # Counts and invitee points were rebuilt by the triggers; bonuses are
+        # only known per referrer, so each total goes to the referrer's shard
+        bonuses: Dict[int, int] = defaultdict(int)
+        for conn in source_conns:
+            if _has_table(conn, 'referral_stats'):
+                for user_id, bonus in conn.execute('SELECT user_id, bonus_earned FROM referral_stats'):
+                    bonuses[user_id] += bonus or 0
+        for user_id, bonus in bonuses.items():
+            if bonus:
+                target_conns[shard_for(user_id, shards)].execute(
+                    '''INSERT INTO referral_stats (user_id, bonus_earned) VALUES (?, ?)
+                       ON CONFLICT (user_id) DO UPDATE SET bonus_earned = bonus_earned + excluded.bonus_earned''',
+                    (user_id, bonus))
+
+        for conn in target_conns:
+            conn.execute('COMMIT')
+        return counts
+    except BaseException:
+        for conn in target_conns:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+        raise
+    finally:
+        for conn in source_conns + target_conns:
+            conn.close()
+
+
+def shard_info(pattern: str, shards: int) -> List[dict]:
+    info = []
+    for n in range(shards):
+        conn = sqlite3.connect(f'file:{shard_path(pattern, n)}?mode=ro', uri=True)
+        try:
+            info.append({
+                'shard': n,
+                'users': conn.execute('SELECT COUNT(*) FROM users').fetchone()[0],
+                'completed_tasks': conn.execute('SELECT COUNT(*) FROM completed_tasks').fetchone()[0],
+                'outbox': conn.execute('SELECT COUNT(*) FROM outbox').fetchone()[0],
+            })
+        finally:
+            conn.close()
+    return info
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Split the Doge World database into user_id shards")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    split = commands.add_parser('reshard', help="copy a database (or a set of shards) into new shard files")
+    split.add_argument('--source', action='append',
+                       help=f"source database; repeat for every existing shard (default: {DB_PATH})")
+    split.add_argument('--shards', type=int, default=DB_SHARDS, help="number of target shards")
+    split.add_argument('--target', default=DB_SHARD_PATH, help="target file pattern containing {shard}")
+    split.add_argument('--force', action='store_true', help="replace existing target files")
+
+    show = commands.add_parser('info', help="row counts per shard")
+    show.add_argument('--shards', type=int, default=DB_SHARDS)
+    show.add_argument('--target', default=DB_SHARD_PATH)
+
+    args = parser.parse_args(argv)
+    if args.command == 'info':
+        for row in shard_info(args.target, args.shards):
+            print(row)
+        return
+
+    started = time.perf_counter()
+    counts = reshard(args.source or [DB_PATH], args.target, args.shards, args.force)
+    print(f"Resharded into {args.shards} files matching {args.target} in {time.perf_counter() - started:.1f}s")
+    for table, count in counts.items():
+        print(f"  {table:<20} {count}")
+    print(f"Start the bot with DOGE_DB_SHARDS={args.shards} DOGE_DB_SHARD_PATH='{args.target}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Write buffered counts to the database this often (seconds)
+STATS_FLUSH_INTERVAL = float(os.environ.get('DOGE_STATS_FLUSH_S', '10'))
+
+# Tasks listed in the /stats funnels, most completed first
+STATS_TASKS_SHOWN = 15
+
+# Counter names; the per-task ones are keyed by task_id, the others by 0
+STARTS = 'starts'                      # /start commands
+USERS = 'users'                        # users registered
+REFERRED_USERS = 'referred_users'      # users whose referrer was recorded
+SOCIAL_COMPLETED = 'social_completed'  # users who finished the social tasks
+TASK_VIEWS = 'task_views'              # task lists shown
+POINTS_ISSUED = 'points_issued'        # points awarded, referral bonuses included
+TASK_SHOWN = 'task_shown'              # task lists the task was offered in
+TASK_TAPS = 'task_taps'                # taps on the task's button, repeats included
+TASK_COMPLETIONS = 'task_completions'  # completions of the task
+
+HOUR = 3600
+DAY = 86400
+
+
+class StatsCounters:
+    """Write-behind counters for the admin /stats command
+
+    Handlers count events in memory; every STATS_FLUSH_INTERVAL the counts
+    are added to the totals and to the current hourly and daily rollups in
+    one transaction. Only increments are ever written, so several worker
+    processes can count into the same tables. A report reads the totals and
+    the recent buckets by primary key and adds what this process has not
+    flushed yet; counts from other processes show up after their next flush.
+    """
+
+    def __init__(self, storage, flush_interval: float = STATS_FLUSH_INTERVAL,
+                 clock: Callable[[], float] = time.time):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.clock = clock
+        # hour -> (name, task_id) -> count
+        self._pending: Dict[int, Dict[Tuple[str, int], int]] = defaultdict(lambda: defaultdict(int))
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+
+    def start(self) -> None:
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Stop the background flusher and write what is still buffered"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def incr(self, name: str, task_id: int = 0, amount: int = 1) -> None:
+        hour = int(self.clock()) // HOUR * HOUR
+        self._pending[hour][name, task_id] += amount
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing stats counters: {str(e)}")
+
+    async def flush(self) -> None:
+        """Add every buffered count to the database in one transaction"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, defaultdict(lambda: defaultdict(int))
+            increments = [(name, task_id, hour, amount)
+                          for hour, counts in pending.items()
+                          for (name, task_id), amount in counts.items()]
+            try:
+                await self.storage.add_stats(increments)
+            except Exception:
+                # Keep the counts and try again with the next flush
+                for name, task_id, hour, amount in increments:
+                    self._pending[hour][name, task_id] += amount
+                raise
+            self.flushes += 1
+
+    async def report(self, hours: int = 24, days: int = 7) -> 'StatsReport':
+        """Totals plus the last hours hourly and days daily buckets, unflushed counts included"""
+        now = int(self.clock())
+        since_hour = now // HOUR * HOUR - (hours - 1) * HOUR
+        since_day = now // DAY * DAY - (days - 1) * DAY
+        stored = await self.storage.get_stats(since_hour, since_day)
+        report = StatsReport(now)
+        for name, task_id, value in stored['totals']:
+            report.totals[name, task_id] += value
+        for hour, name, task_id, value in stored['hourly']:
+            report.hourly[hour][name, task_id] += value
+        for day, name, task_id, value in stored['daily']:
+            report.daily[day][name, task_id] += value
+        for hour, counts in list(self._pending.items()):
+            for key, amount in counts.items():
+                report.totals[key] += amount
+                if hour >= since_hour:
+                    report.hourly[hour][key] += amount
+                if hour >= since_day:
+                    report.daily[hour // DAY * DAY][key] += amount
+        return report
+
+
+class StatsReport:
+    """Counter totals and rollups as read for one /stats reply"""
+
+    def __init__(self, now: int):
+        self.now = now
+        self.totals: Dict[Tuple[str, int], int] = defaultdict(int)
+        self.hourly: Dict[int, Dict[Tuple[str, int], int]] = defaultdict(lambda: defaultdict(int))
+        self.daily: Dict[int, Dict[Tuple[str, int], int]] = defaultdict(lambda: defaultdict(int))
+
+    def total(self, name: str, task_id: int = 0) -> int:
+        return self.totals.get((name, task_id), 0)
+
+    def today(self, name: str, task_id: int = 0) -> int:
+        return self.daily.get(self.now // DAY * DAY, {}).get((name, task_id), 0)
+
+    def last_hour(self, name: str, task_id: int = 0) -> int:
+        return self.hourly.get(self.now // HOUR * HOUR, {}).get((name, task_id), 0)
+
+    def last_hours(self, name: str, task_id: int = 0) -> int:
+        """Sum over every hourly bucket read"""
+        return sum(counts.get((name, task_id), 0) for counts in self.hourly.values())
+
+    def task_ids(self) -> List[int]:
+        """Tasks with any count, most completed first"""
+        task_ids = {task_id for name, task_id in self.totals if task_id}
+        return sorted(task_ids, key=lambda task_id: (-self.total(TASK_COMPLETIONS, task_id), task_id))
+
+
+def _share(part: int, whole: int) -> str:
+    return f"{part / whole:.0%}" if whole else "-"
+
+
+def render(report: StatsReport, task_names: Dict[int, str]) -> str:
+    """Plain-text /stats reply: users, onboarding, points, daily history and task funnels"""
+    users = report.total(USERS)
+    onboarded = report.total(SOCIAL_COMPLETED)
+    lines = [
+        "📊 Doge World stats (UTC)",
+        "",
+        f"Users: {users} (+{report.today(USERS)} today, +{report.last_hour(USERS)} this hour)",
+        f"Referred: {report.total(REFERRED_USERS)} ({_share(report.total(REFERRED_USERS), users)} of users)",
+        f"Social tasks done: {onboarded} ({_share(onboarded, users)} of users, "
+        f"+{report.today(SOCIAL_COMPLETED)} today)",
+        f"/start: {report.today(STARTS)} today, {report.last_hours(STARTS)} in 24h",
+        f"Points issued: {report.total(POINTS_ISSUED)} (+{report.today(POINTS_ISSUED)} today, "
+        f"+{report.last_hour(POINTS_ISSUED)} this hour)",
+        "",
+        "Day         new users  social  completions  points",
+    ]
+    for day in sorted(report.daily, reverse=True):
+        counts = report.daily[day]
+        completions = sum(value for (name, _), value in counts.items() if name == TASK_COMPLETIONS)
+        lines.append(f"{time.strftime('%Y-%m-%d', time.gmtime(day))}  {counts.get((USERS, 0), 0):>9}  "
+                     f"{counts.get((SOCIAL_COMPLETED, 0), 0):>6}  {completions:>11}  "
+                     f"{counts.get((POINTS_ISSUED, 0), 0):>6}")
+
+    task_ids = report.task_ids()
+    if task_ids:
+        lines += ["", "Task funnels: shown → tapped → completed (share of onboarded users)"]
+        for task_id in task_ids[:STATS_TASKS_SHOWN]:
+            shown = report.total(TASK_SHOWN, task_id)
+            taps = report.total(TASK_TAPS, task_id)
+            completions = report.total(TASK_COMPLETIONS, task_id)
+            name = task_names.get(task_id, 'removed')
+            lines.append(f"#{task_id} {name[:30]}: {shown} → {taps} ({_share(taps, shown)}) → "
+                         f"{completions} ({_share(completions, taps)}), {_share(completions, onboarded)}; "
+                         f"+{report.today(TASK_COMPLETIONS, task_id)} today")
+        if len(task_ids) > STATS_TASKS_SHOWN:
+            lines.append(f"...and {len(task_ids) - STATS_TASKS_SHOWN} more")
+    return "\n".join(lines)
@@ -0,0 +1,650 @@
+import sqlite3
+import asyncio
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import metrics
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# Path of the SQLite database file
+DB_PATH = os.environ.get('DOGE_DB_PATH', 'doge_world.db')
+
+# Number of pooled connections (and executor threads)
+DB_POOL_SIZE = int(os.environ.get('DOGE_DB_POOL_SIZE', '4'))
+
+# Applied once to every connection when the pool is opened
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-16000',     # ~16 MB page cache per connection
+    'PRAGMA mmap_size=268435456',   # 256 MB of memory-mapped I/O
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA busy_timeout=5000',
+)
+
+
+SQL_LATENCY = metrics.histogram('doge_sql_seconds', 'SQLite statement latency', ('statement',))
+
+# Hourly stats rollups older than this are deleted as new ones are written
+STATS_HOURLY_RETENTION = float(os.environ.get('DOGE_STATS_HOURLY_DAYS', '14')) * 86400
+
+
+class Registration(NamedTuple):
+    social_tasks_completed: bool
+    referred_by: Optional[int]
+    created: bool        # the user did not exist before
+    referred: bool       # the referrer was recorded by this call
+
+
+class CompletionInfo(NamedTuple):
+    doge_reward: int
+    schedule: str
+    starts_at: Optional[float]
+    ends_at: Optional[float]
+    period: Optional[int]      # last period the user completed the task in, None if never
+    streak: int                # consecutive periods ending with that one
+    referrer_id: Optional[int]
+
+
+@functools.lru_cache(maxsize=1024)
+def _statement_key(sql: str) -> str:
+    return ' '.join(sql.split())[:120]
+
+
+class _TimedCursor(sqlite3.Cursor):
+    def execute(self, sql: str, parameters: Sequence = ()) -> sqlite3.Cursor:
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            SQL_LATENCY.labels(_statement_key(sql)).observe(time.perf_counter() - started)
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Sequence]) -> sqlite3.Cursor:
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            SQL_LATENCY.labels(_statement_key(sql)).observe(time.perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements are timed into SQL_LATENCY, keyed by statement text"""
+
+    def cursor(self, factory=_TimedCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Sequence = ()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Iterable[Sequence]) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class StorageStats:
+    """Running totals for pool wait, writer lock wait and query time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.query_time = 0.0
+        self.max_query_time = 0.0
+        self.pool_wait_time = 0.0
+        self.max_pool_wait = 0.0
+        self.write_lock_waits = 0
+        self.write_lock_wait_time = 0.0
+
+    def record(self, pool_wait: float, query_time: float) -> None:
+        with self._lock:
+            self.queries += 1
+            self.query_time += query_time
+            self.pool_wait_time += pool_wait
+            if query_time > self.max_query_time:
+                self.max_query_time = query_time
+            if pool_wait > self.max_pool_wait:
+                self.max_pool_wait = pool_wait
+
+    def record_write_lock(self, waited: float) -> None:
+        with self._lock:
+            self.write_lock_waits += 1
+            self.write_lock_wait_time += waited
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            queries = self.queries or 1
+            return {
+                'queries': self.queries,
+                'avg_query_ms': self.query_time / queries * 1000,
+                'max_query_ms': self.max_query_time * 1000,
+                'avg_pool_wait_ms': self.pool_wait_time / queries * 1000,
+                'max_pool_wait_ms': self.max_pool_wait * 1000,
+                'write_lock_waits': self.write_lock_waits,
+                'write_lock_wait_ms': self.write_lock_wait_time * 1000,
+            }
+
+
+class Storage:
+    """Pool of long-lived SQLite connections used from a dedicated executor
+
+    Every query runs on one of the executor threads so the event loop never
+    blocks on disk I/O or SQLite locks. Writes are serialised in-process so
+    they queue on a lock instead of spinning in SQLite's busy handler.
+    """
+
+    def __init__(self, path: str = DB_PATH, pool_size: int = DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self.stats = StorageStats()
+        self._pool: queue.LifoQueue = queue.LifoQueue()
+        self._connections: List[sqlite3.Connection] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._write_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                               factory=TimedConnection)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def open(self) -> None:
+        """Open the pooled connections and start the executor"""
+        if self._executor:
+            return
+        for _ in range(self.pool_size):
+            conn = self._connect()
+            self._connections.append(conn)
+            self._pool.put(conn)
+        self._executor = ThreadPoolExecutor(max_workers=self.pool_size,
+                                            thread_name_prefix='doge-db')
+        logger.info(f"Opened storage pool with {self.pool_size} connections to {self.path}")
+
+    async def close(self) -> None:
+        """Stop the executor and close every pooled connection"""
+        if not self._executor:
+            return
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        for conn in self._connections:
+            conn.close()
+        self._connections.clear()
+        self._pool = queue.LifoQueue()
+        logger.info(f"Closed storage pool: {self.stats.snapshot()}")
+
+    def _run(self, submitted: float, write: bool, fn: Callable, args: tuple) -> Any:
+        conn = self._pool.get()
+        started = time.perf_counter()
+        try:
+            if not write:
+                return fn(conn, *args)
+            self._write_lock.acquire()
+            locked = time.perf_counter()
+            self.stats.record_write_lock(locked - started)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    result = fn(conn, *args)
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+                conn.execute('COMMIT')
+                return result
+            finally:
+                self._write_lock.release()
+        finally:
+            self.stats.record(started - submitted, time.perf_counter() - started)
+            self._pool.put(conn)
+
+    async def _submit(self, write: bool, fn: Callable, *args) -> Any:
+        if not self._executor:
+            raise RuntimeError("Storage is not open")
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self._run, time.perf_counter(), write, fn, args)
+        return await loop.run_in_executor(self._executor, call)
+
+    async def read(self, fn: Callable, *args) -> Any:
+        """Run fn(conn, *args) on a pooled connection outside a transaction"""
+        return await self._submit(False, fn, *args)
+
+    async def transaction(self, fn: Callable, *args) -> Any:
+        """Run fn(conn, *args) inside a single write transaction"""
+        return await self._submit(True, fn, *args)
+
+    async def fetchone(self, sql: str, params: Sequence = ()) -> Optional[tuple]:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Sequence = ()) -> List[tuple]:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: Sequence = ()) -> int:
+        """Execute a single write statement and return the affected row count"""
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params: Iterable[Sequence]) -> int:
+        return await self.transaction(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def init_db(self) -> None:
+        """Initialize the database with required tables"""
+        await self.transaction(migrations.migrate)
+
+    async def migrate_online(self) -> List[int]:
+        """Build the indexes deferred by init_db, one per transaction
+
+        SQLite cannot build an index without holding the write lock, so each
+        one blocks writers (not readers) only for its own build.
+        """
+        applied = []
+        for migration in await self.read(migrations.pending, True):
+            if await self.transaction(_apply_pending, migration):
+                applied.append(migration.version)
+        return applied
+
+    # Domain queries used by the handlers
+
+    async def register_user(self, user_id: int, username: Optional[str],
+                            referrer_id: Optional[int]) -> Registration:
+        """Create the user if needed and set their referrer if they have none yet
+
+        The referrer is only accepted if it is an existing user other than the
+        user themselves and the user is not among its ancestors (at any depth),
+        so referrals never form a loop.
+        """
+        return await self.transaction(_register_user, user_id, username, referrer_id)
+
+    async def complete_social_tasks(self, user_id: int) -> bool:
+        """Mark the user's social tasks done; False if they already were"""
+        return await self.execute('''UPDATE users SET social_tasks_completed = ?
+                                     WHERE user_id = ? AND NOT social_tasks_completed''',
+                                  (True, user_id)) > 0
+
+    async def get_tasks(self) -> List[tuple]:
+        """(task_id, task_name, task_description, doge_reward, schedule, starts_at, ends_at) rows"""
+        return await self.fetchall('''SELECT task_id, task_name, task_description, doge_reward,
+                                             schedule, starts_at, ends_at
+                                      FROM tasks ORDER BY task_id''')
+
+    async def get_completions(self, user_id: int) -> List[Tuple[int, int]]:
+        """(task_id, period) of the last completion of every task the user has completed
+
+        One primary-key range read, however many periods the user has
+        completed recurring tasks in.
+        """
+        return await self.fetchall('SELECT task_id, period FROM completed_tasks WHERE user_id = ?', (user_id,))
+
+    async def get_completion_info(self, user_id: int, task_id: int) -> Optional[CompletionInfo]:
+        """The task's reward and schedule with the user's last completion of it, or None for an unknown task"""
+        row = await self.fetchone('''SELECT t.doge_reward, t.schedule, t.starts_at, t.ends_at, c.period,
+                                          COALESCE(c.streak, 0),
+                                          (SELECT referred_by FROM users WHERE user_id = ?)
+                                   FROM tasks t
+                                   LEFT JOIN completed_tasks c ON c.user_id = ? AND c.task_id = t.task_id
+                                   WHERE t.task_id = ?''',
+                                  (user_id, user_id, task_id))
+        if row is None:
+            return None
+        return CompletionInfo(*row)
+
+    async def record_completions(self, events: Sequence[tuple]) -> List[tuple]:
+        """Write a batch of (user_id, task_id, doge_reward, referrer_id, period) completions
+
+        Completions that are repeated in the batch or already recorded for
+        their period are skipped without awarding points again. Returns the
+        completions actually recorded, in the same form.
+        """
+        return await self.transaction(_record_completions, events)
+
+    async def get_scores(self) -> List[Tuple[int, Optional[str], int]]:
+        """Return (user_id, username, doge_points) for every user"""
+        return await self.fetchall('SELECT user_id, username, doge_points FROM users '
+                                   'ORDER BY doge_points DESC, user_id')
+
+    async def get_referral_summary(self, user_id: int) -> Optional[dict]:
+        """Referrer, invitee aggregates and deeper level counts for a user, or None if unknown"""
+        return await self.read(_referral_summary, user_id)
+
+    async def get_invitees_page(self, referrer_id: int, after: Optional[int] = None,
+                                before: Optional[int] = None, limit: int = 20) -> dict:
+        """Keyset page of a referrer's invitees ordered by user_id
+
+        Pages forward from after, or backward from before, and reports the
+        invitee total and whether there are more invitees on either side.
+        """
+        return await self.read(_invitees_page, referrer_id, after, before, limit)
+
+    async def add_task(self, task_name: str, task_description: str, doge_reward: int,
+                       schedule: str = 'once', starts_at: Optional[float] = None,
+                       ends_at: Optional[float] = None) -> None:
+        await self.execute('''INSERT INTO tasks (task_name, task_description, doge_reward,
+                                                schedule, starts_at, ends_at)
+                              VALUES (?, ?, ?, ?, ?, ?)''',
+                           (task_name, task_description, doge_reward, schedule, starts_at, ends_at))
+
+    async def import_tasks(self, tasks: Sequence[tuple]) -> List[int]:
+        """Insert (task_name, task_description, doge_reward, schedule, starts_at, ends_at) rows
+        in one transaction and return their task ids"""
+        return await self.transaction(_import_tasks, tasks)
+
+    async def remove_task(self, task_id: int) -> Optional[tuple]:
+        """Delete a task, returning its row, or None if there was no such task
+
+        Completions of the task and the points they earned are kept.
+        """
+        rows = await self.transaction(lambda conn: conn.execute(
+            '''DELETE FROM tasks WHERE task_id = ?
+               RETURNING task_id, task_name, task_description, doge_reward''', (task_id,)).fetchall())
+        return rows[0] if rows else None
+
+    async def get_users_after(self, after_user_id: int, limit: int) -> List[tuple]:
+        """Keyset page of (user_id, username, referred_by, doge_points, social_tasks_completed) rows"""
+        return await self.fetchall('''SELECT user_id, username, referred_by, doge_points, social_tasks_completed
+                                      FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?''',
+                                   (after_user_id, limit))
+
+    async def get_user_ids_after(self, after_user_id: int, limit: int) -> List[int]:
+        """Keyset page of user ids greater than after_user_id"""
+        rows = await self.fetchall('SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?',
+                                   (after_user_id, limit))
+        return [user_id for user_id, in rows]
+
+    async def create_broadcast(self, message: str, admin_chat_id: int) -> int:
+        return await self.transaction(_create_broadcast, message, admin_chat_id)
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[dict]:
+        row = await self.fetchone('''SELECT broadcast_id, message, admin_chat_id, progress_message_id,
+                                          status, last_user_id, total, sent, failed, blocked
+                                   FROM broadcasts WHERE broadcast_id = ?''', (broadcast_id,))
+        if row is None:
+            return None
+        return dict(zip(('broadcast_id', 'message', 'admin_chat_id', 'progress_message_id',
+                         'status', 'last_user_id', 'total', 'sent', 'failed', 'blocked'), row))
+
+    async def get_running_broadcast_ids(self) -> List[int]:
+        rows = await self.fetchall("SELECT broadcast_id FROM broadcasts WHERE status = 'running'")
+        return [broadcast_id for broadcast_id, in rows]
+
+    async def checkpoint_broadcast(self, broadcast_id: int, last_user_id: int, sent: int,
+                                   failed: int, blocked: int, failures: Sequence[tuple]) -> None:
+        """Advance a broadcast's cursor and record the outcome of one page"""
+        await self.transaction(_checkpoint_broadcast, broadcast_id, last_user_id,
+                               sent, failed, blocked, failures)
+
+    async def set_broadcast_status(self, broadcast_id: int, status: str) -> None:
+        await self.execute('UPDATE broadcasts SET status = ?, updated_at = ? WHERE broadcast_id = ?',
+                           (status, time.time(), broadcast_id))
+
+    async def set_broadcast_progress_message(self, broadcast_id: int, message_id: int) -> None:
+        await self.execute('UPDATE broadcasts SET progress_message_id = ? WHERE broadcast_id = ?',
+                           (message_id, broadcast_id))
+
+    async def add_stats(self, increments: Sequence[tuple]) -> None:
+        """Add (name, task_id, hour, amount) increments to the stats totals and rollups"""
+        await self.transaction(_add_stats, increments)
+
+    async def get_stats(self, since_hour: int, since_day: int) -> Dict[str, List[tuple]]:
+        """Stats totals, hourly rollups from since_hour and daily rollups from since_day
+
+        Only primary-key ranges are read, so the cost depends on the number of
+        counters and buckets, never on the number of users.
+        """
+        return await self.read(_get_stats, since_hour, since_day)
+
+    async def get_scheduled_actions(self) -> List[tuple]:
+        """Pending (action_id, run_at, action, payload, interval) rows"""
+        return await self.fetchall('SELECT action_id, run_at, action, payload, interval FROM scheduled_actions')
+
+    async def save_scheduled_actions(self, upserts: Sequence[tuple], deletes: Sequence[tuple]) -> None:
+        await self.transaction(_save_scheduled_actions, upserts, deletes)
+
+
+def _register_user(conn: sqlite3.Connection, user_id: int, username: Optional[str],
+                   referrer_id: Optional[int]) -> Registration:
+    now = time.time()
+    # One statement: insert or touch the user, keep an existing referrer and
+    # return the onboarding state. created_at and referred_at only take this
+    # call's time if it created the user or recorded the referrer.
+    social_tasks_completed, referred_by, created_at, referred_at = conn.execute(
+        '''INSERT INTO users (user_id, username, referred_by, social_tasks_completed, created_at, referred_at)
+           SELECT :user_id, :username, referrer.user_id, FALSE, :now,
+                  CASE WHEN referrer.user_id IS NOT NULL THEN :now END
+           FROM (SELECT (SELECT user_id FROM users
+                         WHERE user_id = :referrer_id AND user_id != :user_id
+                           AND :user_id NOT IN (
+                               -- The referrer's ancestors; UNION stops on loops already stored
+                               WITH RECURSIVE ancestors (user_id) AS (
+                                   SELECT referred_by FROM users WHERE user_id = :referrer_id
+                                   UNION
+                                   SELECT u.referred_by FROM users u JOIN ancestors a ON u.user_id = a.user_id)
+                               SELECT user_id FROM ancestors WHERE user_id IS NOT NULL)) AS user_id) AS referrer
+           WHERE TRUE
+           ON CONFLICT (user_id) DO UPDATE
+               SET referred_by = COALESCE(users.referred_by, excluded.referred_by),
+                   referred_at = CASE WHEN users.referred_by IS NULL THEN excluded.referred_at
+                                      ELSE users.referred_at END
+           RETURNING social_tasks_completed, referred_by, created_at, referred_at''',
+        {'user_id': user_id, 'username': username, 'referrer_id': referrer_id, 'now': now}).fetchall()[0]
+    return Registration(bool(social_tasks_completed), referred_by, created_at == now,
+                        referred_by is not None and referred_at == now)
+
+
+def _record_completions(conn: sqlite3.Connection, events: Sequence[tuple],
+                        is_remote: Optional[Callable[[int], bool]] = None) -> List[tuple]:
+    c = conn.cursor()
+
+    # Stage the batch, dropping anything that is already recorded for its period
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS completion_batch (
+        user_id INTEGER,
+        task_id INTEGER,
+        doge_reward INTEGER,
+        referrer_id INTEGER,
+        period INTEGER,
+        PRIMARY KEY (user_id, task_id)
+    )''')
+    c.execute('DELETE FROM completion_batch')
+    c.executemany('''INSERT OR IGNORE INTO completion_batch (user_id, task_id, doge_reward, referrer_id, period)
+                     VALUES (?, ?, ?, ?, ?)''', events)
+    c.execute('''DELETE FROM completion_batch WHERE EXISTS
+                 (SELECT 1 FROM completed_tasks t
+                  WHERE t.user_id = completion_batch.user_id AND t.task_id = completion_batch.task_id
+                    AND t.period >= completion_batch.period)''')
+    recorded = c.execute('''SELECT user_id, task_id, doge_reward, referrer_id, period
+                            FROM completion_batch''').fetchall()
+
+    # Mark tasks as completed for the period, extending the streak if the
+    # last completion was in the period before
+    c.execute('''INSERT INTO completed_tasks (user_id, task_id, period, streak, best_streak)
+                 SELECT user_id, task_id, period, 1, 1 FROM completion_batch WHERE TRUE
+                 ON CONFLICT (user_id, task_id) DO UPDATE
+                     SET period = excluded.period,
+                         streak = CASE WHEN period = excluded.period - 1 THEN streak + 1 ELSE 1 END,
+                         best_streak = MAX(best_streak,
+                                           CASE WHEN period = excluded.period - 1 THEN streak + 1 ELSE 1 END)''')
+    c.execute('''INSERT INTO task_period_completions (user_id, task_id, period, completed_at)
+                 SELECT user_id, task_id, period, ? FROM completion_batch WHERE period != 0''', (time.time(),))
+
+    # Award points to users and half to their referrers through the ledger
+    entries = []
+    remote = []
+    for user_id, task_id, doge_reward, referrer_id, _ in recorded:
+        entries.append((user_id, doge_reward, 'task', task_id, None))
+        if referrer_id is None:
+            continue
+        if is_remote is not None and is_remote(referrer_id):
+            # Referrers stored in another database get their points through the outbox
+            remote.append((referrer_id, doge_reward // 2, json.dumps(('referral', task_id, user_id))))
+        else:
+            entries.append((referrer_id, doge_reward // 2, 'referral', task_id, user_id))
+    if remote:
+        c.executemany("INSERT INTO outbox (op, user_id, amount, payload) VALUES ('points', ?, ?, ?)", remote)
+    _post_ledger_entries(c, entries)
+    c.execute('''UPDATE referral_stats SET bonus_earned = bonus_earned + b.bonus
+                 FROM (SELECT referrer_id, SUM(doge_reward / 2) AS bonus FROM completion_batch
+                       WHERE referrer_id IS NOT NULL
+                       GROUP BY referrer_id) AS b
+                 WHERE referral_stats.user_id = b.referrer_id''')
+    c.execute('DELETE FROM completion_batch')
+    return recorded
+
+
+def _post_ledger_entries(c: sqlite3.Cursor, entries: Sequence[tuple]) -> None:
+    """Append (user_id, delta, reason, task_id, source_user_id) entries and apply them to balances"""
+    if not entries:
+        return
+    last = c.execute('SELECT COALESCE(MAX(entry_id), 0) FROM points_ledger').fetchone()[0]
+    now = time.time()
+    c.executemany('''INSERT INTO points_ledger (user_id, delta, reason, task_id, source_user_id, created_at)
+                     VALUES (?, ?, ?, ?, ?, ?)''', [entry + (now,) for entry in entries])
+    _stage_point_deltas(c)
+    c.execute('''INSERT INTO completion_deltas (user_id, delta)
+                 SELECT user_id, SUM(delta) FROM points_ledger WHERE entry_id > ?
+                 GROUP BY user_id''', (last,))
+    _apply_point_deltas(c)
+
+
+def _stage_point_deltas(c: sqlite3.Cursor) -> None:
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS completion_deltas (
+        user_id INTEGER PRIMARY KEY,
+        delta INTEGER
+    )''')
+    c.execute('DELETE FROM completion_deltas')
+
+
+def _apply_point_deltas(c: sqlite3.Cursor) -> None:
+    """Add staged completion_deltas to users and to their referrers' aggregates"""
+    c.execute('''UPDATE users SET doge_points = doge_points + d.delta
+                 FROM completion_deltas AS d
+                 WHERE users.user_id = d.user_id''')
+    c.execute('''UPDATE referral_stats SET invitee_points = invitee_points + d.delta
+                 FROM (SELECT u.referred_by AS user_id, SUM(d.delta) AS delta
+                       FROM completion_deltas d JOIN users u ON u.user_id = d.user_id
+                       WHERE u.referred_by IS NOT NULL
+                       GROUP BY u.referred_by) AS d
+                 WHERE referral_stats.user_id = d.user_id''')
+    c.execute('DELETE FROM completion_deltas')
+
+
+def _import_tasks(conn: sqlite3.Connection, tasks: Sequence[tuple]) -> List[int]:
+    # AUTOINCREMENT ids only grow, so everything above the old maximum is new
+    last = conn.execute('SELECT COALESCE(MAX(task_id), 0) FROM tasks').fetchone()[0]
+    conn.executemany('''INSERT INTO tasks (task_name, task_description, doge_reward, schedule, starts_at, ends_at)
+                        VALUES (?, ?, ?, ?, ?, ?)''', tasks)
+    return [task_id for task_id, in conn.execute('SELECT task_id FROM tasks WHERE task_id > ? ORDER BY task_id',
+                                                  (last,))]
+
+
+def _apply_pending(conn: sqlite3.Connection, migration: migrations.Migration, sharded: bool = False) -> bool:
+    # Another process may have applied it since the pending list was read
+    if migration.version in migrations.applied_versions(conn):
+        return False
+    migrations.apply(conn, migration, sharded)
+    return True
+
+
+def _referral_summary(conn: sqlite3.Connection, user_id: int) -> Optional[dict]:
+    row = conn.execute('''SELECT r.user_id, r.username FROM users u
+                          LEFT JOIN users r ON r.user_id = u.referred_by
+                          WHERE u.user_id = ?''', (user_id,)).fetchone()
+    if row is None:
+        return None
+    referrer_id, referrer_username = row
+    summary = _referral_totals(conn, user_id)
+    summary['referrer'] = (referrer_id, referrer_username) if referrer_id is not None else None
+    return summary
+
+
+def _referral_totals(conn: sqlite3.Connection, user_id: int) -> dict:
+    row = conn.execute('''SELECT invitees, invitee_points, bonus_earned FROM referral_stats
+                          WHERE user_id = ?''', (user_id,)).fetchone()
+    invitees, invitee_points, bonus_earned = row or (0, 0, 0)
+    levels = conn.execute('''SELECT depth, COUNT(*) FROM referral_closure
+                             WHERE ancestor = ? AND depth > 1
+                             GROUP BY depth ORDER BY depth''', (user_id,)).fetchall()
+    return {
+        'invitees': invitees,
+        'invitee_points': invitee_points,
+        'bonus_earned': bonus_earned,
+        'levels': dict(levels),
+    }
+
+
+def _invitees_page(conn: sqlite3.Connection, referrer_id: int, after: Optional[int],
+                   before: Optional[int], limit: int) -> dict:
+    if before is not None:
+        rows = conn.execute('''SELECT user_id, username, doge_points FROM users
+                               WHERE referred_by = ? AND user_id < ?
+                               ORDER BY user_id DESC LIMIT ?''', (referrer_id, before, limit)).fetchall()
+        rows.reverse()
+    else:
+        rows = conn.execute('''SELECT user_id, username, doge_points FROM users
+                               WHERE referred_by = ? AND user_id > ?
+                               ORDER BY user_id LIMIT ?''', (referrer_id, after or 0, limit)).fetchall()
+    total = conn.execute('SELECT invitees FROM referral_stats WHERE user_id = ?', (referrer_id,)).fetchone()
+    has_prev = has_next = False
+    if rows:
+        has_prev = conn.execute('SELECT EXISTS(SELECT 1 FROM users WHERE referred_by = ? AND user_id < ?)',
+                                (referrer_id, rows[0][0])).fetchone()[0]
+        has_next = conn.execute('SELECT EXISTS(SELECT 1 FROM users WHERE referred_by = ? AND user_id > ?)',
+                                (referrer_id, rows[-1][0])).fetchone()[0]
+    return {'total': total[0] if total else 0, 'invitees': rows,
+            'has_prev': bool(has_prev), 'has_next': bool(has_next)}
+
+
+def _create_broadcast(conn: sqlite3.Connection, message: str, admin_chat_id: int,
+                      total: Optional[int] = None) -> int:
+    c = conn.cursor()
+    if total is None:
+        c.execute('SELECT COUNT(*) FROM users')
+        total = c.fetchone()[0]
+    now = time.time()
+    c.execute('''INSERT INTO broadcasts (message, admin_chat_id, total, started_at, updated_at)
+                 VALUES (?, ?, ?, ?, ?)''', (message, admin_chat_id, total, now, now))
+    return c.lastrowid
+
+
+def _checkpoint_broadcast(conn: sqlite3.Connection, broadcast_id: int, last_user_id: int,
+                          sent: int, failed: int, blocked: int, failures: Sequence[tuple]) -> None:
+    c = conn.cursor()
+    c.execute('''UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?,
+                 blocked = blocked + ?, updated_at = ? WHERE broadcast_id = ?''',
+              (last_user_id, sent, failed, blocked, time.time(), broadcast_id))
+    c.executemany('''INSERT OR REPLACE INTO broadcast_failures (broadcast_id, user_id, reason)
+                     VALUES (?, ?, ?)''', failures)
+
+
+def _add_stats(conn: sqlite3.Connection, increments: Sequence[tuple]) -> None:
+    c = conn.cursor()
+    c.executemany('''INSERT INTO stats_counters (name, task_id, value) VALUES (?, ?, ?)
+                     ON CONFLICT (name, task_id) DO UPDATE SET value = value + excluded.value''',
+                  [(name, task_id, amount) for name, task_id, _, amount in increments])
+    c.executemany('''INSERT INTO stats_hourly (hour, name, task_id, value) VALUES (?, ?, ?, ?)
+                     ON CONFLICT (hour, name, task_id) DO UPDATE SET value = value + excluded.value''',
+                  [(hour, name, task_id, amount) for name, task_id, hour, amount in increments])
+    c.executemany('''INSERT INTO stats_daily (day, name, task_id, value) VALUES (?, ?, ?, ?)
+                     ON CONFLICT (day, name, task_id) DO UPDATE SET value = value + excluded.value''',
+                  [(hour - hour % 86400, name, task_id, amount) for name, task_id, hour, amount in increments])
+    c.execute('DELETE FROM stats_hourly WHERE hour < ?', (time.time() - STATS_HOURLY_RETENTION,))
+
+
+def _get_stats(conn: sqlite3.Connection, since_hour: int, since_day: int) -> Dict[str, List[tuple]]:
+    return {
+        'totals': conn.execute('SELECT name, task_id, value FROM stats_counters').fetchall(),
+        'hourly': conn.execute('SELECT hour, name, task_id, value FROM stats_hourly WHERE hour >= ?',
+                               (since_hour,)).fetchall(),
+        'daily': conn.execute('SELECT day, name, task_id, value FROM stats_daily WHERE day >= ?',
+                              (since_day,)).fetchall(),
+    }
+
+
+def _save_scheduled_actions(conn: sqlite3.Connection, upserts: Sequence[tuple],
+                            deletes: Sequence[tuple]) -> None:
+    c = conn.cursor()
+    c.executemany('''INSERT OR REPLACE INTO scheduled_actions (action_id, run_at, action, payload, interval)
+                     VALUES (?, ?, ?, ?, ?)''', upserts)
+    c.executemany('DELETE FROM scheduled_actions WHERE action_id = ?', deletes)
@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import task_schedule
+
+# Memory budget for cached per-user completion sets
+TASK_CACHE_MEMORY_MB = float(os.environ.get('DOGE_TASK_CACHE_MB', '64'))
+
+# Distinct task keyboards kept ready to send (one per set of remaining tasks)
+TASK_KEYBOARD_CACHE_SIZE = 1024
+
+# Approximate cost of one cached user besides its bitset: OrderedDict slot
+# and link node and the user_id key. The bitset's size depends on the
+# highest task id, so the cache is sized again whenever the catalog loads.
+CACHE_ENTRY_OVERHEAD = 140
+
+
+class TaskCatalog:
+    """In-memory copy of the tasks table with pre-rendered keyboard rows
+
+    Only tasks inside their availability window are offered. The set of
+    offered tasks is worked out again, lazily, the first time the catalog
+    is used after the next window opens or closes.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._tasks: Dict[int, tuple] = {}
+        self._all_rows: List[Tuple[int, List[InlineKeyboardButton]]] = []
+        # Recurring tasks only; every other task is completed once
+        self._schedules: Dict[int, str] = {}
+        self._rows: List[Tuple[int, List[InlineKeyboardButton]]] = []
+        self._mask = 0
+        self._open_until = float('inf')
+        self._markups: Dict[int, Optional[InlineKeyboardMarkup]] = {}
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def load(self, tasks: Iterable[tuple]) -> None:
+        """Replace the catalog with (task_id, task_name, task_description, doge_reward,
+        schedule, starts_at, ends_at) rows"""
+        catalog = {}
+        rows = []
+        schedules = {}
+        for task in tasks:
+            task_id, task_name, _, doge_reward, schedule, _, ends_at = task
+            catalog[task_id] = task
+            button_text = f"{task_name} - {doge_reward} Doge Points"
+            if schedule in task_schedule.SCHEDULE_LABELS:
+                schedules[task_id] = schedule
+                button_text += f" {task_schedule.SCHEDULE_LABELS[schedule]}"
+            if ends_at is not None:
+                button_text += f" ⏳ until {task_schedule.format_time(ends_at)} UTC"
+            rows.append((task_id, [InlineKeyboardButton(button_text, callback_data=f'task_{task_id}')]))
+        # Swap every structure at once so readers never see a half-built catalog
+        self._tasks, self._all_rows, self._schedules = catalog, rows, schedules
+        self._open_until = float('-inf')
+        self._refresh()
+
+    def _refresh(self) -> None:
+        """Recompute the offered tasks if a window has opened or closed since the last time"""
+        now = self.clock()
+        if now < self._open_until:
+            return
+        rows = []
+        mask = 0
+        open_until = float('inf')
+        for task_id, row in self._all_rows:
+            _, _, _, _, _, starts_at, ends_at = self._tasks[task_id]
+            if task_schedule.is_open(starts_at, ends_at, now):
+                rows.append((task_id, row))
+                mask |= 1 << task_id
+            for boundary in (starts_at, ends_at):
+                if boundary is not None and boundary > now:
+                    open_until = min(open_until, boundary)
+        self._rows, self._mask, self._open_until, self._markups = rows, mask, open_until, {}
+
+    def get(self, task_id: int) -> Optional[tuple]:
+        return self._tasks.get(task_id)
+
+    @property
+    def max_task_id(self) -> int:
+        """Highest task id in the catalog (0 when empty), which sets the size of completion bitsets"""
+        return max(self._tasks, default=0)
+
+    def schedule_of(self, task_id: int) -> str:
+        return self._schedules.get(task_id, task_schedule.ONCE)
+
+    def period_of(self, task_id: int, now: Optional[float] = None) -> int:
+        """Current period of the task (0 for one-time and unknown tasks)"""
+        return task_schedule.period_of(self.schedule_of(task_id), self.clock() if now is None else now)
+
+    def completed_bits(self, completions: Iterable[Tuple[int, int]]) -> Tuple[int, float]:
+        """Bitset of the tasks done for now from (task_id, period) rows, and when it goes stale
+
+        A recurring task counts only if its last completion is in the current
+        period, and the bitset is stale from the end of the earliest such
+        period; older completions are simply due again.
+        """
+        now = self.clock()
+        completed = 0
+        expires = float('inf')
+        for task_id, period in completions:
+            schedule = self._schedules.get(task_id)
+            if schedule is None:
+                completed |= 1 << task_id
+            elif period == task_schedule.period_of(schedule, now):
+                completed |= 1 << task_id
+                expires = min(expires, task_schedule.period_end(schedule, period))
+        return completed, expires
+
+    def keyboard_for(self, completed: int) -> List[List[InlineKeyboardButton]]:
+        """Keyboard rows for every offered task whose bit is not set in completed"""
+        self._refresh()
+        return [row for task_id, row in self._rows if not (completed >> task_id) & 1]
+
+    def task_ids_left(self, completed: int) -> List[int]:
+        """Ids of the offered tasks whose bit is not set in completed, in catalog order"""
+        self._refresh()
+        return [task_id for task_id, _ in self._rows if not (completed >> task_id) & 1]
+
+    def markup_for(self, completed: int) -> Optional[InlineKeyboardMarkup]:
+        """Shared reply markup for the tasks left after completed, or None if there are none
+
+        Most users have completed one of a few task combinations, so markups
+        are cached by the remaining-task bitset instead of being rebuilt.
+        """
+        self._refresh()
+        remaining = self._mask & ~completed
+        markups = self._markups
+        if remaining in markups:
+            return markups[remaining]
+        keyboard = self.keyboard_for(completed)
+        markup = InlineKeyboardMarkup(keyboard) if keyboard else None
+        if len(markups) >= TASK_KEYBOARD_CACHE_SIZE:
+            markups.clear()
+        markups[remaining] = markup
+        return markup
+
+
+class CompletionCache:
+    """LRU of each user's completed task ids, stored as an int bitset
+
+    Bit n of a user's entry is set once task n is completed (in the current
+    period, for a recurring task). An entry holding a recurring completion
+    also records when that period ends; the first lookup after that drops
+    the entry, so it is read again and the task is offered again. The
+    number of cached users is bounded by the configured memory budget,
+    given the bitset size fit_task_ids() was last called with.
+    """
+
+    def __init__(self, memory_mb: float = TASK_CACHE_MEMORY_MB, clock: Callable[[], float] = time.time):
+        self.memory_bytes = int(memory_mb * 1024 * 1024)
+        self.clock = clock
+        self._entries: 'OrderedDict[int, int]' = OrderedDict()
+        # Only users whose entry holds a recurring completion
+        self._expires: Dict[int, float] = {}
+        self._loading: Dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.rollovers = 0
+        self.fit_task_ids(0)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _current(self, user_id: int) -> Optional[int]:
+        completed = self._entries.get(user_id)
+        if completed is not None and user_id in self._expires and self.clock() >= self._expires[user_id]:
+            del self._entries[user_id]
+            del self._expires[user_id]
+            self.rollovers += 1
+            return None
+        return completed
+
+    def get(self, user_id: int) -> Optional[int]:
+        completed = self._current(user_id)
+        if completed is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return completed
+
+    def has(self, user_id: int, task_id: int) -> bool:
+        completed = self._current(user_id)
+        return completed is not None and bool((completed >> task_id) & 1)
+
+    def fit_task_ids(self, max_task_id: int) -> None:
+        """Bound the number of cached users for bitsets up to max_task_id, evicting if needed"""
+        self.entry_bytes = CACHE_ENTRY_OVERHEAD + sys.getsizeof(1 << max_task_id)
+        self.max_entries = max(self.memory_bytes // self.entry_bytes, 1)
+        while len(self._entries) > self.max_entries:
+            self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        evicted, _ = self._entries.popitem(last=False)
+        self._expires.pop(evicted, None)
+        self.evictions += 1
+
+    def begin_load(self, user_id: int) -> None:
+        """Start tracking completions made while the user's set is read from the DB"""
+        self._loading.setdefault(user_id, 0)
+
+    def end_load(self, user_id: int) -> None:
+        """Stop tracking completions for the user, whether or not their set was loaded"""
+        self._loading.pop(user_id, None)
+
+    def finish_load(self, user_id: int, completed: int, expires: float = float('inf')) -> int:
+        """Cache the loaded bitset, stale from expires, merged with completions made during the load"""
+        completed |= self._loading.pop(user_id, 0)
+        expires = min(expires, self._expires.get(user_id, expires))
+        self._entries[user_id] = completed
+        self._entries.move_to_end(user_id)
+        if expires != float('inf'):
+            self._expires[user_id] = expires
+        if len(self._entries) > self.max_entries:
+            self._evict_oldest()
+        return completed
+
+    def mark(self, user_id: int, task_id: int, expires: float = float('inf')) -> None:
+        """Record a completion for a cached (or currently loading) user, done until expires"""
+        if user_id in self._entries:
+            self._entries[user_id] |= 1 << task_id
+        elif user_id in self._loading:
+            self._loading[user_id] |= 1 << task_id
+        else:
+            return
+        if expires != float('inf'):
+            self._expires[user_id] = min(expires, self._expires.get(user_id, expires))
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._entries),
+            'max_users': self.max_entries,
+            'entry_bytes': self.entry_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'rollovers': self.rollovers,
+        }
@@ -0,0 +1,155 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+from typing import Any, Iterable, List, Sequence, Set, Tuple
+
+import task_schedule
+
+# Largest task document /importtasks accepts (bytes)
+TASK_IMPORT_MAX_BYTES = int(os.environ.get('DOGE_TASK_IMPORT_MAX_BYTES', str(1024 * 1024)))
+# Users read from the database per /exportusers chunk
+EXPORT_CHUNK = int(os.environ.get('DOGE_EXPORT_CHUNK', '5000'))
+
+TASK_FIELDS = ('task_name', 'task_description', 'doge_reward')
+# Optional; a task without them is offered from now on and completed once
+SCHEDULE_FIELDS = ('schedule', 'starts_at', 'ends_at')
+USER_FIELDS = ('user_id', 'username', 'referred_by', 'doge_points', 'social_tasks_completed')
+
+# Task names become button labels, so keep them short
+MAX_TASK_NAME = 64
+MAX_TASK_DESCRIPTION = 1000
+MAX_TASK_REWARD = 1_000_000
+
+
+def parse_task_document(data: bytes, filename: str = '') -> List[Tuple[int, Any]]:
+    """Read a CSV or JSON task document into (row number, record) pairs
+
+    CSV needs a header row naming task_name, task_description and
+    doge_reward, and may add schedule, starts_at and ends_at (other
+    columns, such as an exported task_id, are ignored).
+    JSON is a list of objects with the same keys, or {"tasks": [...]}.
+    Raises ValueError if the document as a whole cannot be read.
+    """
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError("the document is not UTF-8 text")
+
+    if filename.lower().endswith('.json') or text.lstrip()[:1] in ('[', '{'):
+        try:
+            document = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON at line {e.lineno}: {e.msg}")
+        if isinstance(document, dict):
+            document = document.get('tasks')
+        if not isinstance(document, list):
+            raise ValueError('expected a JSON list of tasks or {"tasks": [...]}')
+        return list(enumerate(document, 1))
+
+    reader = csv.DictReader(io.StringIO(text))
+    missing = [field for field in TASK_FIELDS if field not in (reader.fieldnames or ())]
+    if missing:
+        raise ValueError(f"CSV header is missing {', '.join(missing)}")
+    # Row numbers match the line numbers shown by spreadsheets (the header is row 1)
+    return [(reader.line_num, record) for record in reader]
+
+
+def _validate_task(record: Any) -> tuple:
+    if not isinstance(record, dict):
+        raise ValueError("expected an object with task_name, task_description and doge_reward")
+    task_name = record.get('task_name')
+    task_description = record.get('task_description')
+    doge_reward = record.get('doge_reward')
+
+    if not isinstance(task_name, str) or not task_name.strip():
+        raise ValueError("task_name is empty")
+    task_name = task_name.strip()
+    if len(task_name) > MAX_TASK_NAME:
+        raise ValueError(f"task_name is longer than {MAX_TASK_NAME} characters")
+    if task_description is None:
+        task_description = ''
+    if not isinstance(task_description, str):
+        raise ValueError("task_description must be text")
+    task_description = task_description.strip()
+    if len(task_description) > MAX_TASK_DESCRIPTION:
+        raise ValueError(f"task_description is longer than {MAX_TASK_DESCRIPTION} characters")
+    if isinstance(doge_reward, str):
+        try:
+            doge_reward = int(doge_reward.strip())
+        except ValueError:
+            raise ValueError(f"doge_reward {doge_reward!r} is not a whole number")
+    if isinstance(doge_reward, bool) or not isinstance(doge_reward, int):
+        raise ValueError("doge_reward must be a whole number")
+    if not 0 <= doge_reward <= MAX_TASK_REWARD:
+        raise ValueError(f"doge_reward must be between 0 and {MAX_TASK_REWARD}")
+    schedule = record.get('schedule')
+    if schedule is not None and not isinstance(schedule, str):
+        raise ValueError(f"schedule must be one of {', '.join(task_schedule.SCHEDULES)}")
+    return (task_name, task_description, doge_reward) + task_schedule.validate(
+        schedule, record.get('starts_at'), record.get('ends_at'))
+
+
+def validate_tasks(records: Iterable[Tuple[int, Any]],
+                   existing_names: Set[str]) -> Tuple[List[tuple], List[Tuple[int, str]]]:
+    """Split records into insertable (task_name, task_description, doge_reward, schedule, starts_at,
+    ends_at) rows and (row, error) pairs
+
+    Names that already exist, or repeat earlier in the document, are
+    reported rather than inserted twice, so re-importing a document only
+    adds what is new.
+    """
+    rows = []
+    errors = []
+    seen = set(existing_names)
+    for row_number, record in records:
+        try:
+            task = _validate_task(record)
+        except ValueError as e:
+            errors.append((row_number, str(e)))
+            continue
+        if task[0] in seen:
+            errors.append((row_number, f"a task named {task[0]!r} already exists"))
+            continue
+        seen.add(task[0])
+        rows.append(task)
+    return rows, errors
+
+
+def tasks_document(tasks: Sequence[tuple], fmt: str = 'csv') -> bytes:
+    """Serialise get_tasks() rows for /exporttasks, with window times as UTC dates"""
+    fields = ('task_id',) + TASK_FIELDS + SCHEDULE_FIELDS
+    tasks = [task[:5] + (task_schedule.format_time(task[5]), task_schedule.format_time(task[6]))
+             for task in tasks]
+    if fmt == 'json':
+        return json.dumps({'tasks': [dict(zip(fields, task)) for task in tasks]},
+                          ensure_ascii=False, indent=2).encode('utf-8')
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    writer.writerows(tasks)
+    return buffer.getvalue().encode('utf-8')
+
+
+async def export_users(storage, path: str, chunk: int = EXPORT_CHUNK) -> int:
+    """Stream every user into a gzipped CSV file one keyset page at a time
+
+    Only one page is held in memory, and each page is written from a
+    worker thread so the event loop keeps serving updates. Returns the
+    number of users written.
+    """
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(USER_FIELDS)
+        after = 0
+        while True:
+            page = await storage.get_users_after(after, chunk)
+            if not page:
+                break
+            await asyncio.to_thread(writer.writerows, page)
+            count += len(page)
+            after = page[-1][0]
+    return count
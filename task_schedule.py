@@ -0,0 +1,125 @@
+import time
+from datetime import datetime, timezone
+from typing import Any, List, Optional, Sequence, Tuple
+
+# How often a task can be completed again; periods start at 00:00 UTC, and
+# weeks on Monday
+ONCE = 'once'
+DAILY = 'daily'
+WEEKLY = 'weekly'
+SCHEDULES = (ONCE, DAILY, WEEKLY)
+
+DAY = 86400
+WEEK = 7 * DAY
+# The unix epoch was a Thursday; shifting by three days makes weeks start on Monday
+WEEK_SHIFT = 3 * DAY
+
+# Shown after the reward on a recurring task's button
+SCHEDULE_LABELS = {DAILY: '🔁 daily', WEEKLY: '🔁 weekly'}
+STREAK_UNITS = {DAILY: 'day', WEEKLY: 'week'}
+ALREADY_COMPLETED = {
+    ONCE: "You have already completed this task.",
+    DAILY: "You have already completed this task today. It is back at 00:00 UTC.",
+    WEEKLY: "You have already completed this task this week. It is back on Monday at 00:00 UTC.",
+}
+
+TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+
+def period_of(schedule: str, now: float) -> int:
+    """Number of the period now falls in; always 0 for one-time tasks
+
+    Day and week numbers count from the epoch, so a recurring task's
+    period is never 0 and one-time completions never look like a past period.
+    """
+    if schedule == DAILY:
+        return int(now // DAY)
+    if schedule == WEEKLY:
+        return int((now + WEEK_SHIFT) // WEEK)
+    return 0
+
+
+def period_end(schedule: str, period: int) -> float:
+    """When a period ends, or infinity for one-time tasks"""
+    if schedule == DAILY:
+        return (period + 1) * DAY
+    if schedule == WEEKLY:
+        return (period + 1) * WEEK - WEEK_SHIFT
+    return float('inf')
+
+
+def next_streak(last_period: Optional[int], streak: int, period: int) -> int:
+    """Streak after completing in period, given the last period completed and the streak it ended"""
+    return streak + 1 if last_period is not None and last_period == period - 1 else 1
+
+
+def is_open(starts_at: Optional[float], ends_at: Optional[float], now: float) -> bool:
+    """Whether now falls inside a task's availability window (either end may be open)"""
+    return (starts_at is None or starts_at <= now) and (ends_at is None or now < ends_at)
+
+
+def parse_time(value: Any) -> Optional[float]:
+    """Unix time from a number or an ISO date/time (UTC unless it has an offset); None if empty"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"{value!r} is not a date")
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if text.endswith('Z'):
+        text = text[:-1]
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"{value!r} is not a date such as 2025-01-31 or 2025-01-31T18:00")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def format_time(timestamp: Optional[float]) -> str:
+    """UTC date and time in a form parse_time reads back; empty for None"""
+    if timestamp is None:
+        return ''
+    return time.strftime(TIME_FORMAT, time.gmtime(timestamp))
+
+
+def validate(schedule: Any, starts_at: Any, ends_at: Any) -> Tuple[str, Optional[float], Optional[float]]:
+    """Normalised (schedule, starts_at, ends_at); raises ValueError for invalid values"""
+    schedule = (schedule or ONCE).strip().lower() if isinstance(schedule, str) else schedule or ONCE
+    if schedule not in SCHEDULES:
+        raise ValueError(f"schedule must be one of {', '.join(SCHEDULES)}")
+    starts_at = parse_time(starts_at)
+    ends_at = parse_time(ends_at)
+    if starts_at is not None and ends_at is not None and ends_at <= starts_at:
+        raise ValueError("the task must end after it starts")
+    return schedule, starts_at, ends_at
+
+
+def split_options(args: Sequence[str]) -> Tuple[List[str], str, Optional[float], Optional[float]]:
+    """Take trailing schedule options off /addtask arguments
+
+    Options are daily, weekly or once, from=<date> and until=<date>.
+    Returns the remaining arguments and the validated schedule and window.
+    """
+    args = list(args)
+    schedule, starts_at, ends_at = ONCE, None, None
+    while args:
+        option = args[-1]
+        if option.lower() in SCHEDULES:
+            schedule = option.lower()
+        elif option.lower().startswith('from='):
+            starts_at = option[5:]
+        elif option.lower().startswith('until='):
+            ends_at = option[6:]
+        else:
+            break
+        args.pop()
+    return (args,) + validate(schedule, starts_at, ends_at)
@@ -0,0 +1,244 @@
+import argparse
+import functools
+import os
+import time
+import tracemalloc
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import metrics
+
+# Characters with a meaning in Telegram's (legacy) Markdown parse mode
+MARKDOWN_SPECIAL = str.maketrans({'_': '\\_', '*': '\\*', '`': '\\`', '[': '\\['})
+
+# Shown instead of a username for users who have none
+ANONYMOUS_NAME = 'Anonymous Doge'
+
+# Messages whose current content is remembered to skip edits that change nothing
+SHOWN_CONTENT_SIZE = int(os.environ.get('DOGE_SHOWN_CONTENT_SIZE', '100000'))
+
+NAVIGATION_EDITS = metrics.counter('doge_navigation_edits_total',
+                                   'In-place view changes by what was sent',
+                                   ('kind',))
+
+BACK_BUTTON = InlineKeyboardButton("⬅️ Back", callback_data='main_menu')
+BACK_MARKUP = InlineKeyboardMarkup([[BACK_BUTTON]])
+
+
+@functools.lru_cache(maxsize=65536)
+def escape_markdown(text: str) -> str:
+    """Escape text so Markdown messages show it literally (usernames often contain _)"""
+    return text.translate(MARKDOWN_SPECIAL)
+
+
+def display_name(username: Optional[str]) -> str:
+    """Escaped username for a Markdown message"""
+    return escape_markdown(username) if username else ANONYMOUS_NAME
+
+
+def mention(username: Optional[str]) -> str:
+    """Escaped @username for a Markdown message"""
+    return '@' + escape_markdown(username) if username else ANONYMOUS_NAME
+
+
+def _literal(text: str) -> str:
+    # Static text inserted into a str.format template
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+class MessageTemplates:
+    """Static messages and keyboards, built once and shared by every user
+
+    Per-user messages are compiled into str.format templates whose only
+    field is the user id, so rendering one is a single formatting step.
+    InlineKeyboardMarkup objects are immutable and reused as-is. Call
+    compile() again if the bot username or social links change.
+    """
+
+    def __init__(self, bot_username: str, social_links: Dict[str, str]):
+        self.compile(bot_username, social_links)
+
+    def compile(self, bot_username: str, social_links: Dict[str, str]) -> None:
+        referral_link = _literal(f"https://t.me/{bot_username}?start=") + '{user_id}'
+
+        social_tasks = (
+            "👋 *Welcome to Doge World!* 🐕\n\n"
+            "To start earning Doge Points, please join our social accounts:\n\n"
+            "1. Follow us on Twitter\n"
+            "2. Join our Telegram channel\n"
+            "3. Join our Telegram group\n"
+            "4. Join our Discord server\n\n"
+            "Click the buttons below to join:"
+        )
+        social_tasks_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🐦 Follow us on Twitter", url=social_links['twitter'])],
+            [InlineKeyboardButton("📢 Join our Telegram channel", url=social_links['telegram_channel'])],
+            [InlineKeyboardButton("👥 Join our Telegram group", url=social_links['telegram_group'])],
+            [InlineKeyboardButton("🎮 Join our Discord server", url=social_links['discord'])],
+            [InlineKeyboardButton("✅ I've joined all", callback_data='social_tasks_completed')]
+        ])
+
+        main_welcome = (
+            "🐕 *Welcome to Doge World!* 🐕\n\n"
+            "You are now a **Doge Adventurer** on a quest to collect as many **Doge Points** as possible!\n\n"
+            "🌟 *How to Earn Doge Points:*\n"
+            "- Complete tasks to earn points.\n"
+            "- Invite friends and earn points when they complete tasks.\n\n"
+            f"🔗 *Your Referral Link:* `{referral_link}`\n"
+            "Share this link with friends to earn bonus points!\n\n"
+            "🏆 *Climb the Leaderboard* and become the **Top Doge**!\n\n"
+            "Use the buttons below to get started:"
+        )
+        main_menu = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📜 Tasks", callback_data='tasks')],
+            [InlineKeyboardButton("🏆 Leaderboard", callback_data='leaderboard')],
+            [InlineKeyboardButton("👤 Referral Info", callback_data='referral')],
+            [InlineKeyboardButton("👥 My Referrals", callback_data='my_referrals')],
+            [InlineKeyboardButton("🔗 Get Referral Link", callback_data='referral_link')]
+        ])
+
+        referral_link_message = (
+            f"🔗 *Your Referral Link:* `{referral_link}`\n\n"
+            "Share this link with friends to earn bonus points!"
+        )
+
+        # Swap everything at once so a render never mixes old and new templates
+        (self.social_tasks, self.social_tasks_keyboard, self._main_welcome, self.main_menu,
+         self._referral_link_message) = (social_tasks, social_tasks_keyboard, main_welcome,
+                                         main_menu, referral_link_message)
+
+    def main_welcome(self, user_id: int) -> str:
+        return self._main_welcome.format(user_id=user_id)
+
+    def referral_link_message(self, user_id: int) -> str:
+        return self._referral_link_message.format(user_id=user_id)
+
+
+@functools.lru_cache(maxsize=4096)
+def _with_back(markup: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(tuple(markup.inline_keyboard) + ((BACK_BUTTON,),))
+
+
+def with_back(markup: Optional[InlineKeyboardMarkup]) -> InlineKeyboardMarkup:
+    """The markup with a final row leading back to the main menu
+
+    Markups compare and hash by their buttons, so shared markups (task
+    lists, leaderboard pages) get one cached copy each.
+    """
+    return _with_back(markup) if markup is not None else BACK_MARKUP
+
+
+class ShownContent:
+    """Fingerprints of what recently edited messages show, keyed by (chat_id, message_id)
+
+    Lets a view change send only the part that differs (text or just the
+    keyboard), or nothing when a tap would redraw the same view.
+    """
+
+    def __init__(self, max_messages: int = SHOWN_CONTENT_SIZE):
+        self.max_messages = max(max_messages, 1)
+        self._shown: 'OrderedDict[Tuple[int, int], Tuple[int, int]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._shown)
+
+    @staticmethod
+    def fingerprint(text: str, parse_mode: Optional[str],
+                    reply_markup: Optional[InlineKeyboardMarkup]) -> Tuple[int, int]:
+        return hash((text, parse_mode)), hash(reply_markup)
+
+    def get(self, chat_id: int, message_id: int) -> Optional[Tuple[int, int]]:
+        return self._shown.get((chat_id, message_id))
+
+    def put(self, chat_id: int, message_id: int, fingerprint: Tuple[int, int]) -> None:
+        key = (chat_id, message_id)
+        self._shown[key] = fingerprint
+        self._shown.move_to_end(key)
+        if len(self._shown) > self.max_messages:
+            self._shown.popitem(last=False)
+
+    def forget(self, chat_id: int, message_id: int) -> None:
+        self._shown.pop((chat_id, message_id), None)
+
+
+# Micro-benchmark
+
+def _concatenated_welcome(user_id: int, bot_username: str, social_links: Dict[str, str]) -> tuple:
+    """The main welcome as it used to be built on every call, for comparison"""
+    referral_link = f"https://t.me/{bot_username}?start={user_id}"
+    welcome_message = "🐕 *Welcome to Doge World!* 🐕\n\n"
+    welcome_message += "You are now a **Doge Adventurer** on a quest to collect as many **Doge Points** as possible!\n\n"
+    welcome_message += "🌟 *How to Earn Doge Points:*\n"
+    welcome_message += "- Complete tasks to earn points.\n"
+    welcome_message += "- Invite friends and earn points when they complete tasks.\n\n"
+    welcome_message += f"🔗 *Your Referral Link:* `{referral_link}`\n"
+    welcome_message += "Share this link with friends to earn bonus points!\n\n"
+    welcome_message += "🏆 *Climb the Leaderboard* and become the **Top Doge**!\n\n"
+    welcome_message += "Use the buttons below to get started:"
+    keyboard = [
+        [InlineKeyboardButton("📜 Tasks", callback_data='tasks')],
+        [InlineKeyboardButton("🏆 Leaderboard", callback_data='leaderboard')],
+        [InlineKeyboardButton("👤 Referral Info", callback_data='referral')],
+        [InlineKeyboardButton("👥 My Referrals", callback_data='my_referrals')],
+        [InlineKeyboardButton("🔗 Get Referral Link", callback_data='referral_link')]
+    ]
+    return welcome_message, InlineKeyboardMarkup(keyboard)
+
+
+def _measure(render: Callable[[int], tuple], iterations: int) -> dict:
+    started = time.perf_counter()
+    for user_id in range(iterations):
+        render(user_id)
+    elapsed = time.perf_counter() - started
+
+    # Count allocations separately; tracing slows the loop down
+    tracemalloc.start()
+    peak = 0
+    for user_id in range(1000):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        result = render(user_id)
+        peak += tracemalloc.get_traced_memory()[1] - baseline
+        del result
+    before = tracemalloc.take_snapshot()
+    results = [render(user_id) for user_id in range(1000)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    del results
+    return {
+        'us_per_render': elapsed / iterations * 1e6,
+        'peak_bytes_per_render': peak / 1000,
+        'blocks_per_render': sum(stat.count_diff for stat in stats) / 1000,
+        'bytes_per_render': sum(stat.size_diff for stat in stats) / 1000,
+    }
+
+
+def benchmark(iterations: int = 20000) -> Dict[str, dict]:
+    """Time and count allocations for the main welcome, concatenated vs. templated"""
+    bot_username = 'doge_adventurer_bot'
+    social_links = {name: f'https://example.com/{name}'
+                    for name in ('twitter', 'telegram_channel', 'telegram_group', 'discord')}
+    templates = MessageTemplates(bot_username, social_links)
+    return {
+        'concatenated': _measure(lambda user_id: _concatenated_welcome(user_id, bot_username, social_links),
+                                 iterations),
+        'templated': _measure(lambda user_id: (templates.main_welcome(user_id), templates.main_menu),
+                              iterations),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare per-call message building with compiled templates")
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+    for name, result in benchmark(args.iterations).items():
+        print(f"{name:<13} {result['us_per_render']:8.2f} us/render  "
+              f"{result['peak_bytes_per_render']:8.0f} bytes allocated  "
+              f"{result['blocks_per_render']:6.1f} blocks / {result['bytes_per_render']:6.0f} bytes retained")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+import logging
+import os
+import re
+import time
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Pattern, Tuple
+
+from telegram import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Per-user limits as comma-separated key=rate/burst pairs (rate in updates per
+# second, 0 for no limit). A key is a rule name below, a /command, or cb:<regex>
+# matched against callback data; commands and cb: keys are checked first
+THROTTLE_LIMITS = os.environ.get('DOGE_THROTTLE_LIMITS', '')
+# Users tracked per generation; beyond this the oldest generation is dropped early
+THROTTLE_MAX_USERS = int(os.environ.get('DOGE_THROTTLE_MAX_USERS', '1000000'))
+
+UPDATES_SHED = metrics.counter('doge_updates_shed_total',
+                               'Updates dropped by the ingress throttle before any handler ran',
+                               ('rule', 'reason'))
+
+
+class ThrottleRule(NamedTuple):
+    name: str
+    kind: str            # 'message' or 'callback'
+    pattern: Pattern     # matched against the message text or the callback data
+    rate: float          # sustained updates per second, per user
+    burst: float         # updates a user may send at once
+
+
+def _command_pattern(command: str) -> Pattern:
+    return re.compile(rf'/{re.escape(command)}(@\w+)?(\s|$)')
+
+
+# Checked in order; the first rule matching an update is the one it counts against
+DEFAULT_RULES = (
+    # Each /start looks up (and may register or re-refer) the user
+    ThrottleRule('start', 'message', _command_pattern('start'), 0.2, 3),
+    # Each task tap reads and writes completions
+    ThrottleRule('task', 'callback', re.compile('task_'), 1.0, 5),
+    ThrottleRule('callback', 'callback', re.compile(''), 2.0, 10),
+    ThrottleRule('message', 'message', re.compile(''), 1.0, 10),
+)
+
+
+def parse_limits(spec: str, rules: Iterable[ThrottleRule] = DEFAULT_RULES) -> Tuple[ThrottleRule, ...]:
+    """Apply a DOGE_THROTTLE_LIMITS string to rules; raises ValueError if it is malformed"""
+    rules = list(rules)
+    extra: List[ThrottleRule] = []
+    for item in filter(None, (item.strip() for item in spec.split(','))):
+        key, _, limit = item.rpartition('=')
+        try:
+            rate, _, burst = limit.partition('/')
+            rate = float(rate)
+            burst = float(burst) if burst else max(rate, 1.0)
+        except ValueError:
+            raise ValueError(f"bad throttle limit {item!r}, expected key=rate/burst")
+        if key.startswith('/'):
+            extra.append(ThrottleRule(key, 'message', _command_pattern(key[1:]), rate, burst))
+        elif key.startswith('cb:'):
+            extra.append(ThrottleRule(key, 'callback', re.compile(key[3:]), rate, burst))
+        else:
+            for n, rule in enumerate(rules):
+                if rule.name == key:
+                    rules[n] = rule._replace(rate=rate, burst=burst)
+                    break
+            else:
+                raise ValueError(f"unknown throttle rule {key!r}")
+    return tuple(extra + rules)
+
+
+def route_of(update: object) -> Optional[Tuple[str, str]]:
+    """(kind, text) an update is throttled by: the message text or the callback data"""
+    if not isinstance(update, Update):
+        return None
+    if update.callback_query:
+        return 'callback', update.callback_query.data or ''
+    message = update.effective_message
+    if message is None:
+        return None
+    return 'message', message.text or message.caption or ''
+
+
+class IngressThrottle:
+    """Per-user rate limits applied to updates as they arrive
+
+    Each rule keeps a bucket per user in GCRA form: a single float, the
+    time at which the user's bucket would be full again. Buckets live in
+    two generations of plain dicts that are swapped every window (the
+    longest time any bucket takes to refill), so a user idle for a window
+    is forgotten without any scan, and memory tracks recently active users
+    rather than everyone ever seen. A generation that reaches max_users is
+    swapped early, which only ever forgets limits, never tightens them.
+
+    Updates repeating one that is still queued or running for the same
+    user (the same command, or the same callback data) are coalesced into
+    it instead of spending a token.
+    """
+
+    def __init__(self, rules: Iterable[ThrottleRule] = DEFAULT_RULES, exempt: Iterable[int] = (),
+                 max_users: int = THROTTLE_MAX_USERS, clock: Callable[[], float] = time.monotonic):
+        self.rules = tuple(rule for rule in rules if rule.rate > 0)
+        self.exempt = frozenset(exempt)
+        self.max_users = max(max_users, 1)
+        self.clock = clock
+        self.window = max([rule.burst / rule.rate for rule in self.rules] + [1.0])
+        self._current: List[Dict[int, float]] = [{} for _ in self.rules]
+        self._previous: List[Dict[int, float]] = [{} for _ in self.rules]
+        self._current_size = 0
+        self._rotated = clock()
+        self._pending: Dict[Tuple[int, str], int] = {}
+        self.shed = 0
+
+    def __len__(self) -> int:
+        """Buckets currently held, across rules and generations"""
+        return sum(map(len, self._current)) + sum(map(len, self._previous))
+
+    def _rule_for(self, kind: str, text: str) -> Optional[int]:
+        for index, rule in enumerate(self.rules):
+            if rule.kind == kind and rule.pattern.match(text):
+                return index
+        return None
+
+    def _rotate(self, now: float) -> None:
+        self._previous = self._current
+        self._current = [{} for _ in self.rules]
+        self._current_size = 0
+        self._rotated = now
+
+    def _take(self, index: int, user_id: int, now: float) -> bool:
+        """Take a token from the user's bucket for rule index; False if it is empty"""
+        if now - self._rotated >= self.window or self._current_size >= self.max_users:
+            self._rotate(now)
+        rule = self.rules[index]
+        interval = 1 / rule.rate
+        current = self._current[index]
+        full_at = current.get(user_id)
+        if full_at is None:
+            full_at = self._previous[index].get(user_id, now)
+            self._current_size += 1
+        full_at = max(full_at, now)
+        if full_at - now > (rule.burst - 1) * interval:
+            current[user_id] = full_at
+            return False
+        current[user_id] = full_at + interval
+        return True
+
+    @staticmethod
+    def _coalesce_key(kind: str, text: str) -> Optional[str]:
+        # Commands coalesce whatever their arguments; plain text never does
+        if kind == 'callback':
+            return text
+        if text.startswith('/'):
+            return text.split(None, 1)[0]
+        return None
+
+    def admit(self, update: object) -> bool:
+        """Whether update should be processed; shed updates are counted and must be dropped"""
+        route = route_of(update)
+        if route is None or update.effective_user is None:
+            return True
+        user_id = update.effective_user.id
+        if user_id in self.exempt:
+            return True
+        kind, text = route
+        index = self._rule_for(kind, text)
+        name = self.rules[index].name if index is not None else kind
+
+        key = self._coalesce_key(kind, text)
+        if key is not None and (user_id, key) in self._pending:
+            self._shed(name, 'coalesced')
+            return False
+        if index is not None and not self._take(index, user_id, self.clock()):
+            self._shed(name, 'rate')
+            return False
+        if key is not None:
+            self._pending[user_id, key] = self._pending.get((user_id, key), 0) + 1
+        return True
+
+    def release(self, update: object) -> None:
+        """Mark an admitted update as processed"""
+        route = route_of(update)
+        if route is None or update.effective_user is None:
+            return
+        key = self._coalesce_key(*route)
+        if key is None:
+            return
+        pending_key = (update.effective_user.id, key)
+        count = self._pending.get(pending_key)
+        if count is None:
+            return
+        if count > 1:
+            self._pending[pending_key] = count - 1
+        else:
+            del self._pending[pending_key]
+
+    def _shed(self, rule: str, reason: str) -> None:
+        self.shed += 1
+        UPDATES_SHED.labels(rule, reason).inc()
+
+    def stats(self) -> dict:
+        return {
+            'shed': self.shed,
+            'buckets': len(self),
+            'pending': len(self._pending),
+            'window_s': self.window,
+        }
+
+
+def create_throttle(exempt: Iterable[int] = ()) -> IngressThrottle:
+    """Throttle with the configured limits, falling back to the defaults if they are malformed"""
+    try:
+        rules = parse_limits(THROTTLE_LIMITS)
+    except ValueError as e:
+        logger.error(f"Ignoring DOGE_THROTTLE_LIMITS: {str(e)}")
+        rules = DEFAULT_RULES
+    return IngressThrottle(rules, exempt)
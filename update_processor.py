@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+# Handed to the base class, whose semaphore is taken before do_process_update
+# runs; the real limit is applied after the per-user lock instead
+_BASE_LIMIT = 2 ** 30
+
+IN_FLIGHT = metrics.gauge('doge_updates_in_flight', 'Updates being handled')
+QUEUED = metrics.gauge('doge_updates_queued', 'Updates waiting on their user\'s lock or a free slot')
+ACTIVE_USERS = metrics.gauge('doge_updates_active_users', 'Users with an update being handled or waiting')
+
+
+class KeyedLocks:
+    """One asyncio.Lock per key, created on demand and dropped once unused"""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, List[Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently, each user's in order
+
+    Updates are serialised on a per-user lock (asyncio locks are FIFO, so a
+    user's updates run in arrival order) and only then take one of
+    max_concurrent_updates slots. A user with a backlog therefore waits on
+    their own lock without holding slots other users could run in.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(_BASE_LIMIT)
+        self.limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = KeyedLocks()
+        self.in_flight = 0
+        self.queued = 0
+        self.processed = 0
+        self.shed = 0
+        # Called with every update as it arrives, before any waiting
+        self.on_arrival: Optional[Callable[[object], None]] = None
+        # Called with every update the guard refuses
+        self.on_shed: Optional[Callable[[object], None]] = None
+        # Optional admission check (see throttle.IngressThrottle): updates it
+        # refuses are dropped before they wait on a lock or a slot
+        self.guard = None
+        IN_FLIGHT.labels().set_function(lambda: self.in_flight)
+        QUEUED.labels().set_function(lambda: self.queued)
+        ACTIVE_USERS.labels().set_function(lambda: len(self._locks))
+
+    @staticmethod
+    def key_for(update: object) -> Optional[int]:
+        """Ordering key: the user who sent the update, else its chat"""
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self.on_arrival:
+            self.on_arrival(update)
+        guard = self.guard
+        if guard is not None and not guard.admit(update):
+            self.shed += 1
+            if asyncio.iscoroutine(coroutine):
+                coroutine.close()
+            if self.on_shed:
+                self.on_shed(update)
+            return
+        key = self.key_for(update)
+        lock = self._locks.hold(key) if key is not None else contextlib.nullcontext()
+        self.queued += 1
+        started = False
+        try:
+            async with lock:
+                async with self._slots:
+                    self.queued -= 1
+                    started = True
+                    self.in_flight += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.in_flight -= 1
+                        self.processed += 1
+        finally:
+            if not started:
+                self.queued -= 1
+                if asyncio.iscoroutine(coroutine):
+                    coroutine.close()
+            if guard is not None:
+                guard.release(update)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'active_users': len(self._locks),
+            'processed': self.processed,
+            'shed': self.shed,
+            'limit': self.limit,
+        }
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import shutil
+import sqlite3
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Gzipped JSON-lines file incoming updates are appended to; empty disables recording
+TRACE_PATH = os.environ.get('DOGE_TRACE_PATH', '')
+# Key for pseudonymising ids; set it to keep ids consistent across restarts and to
+# let `replay --salt` map a database copy onto the same pseudonyms
+TRACE_SALT = os.environ.get('DOGE_TRACE_SALT', '')
+
+# Seconds between flushes of the compressed stream to disk
+TRACE_FLUSH_INTERVAL = 1.0
+
+
+def pseudonym(value: int, salt: bytes) -> int:
+    """Stable, non-reversible stand-in for a user or chat id (keeps the sign)"""
+    digest = hmac.new(salt, str(abs(value)).encode(), hashlib.sha256).digest()
+    mapped = int.from_bytes(digest[:6], 'big') + 1
+    return -mapped if value < 0 else mapped
+
+
+class Anonymiser:
+    """Reduces updates to the fields handlers read, with ids and text scrubbed
+
+    User and chat ids are replaced by keyed pseudonyms (consistently, so
+    double taps and referrals still line up), names are dropped and free text
+    is masked. Commands and callback data are kept; a numeric /start argument
+    is a referrer id and is pseudonymised too. Ids in keep_ids (the admin) are
+    left as they are so admin commands still work on replay.
+    """
+
+    def __init__(self, salt: bytes, keep_ids: Tuple[int, ...] = ()):
+        self.salt = salt
+        self.keep_ids = frozenset(keep_ids)
+
+    def id(self, value: int) -> int:
+        return value if value in self.keep_ids else pseudonym(value, self.salt)
+
+    def _user(self, user: dict) -> dict:
+        user_id = self.id(user['id'])
+        return {'id': user_id, 'is_bot': user.get('is_bot', False), 'first_name': 'User',
+                'username': f'user{user_id}' if user.get('username') else None}
+
+    def _text(self, text: str, sender_id: int) -> str:
+        if sender_id in self.keep_ids:
+            return text
+        if not text.startswith('/'):
+            return 'x' * len(text)
+        command, _, argument = text.partition(' ')
+        if not argument:
+            return command
+        if argument.strip().lstrip('-').isdigit():
+            return f'{command} {self.id(int(argument))}'
+        return f"{command} {'x' * len(argument)}"
+
+    def _message(self, message: dict) -> dict:
+        sender_id = message.get('from', {}).get('id', 0)
+        result = {'message_id': message['message_id'], 'date': message['date'],
+                  'chat': {'id': self.id(message['chat']['id']), 'type': message['chat']['type']}}
+        if 'from' in message:
+            result['from'] = self._user(message['from'])
+        if 'text' in message:
+            result['text'] = self._text(message['text'], sender_id)
+            entities = [entity for entity in message.get('entities', ())
+                        if entity['type'] == 'bot_command' and entity['offset'] == 0]
+            if entities:
+                result['entities'] = entities
+        return result
+
+    def update(self, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Scrubbed copy of a message or callback update, None for other kinds"""
+        if 'message' in data:
+            return {'update_id': data['update_id'], 'message': self._message(data['message'])}
+        if 'callback_query' in data:
+            query = data['callback_query']
+            scrubbed = {'id': query['id'], 'data': query.get('data'),
+                        'chat_instance': hmac.new(self.salt, str(query.get('chat_instance')).encode(),
+                                                  hashlib.sha256).hexdigest()[:16],
+                        'from': self._user(query['from'])}
+            if 'message' in query:
+                scrubbed['message'] = self._message(query['message'])
+            return {'update_id': data['update_id'], 'callback_query': scrubbed}
+        return None
+
+
+class TraceRecorder:
+    """Appends anonymised incoming updates with their arrival time to a gzipped JSONL trace
+
+    Each line is {"ts": <unix time>, "update": {...}}. Restarts append a new
+    gzip member to the same file, which readers see as one stream.
+    """
+
+    def __init__(self, path: str, salt: str = TRACE_SALT, keep_ids: Tuple[int, ...] = ()):
+        if not salt:
+            logger.warning("DOGE_TRACE_SALT is not set; trace ids use a random key for this run only")
+        self.path = path
+        self.anonymiser = Anonymiser(salt.encode() if salt else secrets.token_bytes(32), keep_ids)
+        self.recorded = 0
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._flushed = time.monotonic()
+
+    def record(self, update: object) -> None:
+        if not isinstance(update, Update) or self._file is None:
+            return
+        try:
+            scrubbed = self.anonymiser.update(update.to_dict())
+            if scrubbed is None:
+                return
+            self._file.write(json.dumps({'ts': round(time.time(), 6), 'update': scrubbed},
+                                        separators=(',', ':')) + '\n')
+            self.recorded += 1
+            if time.monotonic() - self._flushed >= TRACE_FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed = time.monotonic()
+        except Exception as e:
+            logger.error(f"Error recording update trace: {str(e)}")
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f"Recorded {self.recorded} updates to {self.path}")
+
+
+def read_trace(path: str) -> Iterator[Tuple[float, dict]]:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record['ts'], record['update']
+
+
+# Replay
+
+def pseudonymise_database(path: str, salt: bytes, keep_ids: Tuple[int, ...] = ()) -> None:
+    """Rewrite user ids in a database copy with the pseudonyms a trace uses"""
+    anonymiser = Anonymiser(salt, keep_ids)
+    conn = sqlite3.connect(path)
+    conn.create_function('pseudonym', 1, lambda value: None if value is None else anonymiser.id(value),
+                         deterministic=True)
+    with conn:
+        conn.execute('''UPDATE users SET user_id = pseudonym(user_id), referred_by = pseudonym(referred_by),
+                        username = CASE WHEN username IS NULL THEN NULL
+                                        ELSE 'user' || pseudonym(user_id) END''')
+        conn.execute('UPDATE completed_tasks SET user_id = pseudonym(user_id)')
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'task_period_completions'").fetchone():
+            conn.execute('UPDATE task_period_completions SET user_id = pseudonym(user_id)')
+        conn.execute('UPDATE referral_stats SET user_id = pseudonym(user_id)')
+        conn.execute('''UPDATE referral_closure SET ancestor = pseudonym(ancestor),
+                        descendant = pseudonym(descendant)''')
+        conn.execute('''UPDATE points_ledger SET user_id = pseudonym(user_id),
+                        source_user_id = pseudonym(source_user_id)''')
+        conn.execute('UPDATE broadcast_failures SET user_id = pseudonym(user_id)')
+        conn.execute('DELETE FROM scheduled_actions')
+    conn.close()
+
+
+def _table_rows(conn: sqlite3.Connection, table: str) -> Dict[tuple, tuple]:
+    columns = conn.execute(f'PRAGMA table_info({table})').fetchall()
+    key_columns = [index for index, *_, pk in columns if pk] or list(range(len(columns)))
+    return {tuple(row[i] for i in key_columns): row for row in conn.execute(f'SELECT * FROM {table}')}
+
+
+def diff_databases(before: str, after: str) -> Dict[str, Dict[str, int]]:
+    """Rows added, removed and changed per table, matched by primary key"""
+    old, new = sqlite3.connect(before), sqlite3.connect(after)
+    try:
+        tables = [name for name, in new.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+        result = {}
+        for table in tables:
+            new_rows = _table_rows(new, table)
+            old_rows = _table_rows(old, table) if old.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() else {}
+            result[table] = {
+                'rows': len(new_rows),
+                'added': len(new_rows.keys() - old_rows.keys()),
+                'removed': len(old_rows.keys() - new_rows.keys()),
+                'changed': sum(1 for key in new_rows.keys() & old_rows.keys() if new_rows[key] != old_rows[key]),
+            }
+        points = new.execute('SELECT COALESCE(SUM(doge_points), 0) FROM users').fetchone()[0] - \
+            old.execute('SELECT COALESCE(SUM(doge_points), 0) FROM users').fetchone()[0]
+        result['users']['points_delta'] = points
+        return result
+    finally:
+        old.close()
+        new.close()
+
+
+def copy_database(source: str, target: str) -> None:
+    """Consistent copy of a (possibly live, WAL-mode) database"""
+    src, dst = sqlite3.connect(source), sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+
+
+async def replay(trace_path: str, db_path: str, speed: float = 1.0, salt: str = '',
+                 latency: float = 0.03, realistic_limits: bool = True,
+                 work_dir: Optional[str] = None) -> dict:
+    """Feed a trace through DogeBot against a copy of db_path, keeping inter-arrival times / speed"""
+    import metrics
+    from bot import DogeBot, YOUR_ADMIN_USER_ID
+    from dispatch import OutboundDispatcher
+    from fakeapi import FakeTelegramAPI
+    from storage import Storage
+
+    work_dir = work_dir or tempfile.mkdtemp(prefix='doge-replay-')
+    before = os.path.join(work_dir, 'before.db')
+    after = os.path.join(work_dir, 'after.db')
+    copy_database(db_path, before)
+    if salt:
+        pseudonymise_database(before, salt.encode(), (YOUR_ADMIN_USER_ID,))
+    shutil.copyfile(before, after)
+
+    storage = Storage(after)
+    storage.open()
+    await storage.init_db()
+    dispatcher = OutboundDispatcher() if realistic_limits else \
+        OutboundDispatcher(global_rate=1e6, chat_rate=1e6, chat_burst=1e6, workers=64)
+    metrics.METRICS_PORT = ''
+    doge = DogeBot('1:replay', storage, request=FakeTelegramAPI(latency=latency), dispatcher=dispatcher)
+    if not speed:
+        # Updates fed as fast as possible would all look like floods
+        doge.throttle = None
+    application = await doge.initialize()
+    await application.initialize()
+    await doge.post_init(application)
+    await application.start()
+    metrics.HANDLER_LATENCY.reset()
+
+    processor = doge.update_processor
+    processed_before = processor.processed + processor.shed
+    lags: List[float] = []
+    count = 0
+    first_ts: Optional[float] = None
+    started = time.perf_counter()
+    for ts, data in read_trace(trace_path):
+        if first_ts is None:
+            first_ts = ts
+        if speed:
+            due = started + (ts - first_ts) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lags.append(max(time.perf_counter() - due, 0.0))
+        await application.update_queue.put(Update.de_json(data, application.bot))
+        count += 1
+    while processor.processed + processor.shed - processed_before < count:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    shed = processor.shed
+    handlers = {' '.join(values): (series.count, *series.quantiles())
+                for values, series in metrics.HANDLER_LATENCY.series()}
+    await doge.shutdown()
+    await storage.close()
+
+    lags.sort()
+    return {
+        'updates': count,
+        'shed': shed,
+        'trace_span_s': (ts - first_ts) if count else 0.0,
+        'elapsed_s': elapsed,
+        'max_feed_lag_ms': lags[-1] * 1000 if lags else 0.0,
+        'handlers': handlers,
+        'diff': diff_databases(before, after),
+        'before': before,
+        'after': after,
+    }
+
+
+def print_replay(result: dict) -> None:
+    print(f"Replayed {result['updates']} updates spanning {result['trace_span_s']:.1f}s "
+          f"in {result['elapsed_s']:.1f}s (feed lag max {result['max_feed_lag_ms']:.0f} ms, "
+          f"{result['shed']} shed by the ingress throttle)")
+    print(f"\n{'handler / route':<52} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, (count, p50, p95, p99) in sorted(result['handlers'].items(), key=lambda item: -item[1][0]):
+        print(f"{name[:52]:<52} {count:>7} {p50 * 1000:>8.2f} {p95 * 1000:>8.2f} {p99 * 1000:>8.2f}")
+    print(f"\n{'table':<24} {'rows':>8} {'added':>8} {'removed':>8} {'changed':>8}")
+    for table, diff in result['diff'].items():
+        print(f"{table:<24} {diff['rows']:>8} {diff['added']:>8} {diff['removed']:>8} {diff['changed']:>8}")
+    print(f"\nTotal Doge Points awarded: {result['diff']['users']['points_delta']}")
+    print(f"Database before: {result['before']}\nDatabase after:  {result['after']}")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Update traces for Doge Bot")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    play = commands.add_parser('replay', help="replay a trace against a copy of the database")
+    play.add_argument('trace', help="gzipped JSON-lines trace written with DOGE_TRACE_PATH")
+    play.add_argument('--db', default=os.environ.get('DOGE_DB_PATH', 'doge_world.db'),
+                      help="database to copy; the original is never modified")
+    play.add_argument('--speed', type=float, default=1.0,
+                      help="1 = recorded pace, N = N times faster, 0 = as fast as possible")
+    play.add_argument('--salt', default=TRACE_SALT,
+                      help="DOGE_TRACE_SALT used when recording, to map the copy's user ids")
+    play.add_argument('--latency-ms', type=float, default=30, help="simulated Bot API latency")
+    play.add_argument('--no-limits', action='store_true', help="disable Telegram rate limits")
+    play.add_argument('--out', help="directory for the before/after database copies")
+
+    info = commands.add_parser('info', help="summarise a trace")
+    info.add_argument('trace')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.command == 'info':
+        records = list(read_trace(args.trace))
+        if not records:
+            print("Empty trace")
+            return
+        span = records[-1][0] - records[0][0]
+        kinds: Dict[str, int] = {}
+        for _, data in records:
+            kind = 'callback' if 'callback_query' in data else \
+                (data['message'].get('text') or '').split(' ', 1)[0] or 'message'
+            kind = kind if kind.startswith(('/', 'callback')) else 'text'
+            kinds[kind] = kinds.get(kind, 0) + 1
+        busiest, first = 0, 0
+        for last, (ts, _) in enumerate(records):
+            while records[first][0] <= ts - 1:
+                first += 1
+            busiest = max(busiest, last - first + 1)
+        print(f"{len(records)} updates over {span:.1f}s, busiest second {busiest} updates")
+        for kind, n in sorted(kinds.items(), key=lambda item: -item[1]):
+            print(f"  {kind:<20} {n}")
+        return
+    result = asyncio.run(replay(args.trace, args.db, args.speed, args.salt, args.latency_ms / 1000,
+                                not args.no_limits, args.out))
+    print_replay(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import os
+import random
+import secrets
+import signal
+import statistics
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+from httpserver import HTTPServer, Request, Response, text_response
+
+logger = logging.getLogger(__name__)
+
+# Public HTTPS URL registered with Telegram, e.g. https://bot.example.com/webhook
+WEBHOOK_URL = os.environ.get('DOGE_WEBHOOK_URL', '')
+# Address the listener binds to (usually behind a TLS-terminating proxy)
+WEBHOOK_LISTEN = os.environ.get('DOGE_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('DOGE_WEBHOOK_PORT', '8443'))
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token on every request;
+# a random one is generated at startup if this is empty
+WEBHOOK_SECRET = os.environ.get('DOGE_WEBHOOK_SECRET', '')
+# Updates received but not yet handled (queued, waiting in the update processor
+# or running) before the listener answers 503 and Telegram retries later
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('DOGE_WEBHOOK_QUEUE_SIZE', '1000'))
+# Simultaneous connections Telegram may open to the listener
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('DOGE_WEBHOOK_MAX_CONNECTIONS', '40'))
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+def webhook_path(url: str = WEBHOOK_URL) -> str:
+    return urlparse(url).path or '/webhook'
+
+
+class WebhookServer:
+    """HTTP listener that feeds Telegram webhook requests into an Application
+
+    Each POST is validated against the secret token, decoded and put on the
+    application's update queue. With concurrent updates the application
+    empties that queue straight into tasks, so the limit is applied to the
+    whole backlog: once max_backlog updates are waiting or running, requests
+    are answered with 503 so Telegram redelivers them later. GET /healthz
+    reports liveness and GET /readyz readiness to accept updates.
+    """
+
+    def __init__(self, application: Application, secret: str = WEBHOOK_SECRET,
+                 path: str = '/webhook', host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 max_backlog: int = WEBHOOK_QUEUE_SIZE):
+        self.application = application
+        self.secret = secret
+        self.max_backlog = max_backlog
+        self.path = path
+        self.received = 0
+        self.rejected = 0
+        self.shed = 0
+        self.http = HTTPServer(host, port, {
+            path: self._handle_update,
+            '/healthz': self._health,
+            '/readyz': self._ready,
+        })
+
+    @property
+    def port(self) -> int:
+        return self.http.port
+
+    async def start(self) -> None:
+        await self.http.start()
+
+    async def close(self) -> None:
+        await self.http.close()
+
+    @property
+    def backlog(self) -> int:
+        """Updates received but not handled yet: queued, waiting in the update processor or running"""
+        processor = self.application.update_processor
+        return (self.application.update_queue.qsize() + getattr(processor, 'queued', 0)
+                + getattr(processor, 'in_flight', 0))
+
+    async def _handle_update(self, request: Request) -> Response:
+        if request.method != 'POST':
+            return text_response(405, 'Method Not Allowed')
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret):
+            self.rejected += 1
+            return text_response(401, 'Unauthorized')
+        try:
+            update = Update.de_json(json.loads(request.body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook update: {str(e)}")
+            return text_response(400, 'Bad Request')
+        if self.backlog >= self.max_backlog:
+            self.shed += 1
+            return text_response(503, 'Update queue full')
+        try:
+            self.application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.shed += 1
+            return text_response(503, 'Update queue full')
+        self.received += 1
+        return text_response(200, 'OK')
+
+    async def _health(self, request: Request) -> Response:
+        return text_response(200, 'ok')
+
+    async def _ready(self, request: Request) -> Response:
+        if not self.application.running:
+            return text_response(503, 'not running')
+        backlog = self.backlog
+        if backlog >= self.max_backlog:
+            return text_response(503, f'backlog full ({backlog})')
+        return text_response(200, f'ready (backlog {backlog}/{self.max_backlog})')
+
+
+async def run_webhook(application: Application, url: str = WEBHOOK_URL,
+                      secret: str = WEBHOOK_SECRET) -> None:
+    """Serve updates through a webhook until SIGINT/SIGTERM
+
+    The listener never runs without a secret token: without one anyone who
+    can reach it could post forged updates, including admin commands.
+    """
+    if not url:
+        raise ValueError("DOGE_WEBHOOK_URL must be set to run in webhook mode")
+    if not secret:
+        # Registered with Telegram below, so only Telegram knows it
+        secret = secrets.token_urlsafe(32)
+        logger.info("DOGE_WEBHOOK_SECRET is not set; using a random secret token for this run")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    server = WebhookServer(application, secret, webhook_path(url))
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+    try:
+        await application.bot.set_webhook(url=url, secret_token=secret,
+                                          max_connections=WEBHOOK_MAX_CONNECTIONS,
+                                          drop_pending_updates=True)
+        logger.info(f"Webhook registered at {url}")
+        await stop.wait()
+    finally:
+        await server.close()
+        await application.stop()
+
+
+# Local tooling: replay recorded updates and compare ingress latency
+
+
+def load_updates(path: str) -> List[dict]:
+    """Read updates from a JSON array or a JSON-lines file"""
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+async def post_updates(path: str, url: str, secret: str) -> None:
+    import httpx
+
+    headers = {SECRET_HEADER: secret} if secret else {}
+    async with httpx.AsyncClient() as client:
+        for update in load_updates(path):
+            started = time.perf_counter()
+            response = await client.post(url, json=update, headers=headers)
+            print(f"update {update.get('update_id')}: {response.status_code} "
+                  f"{response.text} ({(time.perf_counter() - started) * 1000:.1f} ms)")
+
+
+def _synthetic_update(update_id: int) -> dict:
+    user = {'id': 1000 + update_id, 'is_bot': False, 'first_name': 'Doge'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': 'ping',
+        'chat': {'id': user['id'], 'type': 'private'}, 'from': user}}
+
+
+async def _measure(application: Application, deliver, count: int, mean_gap: float) -> List[float]:
+    """Deliver count updates with exponential gaps and return ingress latencies"""
+    sent: Dict[int, float] = {}
+    latencies: List[float] = []
+    done = asyncio.Event()
+
+    async def record(update: Update, context) -> None:
+        latencies.append(time.perf_counter() - sent[update.update_id])
+        if len(latencies) == count:
+            done.set()
+
+    application.add_handler(TypeHandler(Update, record))
+    for update_id in range(1, count + 1):
+        sent[update_id] = time.perf_counter()
+        await deliver(_synthetic_update(update_id))
+        await asyncio.sleep(random.expovariate(1 / mean_gap))
+    await asyncio.wait_for(done.wait(), 60)
+    return latencies
+
+
+async def compare_latency(count: int = 100, mean_gap: float = 0.1, poll_interval: float = 1.0,
+                          api_latency: float = 0.03) -> None:
+    """Measure delivery latency of webhook vs polling against a fake Bot API"""
+    import httpx
+    from fakeapi import FakeTelegramAPI
+
+    # Polling: a long-poll returns as soon as updates exist, then waits poll_interval
+    api = FakeTelegramAPI(latency=api_latency)
+    application = Application.builder().token('1:fake').request(api).get_updates_request(api).build()
+    await application.initialize()
+    await application.updater.start_polling(poll_interval=poll_interval, timeout=30)
+    await application.start()
+
+    async def push(update: dict) -> None:
+        # The update reaches Telegram's side one network hop after it is sent
+        asyncio.get_running_loop().call_later(api_latency, api.push_update, update)
+
+    polling = await _measure(application, push, count, mean_gap)
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+
+    # Webhook: Telegram POSTs each update to the listener as it arrives
+    api = FakeTelegramAPI(latency=api_latency)
+    application = (Application.builder().token('1:fake').request(api)
+                   .update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)).updater(None).build())
+    server = WebhookServer(application, 'secret', '/webhook', '127.0.0.1', 0)
+    await application.initialize()
+    await application.start()
+    await server.start()
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{server.port}') as client:
+        async def post(update: dict) -> None:
+            await asyncio.sleep(api_latency)
+            await client.post('/webhook', json=update, headers={SECRET_HEADER: 'secret'})
+
+        webhook = await _measure(application, post, count, mean_gap)
+    await server.close()
+    await application.stop()
+    await application.shutdown()
+
+    print(f"{count} updates, mean gap {mean_gap * 1000:.0f} ms, "
+          f"network latency {api_latency * 1000:.0f} ms, poll_interval {poll_interval}s")
+    for name, samples in (('polling', polling), ('webhook', webhook)):
+        samples = sorted(samples)
+        print(f"{name:8} p50 {statistics.median(samples) * 1000:8.1f} ms   "
+              f"p95 {samples[int(len(samples) * 0.95) - 1] * 1000:8.1f} ms   "
+              f"max {samples[-1] * 1000:8.1f} ms")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Webhook tooling for Doge Bot")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    post = commands.add_parser('post', help="POST recorded update JSON to a running listener")
+    post.add_argument('file', help="JSON array or JSON-lines file of updates")
+    post.add_argument('--url', default=f'http://127.0.0.1:{WEBHOOK_PORT}{webhook_path()}')
+    post.add_argument('--secret', default=WEBHOOK_SECRET)
+
+    compare = commands.add_parser('compare', help="compare webhook and polling latency locally")
+    compare.add_argument('--updates', type=int, default=100)
+    compare.add_argument('--mean-gap-ms', type=float, default=100)
+    compare.add_argument('--poll-interval', type=float, default=1.0)
+    compare.add_argument('--network-ms', type=float, default=30)
+
+    args = parser.parse_args(argv)
+    if args.command == 'post':
+        asyncio.run(post_updates(args.file, args.url, args.secret))
+    else:
+        asyncio.run(compare_latency(args.updates, args.mean_gap_ms / 1000,
+                                    args.poll_interval, args.network_ms / 1000))
+
+
+if __name__ == '__main__':
+    main()
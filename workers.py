@@ -0,0 +1,796 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import struct
+import tempfile
+import time
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.ext import Application, BaseUpdateProcessor
+
+import bot
+import logs
+import metrics
+from dispatch import GLOBAL_RATE, OutboundDispatcher
+from fakeapi import FakeTelegramAPI
+from leaderboard import Leaderboard
+from sharding import create_storage, shard_for
+from storage import Storage
+from update_processor import UserOrderedUpdateProcessor
+from update_trace import TraceRecorder, TRACE_PATH
+from webhook import run_webhook, WEBHOOK_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Worker processes started by `python workers.py run`
+WORKERS = int(os.environ.get('DOGE_WORKERS', str(os.cpu_count() or 1)))
+# Size of each worker's shared-memory update ring (bytes)
+WORKER_RING_BYTES = int(os.environ.get('DOGE_WORKER_RING_BYTES', str(4 * 1024 * 1024)))
+# Updates a worker takes off its ring before earlier ones have been processed
+WORKER_MAX_QUEUED = int(os.environ.get('DOGE_WORKER_MAX_QUEUED', '1000'))
+# Milliseconds between a worker's reports (progress, leaderboard and task changes)
+WORKER_SYNC_MS = float(os.environ.get('DOGE_WORKER_SYNC_MS', '100'))
+# Seconds between full leaderboard reloads in each worker, bounding drift between them
+WORKER_REFRESH_S = float(os.environ.get('DOGE_WORKER_REFRESH_S', '300'))
+# Seconds a draining worker gets to finish its queued updates before it is killed
+WORKER_DRAIN_TIMEOUT = float(os.environ.get('DOGE_WORKER_DRAIN_TIMEOUT', '30'))
+
+# Updates the ingress holds while waiting for room in a worker's ring
+INGRESS_MAX_PENDING = 4096
+
+# Seconds between restarts of a worker that keeps exiting
+RESTART_BACKOFF = 1.0
+
+# Record types on the rings: an update, changes from other workers, stop (to a
+# worker); a report (from a worker)
+RECORD_UPDATE = b'U'
+RECORD_PEER = b'P'
+RECORD_STOP = b'S'
+RECORD_REPORT = b'R'
+
+_HEADER = 128           # head and tail positions, on separate cache lines
+_TAIL_OFFSET = 64
+_POSITION = struct.Struct('<Q')
+_LENGTH = struct.Struct('<I')
+
+
+class ShmRing:
+    """Single-producer, single-consumer ring of byte records in shared memory
+
+    The producer copies a record straight into the segment and the
+    consumer copies it out, with no pickling or pipe in between. Head and
+    tail are ever-increasing byte positions, so records simply wrap around
+    the end of the buffer. Each side only writes its own position, after
+    the record data, which is enough for one producer and one consumer.
+    Nothing here blocks; pair the ring with a doorbell to wait for records.
+    """
+
+    def __init__(self, name: Optional[str] = None, size: int = WORKER_RING_BYTES):
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=_HEADER + size)
+            self.owner = True
+        else:
+            # Attaching registers the segment with the resource tracker, which
+            # worker processes share with the ingress that created it, so it is
+            # unlinked only by close() in the ingress (or if the ingress dies)
+            self._shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self._shm.name
+        self._buf = self._shm.buf
+        self._data = self._buf[_HEADER:]
+        self.capacity = len(self._data)
+
+    def __len__(self) -> int:
+        """Bytes in use"""
+        return self._tail() - self._head()
+
+    def _head(self) -> int:
+        return _POSITION.unpack_from(self._buf, 0)[0]
+
+    def _tail(self) -> int:
+        return _POSITION.unpack_from(self._buf, _TAIL_OFFSET)[0]
+
+    def _write(self, position: int, data) -> None:
+        offset = position % self.capacity
+        first = min(len(data), self.capacity - offset)
+        view = memoryview(data)
+        self._data[offset:offset + first] = view[:first]
+        if first < len(data):
+            self._data[:len(data) - first] = view[first:]
+
+    def _read(self, position: int, length: int) -> bytes:
+        offset = position % self.capacity
+        if offset + length <= self.capacity:
+            return bytes(self._data[offset:offset + length])
+        first = self.capacity - offset
+        return bytes(self._data[offset:]) + bytes(self._data[:length - first])
+
+    def put(self, record: bytes) -> bool:
+        """Append a record; False if there is no room for it yet"""
+        needed = _LENGTH.size + len(record)
+        if needed > self.capacity:
+            raise ValueError(f"record of {len(record)} bytes does not fit a {self.capacity} byte ring")
+        tail = self._tail()
+        if self.capacity - (tail - self._head()) < needed:
+            return False
+        self._write(tail, _LENGTH.pack(len(record)))
+        self._write(tail + _LENGTH.size, record)
+        _POSITION.pack_into(self._buf, _TAIL_OFFSET, tail + needed)
+        return True
+
+    def get(self) -> Optional[bytes]:
+        """Take the oldest record, or None if the ring is empty"""
+        head = self._head()
+        if head == self._tail():
+            return None
+        length = _LENGTH.unpack(self._read(head, _LENGTH.size))[0]
+        record = self._read(head + _LENGTH.size, length)
+        _POSITION.pack_into(self._buf, 0, head + _LENGTH.size + length)
+        return record
+
+    def close(self) -> None:
+        self._data.release()
+        self._buf.release()
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+
+
+def _ring_bell(fd: int) -> None:
+    try:
+        os.write(fd, b'\0')
+    except BlockingIOError:
+        # The pipe is full, so the other side has wake-ups pending anyway
+        pass
+
+
+def _clear_bell(fd: int) -> None:
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+class PeerLeaderboard(Leaderboard):
+    """Leaderboard that records its own changes for other workers and applies theirs
+
+    Every worker ranks every user, but only sees point changes from the
+    updates it handles. New users and point deltas are collected here,
+    shipped to the other workers with each report and applied there.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.new_users: List[Tuple[int, Optional[str]]] = []
+        self.deltas: Dict[int, int] = {}
+
+    def add_user(self, user_id: int, username: Optional[str], doge_points: int = 0) -> None:
+        if user_id not in self:
+            self.new_users.append((user_id, username))
+        super().add_user(user_id, username, doge_points)
+
+    def add_points(self, user_id: int, delta: int) -> None:
+        # Recorded even for users not ranked here yet; another worker may know them
+        if delta:
+            self.deltas[user_id] = self.deltas.get(user_id, 0) + delta
+        super().add_points(user_id, delta)
+
+    def changes(self) -> Dict[str, list]:
+        changes = {}
+        if self.new_users:
+            changes['users'] = self.new_users
+        if self.deltas:
+            changes['points'] = list(self.deltas.items())
+        return changes
+
+    def clear_changes(self) -> None:
+        self.new_users = []
+        self.deltas = {}
+
+    def apply(self, changes: Dict[str, list]) -> None:
+        """Apply another worker's changes without recording them again"""
+        for user_id, username in changes.get('users', ()):
+            if user_id in self:
+                if self._usernames.get(user_id) is None:
+                    self._usernames[user_id] = username
+            else:
+                super().add_user(user_id, username)
+        for user_id, delta in changes.get('points', ()):
+            if user_id in self:
+                super().add_points(user_id, delta)
+            else:
+                # Users start with no points, so the delta is their total
+                super().add_user(user_id, None, delta)
+
+
+# Worker process
+
+class _WorkerLoop:
+    """Feeds a worker's DogeBot from its ring and reports back to the ingress"""
+
+    def __init__(self, doge: 'bot.DogeBot', application: Application, inbox: ShmRing, outbox: ShmRing,
+                 in_bell: int, out_bell: int):
+        self.doge = doge
+        self.application = application
+        self.inbox = inbox
+        self.outbox = outbox
+        self.in_bell = in_bell
+        self.out_bell = out_bell
+        self.tasks_changed = False
+        self._stopped = asyncio.Event()
+        self._retry = None
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+    def _tasks_changed(self) -> None:
+        self.tasks_changed = True
+
+    def _wake(self) -> None:
+        _clear_bell(self.in_bell)
+        self._drain()
+
+    def _drain(self) -> None:
+        self._retry = None
+        queue = self.application.update_queue
+        processor = self.doge.update_processor
+        while not self._stopped.is_set():
+            # Leave updates on the ring (and the ingress waiting) while this worker is behind
+            if queue.qsize() + processor.queued + processor.in_flight >= WORKER_MAX_QUEUED:
+                self._retry = asyncio.get_running_loop().call_later(0.005, self._drain)
+                return
+            record = self.inbox.get()
+            if record is None:
+                return
+            kind = record[:1]
+            if kind == RECORD_UPDATE:
+                queue.put_nowait(Update.de_json(json.loads(record[1:]), self.application.bot))
+            elif kind == RECORD_PEER:
+                changes = json.loads(record[1:])
+                self.doge.leaderboard.apply(changes)
+                if changes.get('tasks'):
+                    asyncio.create_task(self.doge.reload_tasks())
+            elif kind == RECORD_STOP:
+                self.stop()
+
+    def report(self, ready: bool = False) -> None:
+        """Send progress and any leaderboard or task changes to the ingress"""
+        processor = self.doge.update_processor
+        report: Dict[str, Any] = {'processed': processor.processed, 'shed': processor.shed}
+        if ready:
+            report['ready'] = True
+        report.update(self.doge.leaderboard.changes())
+        if self.tasks_changed:
+            report['tasks'] = True
+        try:
+            sent = self.outbox.put(RECORD_REPORT + json.dumps(report).encode())
+        except ValueError:
+            # Too many changes for one record; the periodic reload catches up
+            logger.warning(f"Dropping an oversized worker report ({len(report.get('points', ()))} changes)")
+            sent = True
+        if sent:
+            self.doge.leaderboard.clear_changes()
+            self.tasks_changed = False
+            _ring_bell(self.out_bell)
+
+    async def _report_loop(self) -> None:
+        reported = None
+        while True:
+            await asyncio.sleep(WORKER_SYNC_MS / 1000)
+            processor = self.doge.update_processor
+            progress = (processor.processed, processor.shed)
+            if progress != reported or self.doge.leaderboard.new_users or self.doge.leaderboard.deltas \
+                    or self.tasks_changed:
+                self.report()
+                reported = progress
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_REFRESH_S)
+            try:
+                # Write queued completions first so the reload includes them
+                await self.doge.batcher.flush()
+                self.doge.leaderboard.load(await self.doge.storage.get_scores())
+            except Exception as e:
+                logger.error(f"Error refreshing the leaderboard: {str(e)}")
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.doge.on_tasks_changed = self._tasks_changed
+        loop.add_reader(self.in_bell, self._wake)
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        background = [asyncio.create_task(self._report_loop()), asyncio.create_task(self._refresh_loop())]
+        self.report(ready=True)
+        self._drain()
+        try:
+            await self._stopped.wait()
+        finally:
+            loop.remove_reader(self.in_bell)
+            if self._retry:
+                self._retry.cancel()
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+
+
+async def _run_worker(index: int, count: int, inbox_name: str, outbox_name: str,
+                      in_bell, out_bell, options: Dict[str, Any]) -> None:
+    # The ingress records traces and receives updates; workers only handle them
+    bot.TRACE_PATH = ''
+    bot.UPDATE_MODE = 'polling'
+    if metrics.METRICS_PORT:
+        metrics.METRICS_PORT = str(int(metrics.METRICS_PORT) + index)
+    os.set_blocking(in_bell.fileno(), False)
+    os.set_blocking(out_bell.fileno(), False)
+
+    if options.get('db_path'):
+        storage = Storage(options['db_path'])
+    else:
+        storage = create_storage()
+    storage.open()
+    await storage.init_db()
+
+    fake_api = options.get('fake_api')
+    if fake_api is not None:
+        request = FakeTelegramAPI(**fake_api)
+        dispatcher = OutboundDispatcher(global_rate=1e6, chat_rate=1e6, chat_burst=1e6)
+    else:
+        # Telegram's global limit applies to the bot as a whole
+        request = None
+        dispatcher = OutboundDispatcher(global_rate=GLOBAL_RATE / count)
+    doge = bot.DogeBot(options.get('token') or bot.TOKEN, storage, request=request,
+                       dispatcher=dispatcher, worker=(index, count))
+    doge.leaderboard = PeerLeaderboard()
+    if not options.get('throttle', True):
+        doge.throttle = None
+
+    inbox = ShmRing(inbox_name)
+    outbox = ShmRing(outbox_name)
+    try:
+        application = await doge.initialize()
+        await application.initialize()
+        await doge.post_init(application)
+        await application.start()
+        worker = _WorkerLoop(doge, application, inbox, outbox, in_bell.fileno(), out_bell.fileno())
+        logger.info(f"Worker {index} of {count} ready (pid {os.getpid()})")
+        await worker.run()
+
+        # Finish what was taken off the ring, then flush and report one last time
+        await application.stop()
+        await doge.shutdown()
+        worker.report()
+    finally:
+        inbox.close()
+        outbox.close()
+        await storage.close()
+    logger.info(f"Worker {index} stopped")
+
+
+def _worker_main(index: int, count: int, inbox_name: str, outbox_name: str,
+                 in_bell, out_bell, options: Dict[str, Any]) -> None:
+    # Ctrl+C reaches the whole process group; the ingress decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(_run_worker(index, count, inbox_name, outbox_name, in_bell, out_bell, options))
+    finally:
+        # Child processes exit without running atexit hooks
+        logs.shutdown()
+
+
+# Ingress process
+
+class _Worker:
+    def __init__(self, index: int, ring_bytes: int):
+        self.index = index
+        self.inbox = ShmRing(size=ring_bytes)
+        self.outbox = ShmRing(size=ring_bytes)
+        self.in_bell = multiprocessing.Pipe(duplex=False)
+        self.out_bell = multiprocessing.Pipe(duplex=False)
+        os.set_blocking(self.in_bell[1].fileno(), False)
+        os.set_blocking(self.out_bell[0].fileno(), False)
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.backlog: Deque[Tuple[bytes, Optional[asyncio.Future]]] = deque()
+        self.bell_pending = False
+        self.ready = asyncio.Event()
+        self.draining = False
+        self.exited: Optional[asyncio.Future] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        # Totals reported by earlier processes of this worker plus the current one's
+        self.processed = 0
+        self.shed = 0
+        self._base = (0, 0)
+
+    def close(self) -> None:
+        self.inbox.close()
+        self.outbox.close()
+        for conn in self.in_bell + self.out_bell:
+            conn.close()
+
+
+class WorkerPool:
+    """Worker processes running the handlers, fed with updates by user
+
+    Each update goes to worker shard_for(user_id, count) through that
+    worker's shared-memory ring, so one user's updates always reach the same
+    process in arrival order and per-user state (caches, dedupe, ordering
+    locks) stays local. Workers report progress and leaderboard/task
+    changes on a second ring, which the pool forwards to the others.
+    restart() drains a worker (it finishes everything queued before the
+    stop record) and starts a new process on the same rings, so updates
+    that arrive meanwhile wait and are handled in order. Workers that exit
+    on their own (a crash, or SIGTERM to drain one) are restarted too.
+    """
+
+    def __init__(self, count: int = WORKERS, options: Optional[Dict[str, Any]] = None,
+                 ring_bytes: int = WORKER_RING_BYTES):
+        self.count = max(count, 1)
+        self.options = options or {}
+        self.ring_bytes = ring_bytes
+        self.workers: List[_Worker] = []
+        self._context = multiprocessing.get_context('spawn')
+        self._pump: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.workers = [_Worker(index, self.ring_bytes) for index in range(self.count)]
+        for worker in self.workers:
+            loop.add_reader(worker.out_bell[0].fileno(), self._on_reports, worker)
+            self._spawn(worker)
+
+    async def wait_ready(self) -> None:
+        await asyncio.gather(*(worker.ready.wait() for worker in self.workers))
+
+    def _spawn(self, worker: _Worker) -> None:
+        loop = asyncio.get_running_loop()
+        worker.ready.clear()
+        worker.exited = loop.create_future()
+        worker.started_at = time.monotonic()
+        worker._base = (worker.processed, worker.shed)
+        worker.process = self._context.Process(
+            target=_worker_main, name=f'doge-worker-{worker.index}',
+            args=(worker.index, self.count, worker.inbox.name, worker.outbox.name,
+                  worker.in_bell[0], worker.out_bell[1], self.options))
+        worker.process.start()
+        loop.add_reader(worker.process.sentinel, self._on_exit, worker)
+        logger.info(f"Started worker {worker.index} (pid {worker.process.pid})")
+
+    def _on_exit(self, worker: _Worker) -> None:
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(worker.process.sentinel)
+        worker.process.join()
+        worker.ready.clear()
+        self._on_reports(worker)
+        if not worker.exited.done():
+            worker.exited.set_result(worker.process.exitcode)
+        if worker.draining or self._closing:
+            return
+        if worker.process.exitcode:
+            logger.error(f"Worker {worker.index} died with exit code {worker.process.exitcode}; restarting")
+        else:
+            logger.info(f"Worker {worker.index} stopped on its own; restarting")
+        worker.restarts += 1
+        delay = max(RESTART_BACKOFF - (time.monotonic() - worker.started_at), 0)
+        loop.call_later(delay, self._respawn, worker)
+
+    def _respawn(self, worker: _Worker) -> None:
+        if not self._closing and not worker.draining:
+            self._spawn(worker)
+
+    def worker_for(self, key: Optional[int]) -> _Worker:
+        return self.workers[shard_for(key, self.count) if key is not None else 0]
+
+    async def submit(self, key: Optional[int], update_json: bytes) -> None:
+        """Queue an update for the worker that owns key; waits while its ring is full"""
+        future = self._send(self.worker_for(key), RECORD_UPDATE + update_json)
+        if future is not None:
+            await future
+
+    def _send(self, worker: _Worker, record: bytes, wait: bool = True) -> Optional[asyncio.Future]:
+        if not worker.backlog:
+            try:
+                if worker.inbox.put(record):
+                    self._ring(worker)
+                    return None
+            except ValueError as e:
+                logger.error(f"Dropping a record for worker {worker.index}: {str(e)}")
+                return None
+        future = asyncio.get_running_loop().create_future() if wait else None
+        worker.backlog.append((record, future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._pump_backlogs())
+        return future
+
+    async def _pump_backlogs(self) -> None:
+        """Move records that did not fit into their rings as workers make room"""
+        while any(worker.backlog for worker in self.workers):
+            for worker in self.workers:
+                while worker.backlog and worker.inbox.put(worker.backlog[0][0]):
+                    _, future = worker.backlog.popleft()
+                    if future is not None and not future.done():
+                        future.set_result(None)
+                    self._ring(worker)
+            await asyncio.sleep(0.001)
+
+    def _ring(self, worker: _Worker) -> None:
+        # One wake-up per worker per event-loop iteration, however many records were added
+        if not worker.bell_pending:
+            worker.bell_pending = True
+            asyncio.get_running_loop().call_soon(self._ring_now, worker)
+
+    def _ring_now(self, worker: _Worker) -> None:
+        worker.bell_pending = False
+        _ring_bell(worker.in_bell[1].fileno())
+
+    def _on_reports(self, worker: _Worker) -> None:
+        _clear_bell(worker.out_bell[0].fileno())
+        while True:
+            record = worker.outbox.get()
+            if record is None:
+                return
+            report = json.loads(record[1:])
+            worker.processed = worker._base[0] + report['processed']
+            worker.shed = worker._base[1] + report['shed']
+            changes = {key: report[key] for key in ('users', 'points', 'tasks') if key in report}
+            if changes:
+                # Workers that are starting load the leaderboard themselves, so
+                # only ones already running get the changes
+                peer = RECORD_PEER + json.dumps(changes).encode()
+                for other in self.workers:
+                    if other is not worker and other.ready.is_set() and not other.draining:
+                        self._send(other, peer, wait=False)
+            if report.get('ready'):
+                worker.ready.set()
+
+    async def restart(self, index: int) -> None:
+        """Drain worker index and start a fresh process in its place"""
+        worker = self.workers[index]
+        if worker.draining:
+            return
+        worker.draining = True
+        try:
+            self._send(worker, RECORD_STOP, wait=False)
+            try:
+                await asyncio.wait_for(asyncio.shield(worker.exited), WORKER_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Worker {index} did not drain within {WORKER_DRAIN_TIMEOUT}s; killing it")
+                worker.process.kill()
+                await worker.exited
+            worker.restarts += 1
+            self._spawn(worker)
+            await worker.ready.wait()
+        finally:
+            worker.draining = False
+        logger.info(f"Restarted worker {index} (pid {worker.process.pid})")
+
+    async def rolling_restart(self) -> None:
+        """Restart the workers one at a time (e.g. to pick up new code)"""
+        for index in range(self.count):
+            await self.restart(index)
+
+    async def close(self) -> None:
+        """Drain every worker and release the rings"""
+        self._closing = True
+        loop = asyncio.get_running_loop()
+        waiting = []
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                self._send(worker, RECORD_STOP, wait=False)
+                waiting.append(worker)
+        # Let records still queued behind full rings through
+        while any(worker.backlog and worker.process.is_alive() for worker in waiting):
+            await asyncio.sleep(0.01)
+        for worker in waiting:
+            try:
+                await asyncio.wait_for(asyncio.shield(worker.exited), WORKER_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Worker {worker.index} did not drain within {WORKER_DRAIN_TIMEOUT}s; killing it")
+                worker.process.kill()
+                await worker.exited
+        if self._pump:
+            self._pump.cancel()
+        for worker in self.workers:
+            loop.remove_reader(worker.out_bell[0].fileno())
+            worker.close()
+        logger.info(f"Worker pool closed: {self.stats()}")
+
+    def stats(self) -> dict:
+        return {
+            'workers': self.count,
+            'processed': sum(worker.processed for worker in self.workers),
+            'shed': sum(worker.shed for worker in self.workers),
+            'backlog': sum(len(worker.backlog) for worker in self.workers),
+            'restarts': sum(worker.restarts for worker in self.workers),
+        }
+
+
+class RoutingUpdateProcessor(BaseUpdateProcessor):
+    """Hands every update to its user's worker instead of running handlers"""
+
+    def __init__(self, pool: WorkerPool, max_pending: int = INGRESS_MAX_PENDING):
+        super().__init__(max_pending)
+        self.pool = pool
+        # Called with every update as it arrives
+        self.on_arrival = None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # The ingress has no handlers; the worker runs them
+        if asyncio.iscoroutine(coroutine):
+            coroutine.close()
+        if self.on_arrival:
+            self.on_arrival(update)
+        if isinstance(update, Update):
+            await self.pool.submit(UserOrderedUpdateProcessor.key_for(update), update.to_json().encode())
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+async def poll_until_stopped(application: Application) -> None:
+    """Long-poll Telegram until SIGINT/SIGTERM
+
+    run_polling() drives its own event loop, so it cannot be used from a
+    coroutine; this starts the application and updater on the running loop.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    await application.initialize()
+    await application.updater.start_polling(poll_interval=1.0, timeout=30, drop_pending_updates=True)
+    await application.start()
+    try:
+        await stop.wait()
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+
+
+async def run_ingress(count: int = WORKERS) -> None:
+    """Receive updates (polling or webhook) and route them to count worker processes"""
+    # Migrate once here rather than racing in every worker
+    storage = create_storage()
+    storage.open()
+    await storage.init_db()
+    await storage.close()
+
+    pool = WorkerPool(count)
+    await pool.start()
+    await pool.wait_ready()
+    logger.info(f"{count} workers ready")
+
+    processor = RoutingUpdateProcessor(pool)
+    builder = Application.builder().token(bot.TOKEN).concurrent_updates(processor)
+    if bot.UPDATE_MODE == 'webhook':
+        builder = builder.update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)).updater(None)
+    application = builder.build()
+    recorder = None
+    if TRACE_PATH:
+        recorder = TraceRecorder(TRACE_PATH, keep_ids=(bot.YOUR_ADMIN_USER_ID,))
+        processor.on_arrival = recorder.record
+
+    loop = asyncio.get_running_loop()
+    restarts = set()
+
+    def rolling_restart() -> None:
+        task = asyncio.create_task(pool.rolling_restart())
+        restarts.add(task)
+        task.add_done_callback(restarts.discard)
+
+    loop.add_signal_handler(signal.SIGHUP, rolling_restart)
+    try:
+        if bot.UPDATE_MODE == 'webhook':
+            await run_webhook(application)
+        else:
+            await poll_until_stopped(application)
+    except (TelegramError, ValueError) as e:
+        # Telegram refusing the token or the webhook, or missing webhook settings
+        logger.error(f"Error running ingress: {str(e)}")
+    finally:
+        loop.remove_signal_handler(signal.SIGHUP)
+        await pool.close()
+        if recorder:
+            recorder.close()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+
+
+# Benchmark
+
+async def _bench_one(count: int, args: argparse.Namespace) -> dict:
+    from loadtest import MIXES, UpdateFactory, seed_database
+
+    rng = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(prefix='doge-workers-'), 'bench.db')
+    storage = Storage(path)
+    storage.open()
+    await storage.init_db()
+    await storage.transaction(seed_database, args.users, args.tasks, 3, 0.5, rng)
+    task_ids = [task_id for task_id, *_ in await storage.get_tasks()]
+    await storage.close()
+
+    token = '1:bench'
+    factory = UpdateFactory(Bot(token), args.users, task_ids, MIXES[args.mix], rng)
+    updates = []
+    for _ in range(args.updates):
+        update = factory.next()
+        updates.append((UserOrderedUpdateProcessor.key_for(update), update.to_json().encode()))
+
+    pool = WorkerPool(count, {'token': token, 'db_path': path, 'throttle': False,
+                              'fake_api': {'latency': args.latency_ms / 1000, 'jitter': args.jitter_ms / 1000}})
+    await pool.start()
+    await pool.wait_ready()
+    started = time.perf_counter()
+    for key, update_json in updates:
+        await pool.submit(key, update_json)
+    while pool.stats()['processed'] < args.updates:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    if args.restart and count > 1:
+        # Drain and replace one worker to check nothing is lost on the way
+        await pool.restart(0)
+    per_worker = [worker.processed for worker in pool.workers]
+    await pool.close()
+    return {'workers': count, 'elapsed_s': elapsed, 'throughput_per_s': args.updates / elapsed,
+            'per_worker': per_worker}
+
+
+async def benchmark(args: argparse.Namespace) -> List[dict]:
+    results = []
+    for count in args.workers:
+        result = await _bench_one(count, args)
+        results.append(result)
+        speedup = result['throughput_per_s'] / results[0]['throughput_per_s']
+        print(f"{count:>3} workers  {result['throughput_per_s']:8.0f} updates/s  "
+              f"x{speedup:4.2f}  per worker {result['per_worker']}")
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Run Doge Bot as an ingress process and worker processes")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="serve the bot with DOGE_WORKERS worker processes")
+    run.add_argument('--workers', type=int, default=WORKERS)
+    bench = commands.add_parser('bench', help="measure throughput per worker count against a fake Bot API")
+    bench.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    bench.add_argument('--updates', type=int, default=5000)
+    bench.add_argument('--users', type=int, default=10000)
+    bench.add_argument('--tasks', type=int, default=20)
+    bench.add_argument('--mix', default='default')
+    # No simulated network by default, so the handlers' CPU time is what is measured
+    bench.add_argument('--latency-ms', type=float, default=0)
+    bench.add_argument('--jitter-ms', type=float, default=0)
+    bench.add_argument('--restart', action='store_true', help="also drain and restart a worker after each run")
+    bench.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        asyncio.run(run_ingress(args.workers))
+        return
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"{os.cpu_count()} CPUs available")
+    asyncio.run(benchmark(args))
+
+
+if __name__ == '__main__':
+    main()